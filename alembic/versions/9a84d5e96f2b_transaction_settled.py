@@ -0,0 +1,39 @@
+"""transaction settled
+
+Revision ID: 9a84d5e96f2b
+Revises: 8a1ba649da16
+Create Date: 2026-10-18 10:52:11.402915
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9a84d5e96f2b'
+down_revision: Union[str, None] = '8a1ba649da16'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('transaction',
+    sa.Column('settled', sa.Boolean(), server_default=sa.true(), nullable=False),
+    schema='eventhorizon'
+    )
+    # Only unsettled rows are indexed, the write-behind flush looks them up by subscription
+    op.create_index('ix_transaction_unsettled', 'transaction', ['subscription_id'], unique=False,
+    schema='eventhorizon',
+    postgresql_where=sa.text('NOT settled')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_transaction_unsettled', table_name='transaction', schema='eventhorizon',
+    postgresql_where=sa.text('NOT settled')
+    )
+    op.drop_column('transaction', 'settled', schema='eventhorizon')
@@ -0,0 +1,154 @@
+"""partition metricvalue and transaction
+
+Revision ID: e5b2c8d17a43
+Revises: c41e7a9d2f10
+Create Date: 2026-10-18 16:41:05.118204
+
+"""
+import datetime
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e5b2c8d17a43'
+down_revision: Union[str, None] = 'c41e7a9d2f10'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+SCHEMA = 'eventhorizon'
+
+# Monthly partitions created past the current month, partitions.py keeps them ahead from then on
+MONTHS_AHEAD = 3
+
+COLUMNS = {
+    'metricvalue': ['value', 'calculated_on', 'metric_id', 'id', 'created_at'],
+    'transaction': ['subscription_id', 'metric_id', 'amount', 'id', 'created_at', 'settled'],
+}
+
+
+def _qualified(table_name):
+    return f'{SCHEMA}."{table_name}"'
+
+
+def _next_month(month):
+    return month.replace(year=month.year + month.month // 12, month=month.month % 12 + 1)
+
+
+def _create_partitions(table_name, key, source_table_name):
+    # Default partition for rows outside every monthly one, monthly partitions from the oldest row to MONTHS_AHEAD
+    op.execute(f'CREATE TABLE {_qualified(f"{table_name}_default")} PARTITION OF {_qualified(table_name)} DEFAULT')
+
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    first = op.get_bind().execute(sa.text(f'SELECT min({key}) FROM {_qualified(source_table_name)}')).scalar()
+    month = min(first or now, now).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    last = now
+    for _ in range(MONTHS_AHEAD):
+        last = _next_month(last.replace(day=1))
+
+    while month <= last:
+        op.execute(
+            f"CREATE TABLE {_qualified(f'{table_name}_p{month:%Y_%m}')} PARTITION OF {_qualified(table_name)} "
+            f"FOR VALUES FROM ('{month.isoformat()}') TO ('{_next_month(month).isoformat()}')"
+        )
+        month = _next_month(month)
+
+
+def _swap(table_name, key, create_table):
+    # Rename the old table out of the way, create the new one on the same id sequence and copy the rows over
+    old_table_name = f'{table_name}_old'
+    op.execute(f'ALTER TABLE {_qualified(table_name)} RENAME TO "{old_table_name}"')
+    op.execute(f'ALTER INDEX {_qualified(f"{table_name}_pkey")} RENAME TO "{old_table_name}_pkey"')
+    op.execute(f'ALTER SEQUENCE {_qualified(f"{table_name}_id_seq")} OWNED BY NONE')
+
+    create_table()
+    op.execute(f'ALTER SEQUENCE {_qualified(f"{table_name}_id_seq")} OWNED BY {_qualified(table_name)}.id')
+    if key is not None:
+        _create_partitions(table_name, key, old_table_name)
+
+    columns = ', '.join(COLUMNS[table_name])
+    op.execute(
+        f'INSERT INTO {_qualified(table_name)} ({columns}) SELECT {columns} FROM {_qualified(old_table_name)}'
+    )
+    op.drop_table(old_table_name, schema=SCHEMA)
+
+
+def _id_column(table_name):
+    return sa.Column('id', sa.Integer(), server_default=sa.text(f"nextval('{SCHEMA}.{table_name}_id_seq'::regclass)"),
+                     nullable=False)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # The primary key of a partitioned table has to include its partition key, calculated_on becomes required
+    op.execute(f'UPDATE {_qualified("metricvalue")} SET calculated_on = created_at WHERE calculated_on IS NULL')
+    _swap('metricvalue', 'calculated_on', lambda: op.create_table('metricvalue',
+    sa.Column('value', sa.Numeric(precision=10, scale=4), nullable=True),
+    sa.Column('calculated_on', sa.DateTime(), nullable=False),
+    sa.Column('metric_id', sa.Integer(), nullable=True),
+    _id_column('metricvalue'),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['metric_id'], ['eventhorizon.metric.id'], ),
+    sa.PrimaryKeyConstraint('id', 'calculated_on'),
+    schema='eventhorizon',
+    postgresql_partition_by='RANGE (calculated_on)'
+    ))
+
+    op.drop_index('ix_transaction_unsettled', table_name='transaction', schema='eventhorizon',
+    postgresql_where=sa.text('NOT settled')
+    )
+    _swap('transaction', 'created_at', lambda: op.create_table('transaction',
+    sa.Column('subscription_id', sa.Integer(), nullable=True),
+    sa.Column('metric_id', sa.Integer(), nullable=True),
+    sa.Column('amount', sa.Numeric(precision=10, scale=4), nullable=True),
+    _id_column('transaction'),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('settled', sa.Boolean(), server_default=sa.true(), nullable=False),
+    sa.ForeignKeyConstraint(['metric_id'], ['eventhorizon.metric.id'], ),
+    sa.ForeignKeyConstraint(['subscription_id'], ['eventhorizon.subscription.id'], ),
+    sa.PrimaryKeyConstraint('id', 'created_at'),
+    schema='eventhorizon',
+    postgresql_partition_by='RANGE (created_at)'
+    ))
+    # Created on every partition
+    op.create_index('ix_transaction_unsettled', 'transaction', ['subscription_id'], unique=False,
+    schema='eventhorizon',
+    postgresql_where=sa.text('NOT settled')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    # Rows of partitions detached by partitions.py are not copied back
+    op.drop_index('ix_transaction_unsettled', table_name='transaction', schema='eventhorizon',
+    postgresql_where=sa.text('NOT settled')
+    )
+    _swap('transaction', None, lambda: op.create_table('transaction',
+    sa.Column('subscription_id', sa.Integer(), nullable=True),
+    sa.Column('metric_id', sa.Integer(), nullable=True),
+    sa.Column('amount', sa.Numeric(precision=10, scale=4), nullable=True),
+    _id_column('transaction'),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('settled', sa.Boolean(), server_default=sa.true(), nullable=False),
+    sa.ForeignKeyConstraint(['metric_id'], ['eventhorizon.metric.id'], ),
+    sa.ForeignKeyConstraint(['subscription_id'], ['eventhorizon.subscription.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    schema='eventhorizon'
+    ))
+    op.create_index('ix_transaction_unsettled', 'transaction', ['subscription_id'], unique=False,
+    schema='eventhorizon',
+    postgresql_where=sa.text('NOT settled')
+    )
+
+    _swap('metricvalue', None, lambda: op.create_table('metricvalue',
+    sa.Column('value', sa.Numeric(precision=10, scale=4), nullable=True),
+    sa.Column('calculated_on', sa.DateTime(), nullable=True),
+    sa.Column('metric_id', sa.Integer(), nullable=True),
+    _id_column('metricvalue'),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['metric_id'], ['eventhorizon.metric.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    schema='eventhorizon'
+    ))
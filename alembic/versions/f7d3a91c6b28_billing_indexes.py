@@ -0,0 +1,109 @@
+"""billing indexes
+
+Revision ID: f7d3a91c6b28
+Revises: e5b2c8d17a43
+Create Date: 2026-10-18 18:12:40.627351
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f7d3a91c6b28'
+down_revision: Union[str, None] = 'e5b2c8d17a43'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+SCHEMA = 'eventhorizon'
+
+PARTITIONED_INDEXES = [
+    ('ix_transaction_subscription_id_created_at', 'transaction', ['subscription_id', 'created_at']),
+    ('ix_transaction_metric_id_created_at', 'transaction', ['metric_id', 'created_at']),
+    ('ix_metricvalue_metric_id_calculated_on', 'metricvalue', ['metric_id', 'calculated_on']),
+]
+
+
+def _qualified(name):
+    return f'{SCHEMA}."{name}"'
+
+
+def _drop_invalid(name):
+    # Left behind by an interrupted CREATE INDEX CONCURRENTLY, IF NOT EXISTS would keep it
+    invalid = op.get_bind().execute(sa.text(
+        'SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)'
+    ), {'name': _qualified(name)}).scalar()
+    if invalid:
+        op.execute(f'DROP INDEX CONCURRENTLY {_qualified(name)}')
+
+
+def _create_partitioned_index(name, table_name, columns):
+    # CONCURRENTLY is not supported on partitioned tables: create the parent index invalid and empty
+    # (ON ONLY), build the index of each partition concurrently and attach it, the parent becomes valid
+    # once every partition has one. Partitions created later get theirs from the parent.
+    column_list = ', '.join(columns)
+    op.execute(f'CREATE INDEX IF NOT EXISTS "{name}" ON ONLY {_qualified(table_name)} ({column_list})')
+
+    partitions = op.get_bind().execute(sa.text(
+        'SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+        'WHERE i.inhparent = CAST(:table AS regclass) ORDER BY c.relname'
+    ), {'table': _qualified(table_name)}).scalars().all()
+    for partition in partitions:
+        partition_index = f'{partition}_{"_".join(columns)}_idx'
+        _drop_invalid(partition_index)
+        op.execute(
+            f'CREATE INDEX CONCURRENTLY IF NOT EXISTS "{partition_index}" ON {_qualified(partition)} ({column_list})'
+        )
+        attached = op.get_bind().execute(sa.text(
+            'SELECT EXISTS (SELECT 1 FROM pg_inherits WHERE inhrelid = CAST(:index AS regclass))'
+        ), {'index': _qualified(partition_index)}).scalar()
+        if not attached:
+            op.execute(f'ALTER INDEX {_qualified(name)} ATTACH PARTITION {_qualified(partition_index)}')
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Built without blocking writes, outside the migration's transaction
+    with op.get_context().autocommit_block():
+        for name in ('ix_subscription_topic_id', 'ix_subscription_client_id', 'ix_metric_topic_ids'):
+            _drop_invalid(name)
+
+        op.create_index('ix_subscription_topic_id', 'subscription', ['topic_id'], unique=False,
+        schema='eventhorizon',
+        postgresql_concurrently=True,
+        if_not_exists=True
+        )
+        op.create_index('ix_subscription_client_id', 'subscription', ['client_id'], unique=False,
+        schema='eventhorizon',
+        postgresql_concurrently=True,
+        if_not_exists=True
+        )
+        op.create_index('ix_metric_topic_ids', 'metric', ['topic_ids'], unique=False,
+        schema='eventhorizon',
+        postgresql_using='gin',
+        postgresql_concurrently=True,
+        if_not_exists=True
+        )
+
+        for name, table_name, columns in PARTITIONED_INDEXES:
+            _create_partitioned_index(name, table_name, columns)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    for name, table_name, columns in PARTITIONED_INDEXES:
+        # Drops the partitions' indexes too
+        op.drop_index(name, table_name=table_name, schema='eventhorizon')
+
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_metric_topic_ids', table_name='metric', schema='eventhorizon',
+        postgresql_concurrently=True
+        )
+        op.drop_index('ix_subscription_client_id', table_name='subscription', schema='eventhorizon',
+        postgresql_concurrently=True
+        )
+        op.drop_index('ix_subscription_topic_id', table_name='subscription', schema='eventhorizon',
+        postgresql_concurrently=True
+        )
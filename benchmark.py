@@ -0,0 +1,338 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from decimal import Decimal
+from typing import Callable, List, NamedTuple
+
+from sqlalchemy import delete, func, insert, select, update
+
+from config import Config
+from database import with_database
+from export import peak_rss_mb
+import models
+
+SEED = 42
+# Fixed clock for generated data, runs with the same seed write the same documents
+NOW = datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc)
+THRESHOLD = 0.1
+
+# Higher is worse for every metric but throughput
+COMPARED = ('p50_ms', 'p95_ms', 'p99_ms', 'throughput', 'peak_rss_mb')
+
+
+class Scenario(NamedTuple):
+    # prepare(rng, count) -> (operations, cleanup), every operation returns the number of items it processed.
+    # Data is generated in prepare(), only the operations are timed.
+    prepare: Callable
+    count: int
+    warmup: int
+    description: str
+
+
+def _metric_ids(db) -> List[int]:
+    return [metric_id for metric_id, in db.query(models.Metric.id).order_by(models.Metric.id)]
+
+
+def _events(rng: random.Random, metric_ids: List[int], count: int):
+    return [(rng.choice(metric_ids), Decimal(rng.randint(1, 10000)) / 100) for _ in range(count)]
+
+
+def _billing_restorer(db):
+    """
+    Snapshot of everything billing writes, the returned function puts it back: metric values and transactions
+    past the current max ids are deleted, total_amount and the ledger and rollup rows from today on (a day
+    earlier, whatever time zone buckets are truncated in) are restored. Runs don't grow the database.
+    """
+    from rollups import ROLLUPS
+    from statements import Ledger
+
+    since = models.now().replace(tzinfo=None, hour=0, minute=0, second=0, microsecond=0) - datetime.timedelta(days=1)
+    max_ids = [
+        (model, db.query(func.coalesce(func.max(model.id), 0)).scalar())
+        for model in (models.MetricValue, models.Transaction)
+    ]
+    total_amounts = [
+        {'id': subscription_id, 'total_amount': total_amount}
+        for subscription_id, total_amount in db.query(models.Subscription.id, models.Subscription.total_amount)
+    ]
+    kept = [(Ledger.__table__, Ledger.day >= since.date())] + [
+        (rollup.__table__, rollup.bucket >= since) for rollup in ROLLUPS.values()
+    ]
+    snapshots = [(table, where, db.execute(select(table).where(where)).mappings().all()) for table, where in kept]
+    db.commit()
+
+    def restore():
+        db.rollback()
+        for model, max_id in max_ids:
+            db.execute(delete(model).where(model.id > max_id))
+        for table, where, rows in snapshots:
+            db.execute(delete(table).where(where))
+            if rows:
+                db.execute(insert(table), [dict(row) for row in rows])
+        db.execute(update(models.Subscription), total_amounts)
+        db.commit()
+
+    return restore
+
+
+def _billing(rng: random.Random, count: int):
+    from business import process_metric_value
+
+    stack = ExitStack()
+    db = stack.enter_context(with_database())
+    stack.callback(_billing_restorer(db))
+    events = _events(rng, _metric_ids(db), count)
+
+    def operation(metric_id, value):
+        process_metric_value(db, metric_id=metric_id, value=value)
+        return 1
+
+    return [lambda event=event: operation(*event) for event in events], stack.close
+
+
+def _billing_batch(rng: random.Random, count: int, batch_size: int = 100):
+    from business import process_metric_values
+
+    stack = ExitStack()
+    db = stack.enter_context(with_database())
+    stack.callback(_billing_restorer(db))
+    events = _events(rng, _metric_ids(db), count * batch_size)
+    batches = [events[i:i + batch_size] for i in range(0, len(events), batch_size)]
+
+    def operation(batch):
+        process_metric_values(db, batch)
+        return len(batch)
+
+    return [lambda batch=batch: operation(batch) for batch in batches], stack.close
+
+
+def _contents(count: int, batch_size: int):
+    from seed import generate_contents
+
+    with with_database() as db:
+        source_ids = [source_id for source_id, in db.query(models.Source.id).order_by(models.Source.id)]
+    documents = [document for batch in generate_contents(count * batch_size, source_ids, workers=1, now=NOW) for document in batch]
+    return [documents[i:i + batch_size] for i in range(0, len(documents), batch_size)]
+
+
+def _delete_contents(batches):
+    ids = [document['_id'] for batch in batches for document in batch if '_id' in document]
+    models.Content._get_collection().delete_many({'_id': {'$in': ids}})
+
+
+def _mongo_insert(rng: random.Random, count: int):
+    from nonrelational import BATCH_SIZE, bulk_insert_contents
+
+    batches = _contents(count, BATCH_SIZE)
+    operations = [lambda batch=batch: bulk_insert_contents(batch, batch_size=BATCH_SIZE) for batch in batches]
+    return operations, lambda: _delete_contents(batches)
+
+
+def _mongo_update(rng: random.Random, count: int):
+    from nonrelational import BATCH_SIZE, bulk_insert_contents, bulk_update_contents
+
+    batches = _contents(count, BATCH_SIZE)
+    for batch in batches:
+        bulk_insert_contents(batch, batch_size=BATCH_SIZE)
+
+    def update(document):
+        return {'title': f"UPDATED {document['title']}", 'updated_at': NOW}
+
+    operations = [
+        lambda batch=batch: bulk_update_contents(
+            update, fields=('title',), query={'_id': {'$in': [document['_id'] for document in batch]}}
+        )
+        for batch in batches
+    ]
+    return operations, lambda: _delete_contents(batches)
+
+
+def _export(rng: random.Random, count: int, table_name: str = 'metricvalue'):
+    from database import get_engine
+    from export import SQLiteSink, export_table
+
+    directory = tempfile.mkdtemp()
+    engine = get_engine()
+
+    def operation():
+        sink = SQLiteSink(os.path.join(directory, 'export.sqlite'))
+        try:
+            return export_table(engine, sink, table_name)['rows']
+        finally:
+            sink.close()
+
+    return [operation] * count, lambda: shutil.rmtree(directory, ignore_errors=True)
+
+
+SCENARIOS = {
+    'billing': Scenario(_billing, 500, 50, 'process_metric_value, one event per operation'),
+    'billing_batch': Scenario(_billing_batch, 50, 5, 'process_metric_values, 100 events per operation'),
+    'mongo_insert': Scenario(_mongo_insert, 20, 2, 'bulk_insert_contents, one batch per operation'),
+    'mongo_update': Scenario(_mongo_update, 20, 2, 'bulk_update_contents, one batch per operation'),
+    'export': Scenario(_export, 3, 1, 'export_table(metricvalue) to SQLite, one table per operation'),
+}
+
+
+def summarize(latencies: List[float], items: int, elapsed: float) -> dict:
+    # Percentiles in milliseconds, throughput in items per second
+    if not latencies:
+        # Nothing ran (--count 0 or every operation failed)
+        return {
+            'operations': 0,
+            'items': items,
+            'seconds': elapsed,
+            'throughput': 0.0,
+            **dict.fromkeys(('mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms'), 0.0),
+        }
+    cuts = statistics.quantiles(latencies, n=100, method='inclusive') if len(latencies) > 1 else latencies * 99
+    return {
+        'operations': len(latencies),
+        'items': items,
+        'seconds': elapsed,
+        'throughput': items / elapsed if elapsed else 0.0,
+        'mean_ms': statistics.fmean(latencies) * 1000,
+        'p50_ms': cuts[49] * 1000,
+        'p95_ms': cuts[94] * 1000,
+        'p99_ms': cuts[98] * 1000,
+        'max_ms': max(latencies) * 1000,
+    }
+
+
+def run_scenario(name: str, count: int = None, warmup: int = None, seed: int = SEED) -> dict:
+    """
+    Runs `warmup` untimed operations then `count` timed ones of the scenario, all generated from `seed`.
+    """
+    scenario = SCENARIOS[name]
+    count = scenario.count if count is None else count
+    warmup = scenario.warmup if warmup is None else warmup
+
+    operations, cleanup = scenario.prepare(random.Random(seed), warmup + count)
+    try:
+        for operation in operations[:warmup]:
+            operation()
+
+        latencies = []
+        items = 0
+        started = time.perf_counter()
+        for operation in operations[warmup:]:
+            start_time = time.perf_counter()
+            items += operation()
+            latencies.append(time.perf_counter() - start_time)
+        elapsed = time.perf_counter() - started
+    finally:
+        cleanup()
+
+    return {**summarize(latencies, items, elapsed), 'warmup': warmup, 'peak_rss_mb': peak_rss_mb()}
+
+
+def run_isolated(name: str, **kwargs) -> dict:
+    # One fresh process per scenario, peak RSS and connection pools are its own
+    with ProcessPoolExecutor(max_workers=1) as pool:
+        return pool.submit(run_scenario, name, **kwargs).result()
+
+
+def compare(results: dict, baseline: dict, threshold: float = THRESHOLD) -> List[str]:
+    """
+    Regressions of `results` against `baseline` (two benchmark JSON documents): a latency or peak memory
+    more than `threshold` above the baseline's, or a throughput more than `threshold` below it.
+    """
+    regressions = []
+    for name, stats in results['scenarios'].items():
+        reference = baseline.get('scenarios', {}).get(name)
+        if reference is None:
+            continue
+        for metric in COMPARED:
+            current, previous = stats[metric], reference[metric]
+            if not previous:
+                continue
+            change = (current - previous) / previous
+            if (change < -threshold) if metric == 'throughput' else (change > threshold):
+                regressions.append(f"{name} {metric} {current:.3f} vs baseline {previous:.3f} ({change:+.1%})")
+    return regressions
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _write(path: str, document: dict):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(document, f, indent=2)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Runs benchmark scenarios against the configured databases.')
+    parser.add_argument('scenarios', nargs='*', help=f'any of {", ".join(SCENARIOS)} (default: all of them)')
+    parser.add_argument('--count', type=int, help='timed operations per scenario (default: per scenario)')
+    parser.add_argument('--warmup', type=int, help='untimed operations first (default: per scenario)')
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--output', help=f'results JSON (default: {Config.BENCHMARK_PATH}/<timestamp>.json)')
+    parser.add_argument('--baseline', default=os.path.join(Config.BENCHMARK_PATH, 'baseline.json'))
+    parser.add_argument('--threshold', type=float, default=THRESHOLD, help='relative change flagged as a regression')
+    parser.add_argument('--update-baseline', action='store_true', help='store these results as the baseline')
+    parser.add_argument('--in-process', action='store_true', help='run scenarios in this process (for profiling)')
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f'unknown scenarios: {", ".join(unknown)}')
+
+    started_at = datetime.datetime.now(datetime.timezone.utc)
+    results = {
+        'started_at': started_at.isoformat(),
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'machine': platform.node(),
+        'seed': args.seed,
+        'scenarios': {},
+    }
+
+    run = run_scenario if args.in_process else run_isolated
+    for name in args.scenarios or SCENARIOS:
+        print(f"Running {name}: {SCENARIOS[name].description}...")
+        stats = run(name, count=args.count, warmup=args.warmup, seed=args.seed)
+        results['scenarios'][name] = stats
+        print(f"{name}: {stats['operations']} operations ({stats['items']} items) in {stats['seconds']:.4f} seconds, "
+              f"{stats['throughput']:.1f} items per second, p50 {stats['p50_ms']:.3f} ms, p95 {stats['p95_ms']:.3f} ms, "
+              f"p99 {stats['p99_ms']:.3f} ms, peak RSS {stats['peak_rss_mb']:.1f} MB")
+
+    output = args.output or os.path.join(Config.BENCHMARK_PATH, f'{started_at:%Y%m%dT%H%M%S}.json')
+    _write(output, results)
+    print(f"Results written to {output}")
+
+    if args.update_baseline:
+        _write(args.baseline, results)
+        print(f"Baseline updated: {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --update-baseline to store one")
+        return 0
+
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f), args.threshold)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if not regressions:
+        print(f"No regression against {args.baseline} (threshold {args.threshold:.0%})")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,11 +1,20 @@
+import asyncio
 import decimal
 import time
+from collections import defaultdict
 from decimal import Decimal
-from typing import List
+from typing import Iterable, List, Tuple
 import datetime
-from sqlalchemy import insert, update
+from sqlalchemy import Integer, column, insert, literal, select, update, values
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session, load_only
 import models
+from counters import add_routes_to_stripes, routes_stripes_upsert, stripe_slot, stripes_upsert
+from instrumentation import instrumented, stage
+from rollups import add_to_rollups, rollup_upserts
+from routing import Route, billed_subscriptions, locked_in_order, routing_cache
+from statements import add_to_statements, transactions_upsert
+from writebehind import WriteBehindAggregator
 
 
 def create_client_with_subscription(
@@ -59,18 +68,222 @@ def add_content_with_metric_values(
     return content
 
 
-def process_metric_value(db: Session, metric_id: int, value: Decimal, calculated_on: datetime.datetime = None, _artificial_delay: float = 0):
+def _insert_billed(metric_id: int, topic_ids: List[int], calculated_on: datetime.datetime, settled: bool = True):
+    billed = billed_subscriptions(topic_ids).subquery()
+    return insert(models.Transaction).from_select(
+        ['subscription_id', 'metric_id', 'amount', 'created_at', 'settled'],
+        select(
+            billed.c.id,
+            literal(metric_id, Integer),
+            billed.c.single_metric_pricing,
+            literal(calculated_on, models.Transaction.created_at.type),
+            literal(settled),
+        )
+    ).returning(models.Transaction.subscription_id, models.Transaction.amount)
+
+
+def _insert_routes(metric_id: int, routes: Iterable[Route], calculated_on: datetime.datetime, settled: bool = True):
+    return insert(models.Transaction).values([
+        {
+            'subscription_id': subscription_id,
+            'metric_id': metric_id,
+            'amount': single_metric_pricing,
+            'created_at': calculated_on,
+            'settled': settled,
+        }
+        for subscription_id, single_metric_pricing in routes
+    ])
+
+
+def _update_billed(topic_ids: List[int]):
+    # Same rows as _insert_billed
+    billed_ids = billed_subscriptions(topic_ids).with_only_columns(models.Subscription.id)
+    return (
+        update(models.Subscription)
+        .where(models.Subscription.id.in_(locked_in_order(billed_ids)))
+        .values(total_amount=models.Subscription.total_amount + models.Subscription.single_metric_pricing)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def _update_route(route: Route, stripes: int = 0):
+    subscription_id, single_metric_pricing = route
+    if stripes:
+        return routes_stripes_upsert([route], stripe_slot(stripes))
+    return (
+        update(models.Subscription)
+        .where(models.Subscription.id == subscription_id)
+        .values(total_amount=models.Subscription.total_amount + single_metric_pricing)
+    )
+
+
+def _fan_out_set_based(
+    db: Session,
+    metric_id: int,
+    topic_ids: List[int],
+    calculated_on: datetime.datetime,
+    stripes: int = 0,
+) -> List[Route]:
+    inserted = db.execute(_insert_billed(metric_id, topic_ids, calculated_on)).all()
+
+    if stripes:
+        db.execute(stripes_upsert(topic_ids, stripe_slot(stripes)))
+    else:
+        db.execute(_update_billed(topic_ids))
+    return inserted
+
+
+def _fan_out_routes(
+    db: Session,
+    metric_id: int,
+    routes: Tuple[Route, ...],
+    calculated_on: datetime.datetime,
+    stripes: int = 0,
+) -> List[Route]:
+    if not routes:
+        return []
+
+    db.execute(_insert_routes(metric_id, routes, calculated_on))
+    if stripes:
+        db.execute(routes_stripes_upsert(routes, stripe_slot(stripes)))
+    else:
+        db.execute(_update_deltas(dict(routes)))
+    return list(routes)
+
+
+def _fan_out_unsettled(
+    db: Session,
+    metric_id: int,
+    topic_ids: List[int],
+    routes: Tuple[Route, ...],
+    calculated_on: datetime.datetime,
+) -> List[Route]:
+    # Transactions only, total_amount is left to the write-behind aggregator
+    if routes is None:
+        return db.execute(_insert_billed(metric_id, topic_ids, calculated_on, settled=False)).all()
+
+    if routes:
+        db.execute(_insert_routes(metric_id, routes, calculated_on, settled=False))
+    return list(routes)
+
+
+@instrumented('process_metric_value')
+def process_metric_value(
+    db: Session,
+    metric_id: int,
+    value: Decimal,
+    calculated_on: datetime.datetime = None,
+    _artificial_delay: float = 0,
+    set_based: bool = True,
+    use_routing_cache: bool = False,
+    aggregator: WriteBehindAggregator = None,
+    stripes: int = 0,
+):
     if calculated_on is None:
         calculated_on = models.now()
 
-    metric = db.query(models.Metric).options(
-        load_only(models.Metric.id, models.Metric.topic_ids)
-    ).get(metric_id)
+    with stage('metric_lookup'):
+        if use_routing_cache:
+            routes = routing_cache.get(db, metric_id)
+            topic_ids = None
+        else:
+            metric = db.query(models.Metric).options(
+                load_only(models.Metric.id, models.Metric.topic_ids)
+            ).get(metric_id)
 
-    if not metric:
-        raise ValueError(f"Metric with ID {metric_id} not found")
+            if not metric:
+                raise ValueError(f"Metric with ID {metric_id} not found")
 
-    db.execute(
+            routes = None
+            topic_ids = metric.topic_ids
+
+    with stage('metric_value_insert'):
+        db.execute(
+            insert(models.MetricValue).values(
+                metric_id=metric_id,
+                value=value,
+                calculated_on=calculated_on
+            )
+        )
+
+    if aggregator is not None:
+        with stage('fan_out'):
+            billed = _fan_out_unsettled(db, metric_id, topic_ids, routes, calculated_on)
+        if _artificial_delay:
+            time.sleep(_artificial_delay * len(billed))
+    elif set_based:
+        # Subscription query and writes are the same statements here
+        with stage('fan_out'):
+            if routes is None:
+                billed = _fan_out_set_based(db, metric_id, topic_ids, calculated_on, stripes)
+            else:
+                billed = _fan_out_routes(db, metric_id, routes, calculated_on, stripes)
+
+        if _artificial_delay:
+            # Keep the same lock window as the per-subscription loop below
+            time.sleep(_artificial_delay * len(billed))
+    else:
+        if routes is None:
+            with stage('fan_out_query'):
+                routes = db.execute(billed_subscriptions(topic_ids)).all()
+
+        with stage('subscription_writes'):
+            for route in routes:
+                db.execute(_insert_routes(metric_id, [route], calculated_on))
+                # Isolation check // add amount from transaction to subscription total money spent
+                db.execute(_update_route(route, stripes))
+                if _artificial_delay:
+                    time.sleep(_artificial_delay)
+        billed = routes
+
+    # Unsettled transactions reach the ledger when the aggregator settles them
+    if aggregator is None:
+        with stage('statements'):
+            add_to_statements(db, (
+                {'subscription_id': subscription_id, 'metric_id': metric_id, 'amount': amount, 'created_at': calculated_on}
+                for subscription_id, amount in billed
+            ), stripe_slot(stripes) if stripes else 0)
+    # Every writer of the metric shares the rollup rows, lock them last so they are held for the commit only
+    with stage('rollups'):
+        add_to_rollups(db, [{'metric_id': metric_id, 'value': value, 'calculated_on': calculated_on}])
+    with stage('commit'):
+        db.commit()
+    if aggregator is not None:
+        aggregator.record(billed)
+
+
+async def process_metric_value_async(
+    db: AsyncSession,
+    metric_id: int,
+    value: Decimal,
+    calculated_on: datetime.datetime = None,
+    _artificial_delay: float = 0,
+    set_based: bool = True,
+    use_routing_cache: bool = False,
+    aggregator: WriteBehindAggregator = None,
+    stripes: int = 0,
+):
+    # Same statements and lock order as process_metric_value, awaited so the delay and every round trip
+    # leave the event loop to the other workers
+    if calculated_on is None:
+        calculated_on = models.now()
+
+    if use_routing_cache:
+        # Hits are served from memory, misses load the routes through the session's sync facade
+        routes = await db.run_sync(routing_cache.get, metric_id)
+        topic_ids = None
+    else:
+        metric = await db.get(
+            models.Metric, metric_id, options=[load_only(models.Metric.id, models.Metric.topic_ids)]
+        )
+
+        if not metric:
+            raise ValueError(f"Metric with ID {metric_id} not found")
+
+        routes = None
+        topic_ids = metric.topic_ids
+
+    await db.execute(
         insert(models.MetricValue).values(
             metric_id=metric_id,
             value=value,
@@ -78,29 +291,159 @@ def process_metric_value(db: Session, metric_id: int, value: Decimal, calculated
         )
     )
 
-    subscriptions = db.query(
-        models.Subscription.id,
-        models.Subscription.single_metric_pricing,
-        models.Subscription.total_amount
-    ).join(models.Topic).filter(
-        models.Topic.id.in_(metric.topic_ids)
-    ).all()
-
-    for subscription in subscriptions:
-        db.execute(
-            insert(models.Transaction).values(
-                subscription_id=subscription.id,
-                metric_id=metric_id,
-                amount=subscription.single_metric_pricing,
-                created_at=calculated_on
-            )
-        )
-        # Isolation check // add amount from transaction to subscription total money spent
-        db.execute(
-            update(models.Subscription)
-            .where(models.Subscription.id == subscription.id)
-            .values(total_amount=models.Subscription.total_amount + subscription.single_metric_pricing)
-        )
+    if aggregator is not None:
+        if routes is None:
+            billed = (await db.execute(_insert_billed(metric_id, topic_ids, calculated_on, settled=False))).all()
+        else:
+            if routes:
+                await db.execute(_insert_routes(metric_id, routes, calculated_on, settled=False))
+            billed = list(routes)
         if _artificial_delay:
-            time.sleep(_artificial_delay)
+            await asyncio.sleep(_artificial_delay * len(billed))
+    elif set_based:
+        if routes is None:
+            billed = (await db.execute(_insert_billed(metric_id, topic_ids, calculated_on))).all()
+            if stripes:
+                await db.execute(stripes_upsert(topic_ids, stripe_slot(stripes)))
+            else:
+                await db.execute(_update_billed(topic_ids))
+        else:
+            if routes:
+                await db.execute(_insert_routes(metric_id, routes, calculated_on))
+                if stripes:
+                    await db.execute(routes_stripes_upsert(routes, stripe_slot(stripes)))
+                else:
+                    await db.execute(_update_deltas(dict(routes)))
+            billed = list(routes)
+        if _artificial_delay:
+            await asyncio.sleep(_artificial_delay * len(billed))
+    else:
+        if routes is None:
+            routes = (await db.execute(billed_subscriptions(topic_ids))).all()
+        for route in routes:
+            await db.execute(_insert_routes(metric_id, [route], calculated_on))
+            await db.execute(_update_route(route, stripes))
+            if _artificial_delay:
+                await asyncio.sleep(_artificial_delay)
+        billed = routes
+
+    if aggregator is None:
+        statement = transactions_upsert((
+            {'subscription_id': subscription_id, 'metric_id': metric_id, 'amount': amount, 'created_at': calculated_on}
+            for subscription_id, amount in billed
+        ), stripe_slot(stripes) if stripes else 0)
+        if statement is not None:
+            await db.execute(statement)
+    for statement in rollup_upserts([{'metric_id': metric_id, 'value': value, 'calculated_on': calculated_on}]):
+        await db.execute(statement)
+    await db.commit()
+    if aggregator is not None:
+        aggregator.record(billed)
+
+
+def _load_routes(db: Session, metric_ids: set) -> dict:
+    topic_ids_by_metric = dict(
+        db.query(models.Metric.id, models.Metric.topic_ids).filter(models.Metric.id.in_(metric_ids)).all()
+    )
+
+    missing_ids = metric_ids - topic_ids_by_metric.keys()
+    if missing_ids:
+        raise ValueError(f"Metric with ID {min(missing_ids)} not found")
+
+    topic_ids = {topic_id for ids in topic_ids_by_metric.values() for topic_id in ids or ()}
+    routes_by_topic = defaultdict(list)
+    for subscription in db.execute(
+        billed_subscriptions(list(topic_ids)).add_columns(models.Subscription.topic_id)
+    ):
+        routes_by_topic[subscription.topic_id].append((subscription.id, subscription.single_metric_pricing))
+
+    return {
+        metric_id: [
+            route
+            for topic_id in set(ids or ())
+            for route in routes_by_topic[topic_id]
+        ]
+        for metric_id, ids in topic_ids_by_metric.items()
+    }
+
+
+# Batch version of process_metric_value, events are (metric_id, value) or (metric_id, value, calculated_on) tuples
+def process_metric_values(
+    db: Session,
+    events: Iterable[Tuple],
+    use_routing_cache: bool = False,
+    aggregator: WriteBehindAggregator = None,
+    stripes: int = 0,
+) -> int:
+    default_calculated_on = models.now()
+
+    metric_values = []
+    for metric_id, value, *rest in events:
+        calculated_on = rest[0] if rest and rest[0] is not None else default_calculated_on
+        metric_values.append({
+            'metric_id': metric_id,
+            'value': value,
+            'calculated_on': calculated_on,
+        })
+
+    if not metric_values:
+        return 0
+
+    metric_ids = {metric_value['metric_id'] for metric_value in metric_values}
+    if use_routing_cache:
+        routes = {metric_id: routing_cache.get(db, metric_id) for metric_id in metric_ids}
+    else:
+        routes = _load_routes(db, metric_ids)
+
+    transactions = []
+    deltas = defaultdict(Decimal)
+    for metric_value in metric_values:
+        for subscription_id, single_metric_pricing in routes[metric_value['metric_id']]:
+            transactions.append({
+                'subscription_id': subscription_id,
+                'metric_id': metric_value['metric_id'],
+                'amount': single_metric_pricing,
+                'created_at': metric_value['calculated_on'],
+                'settled': aggregator is None,
+            })
+            deltas[subscription_id] += single_metric_pricing
+
+    db.execute(insert(models.MetricValue), metric_values)
+
+    if transactions:
+        db.execute(insert(models.Transaction), transactions)
+        # With an aggregator total_amount and the ledger are updated when it flushes
+        if stripes and aggregator is None:
+            add_routes_to_stripes(db, deltas.items(), stripe_slot(stripes))
+        elif aggregator is None:
+            db.execute(_update_deltas(deltas))
+        if aggregator is None:
+            add_to_statements(db, transactions, stripe_slot(stripes) if stripes else 0)
+
+    add_to_rollups(db, metric_values)
     db.commit()
+
+    if aggregator is not None:
+        aggregator.record((transaction['subscription_id'], transaction['amount']) for transaction in transactions)
+    return len(transactions)
+
+
+def _update_deltas(deltas: dict):
+    # One UPDATE ... FROM (VALUES ...) for all subscriptions, one row per subscription
+    subscription_deltas = values(
+        column('id', Integer),
+        column('delta', models.Subscription.total_amount.type),
+        name='subscription_deltas',
+    ).data(sorted(deltas.items()))
+
+    return (
+        update(models.Subscription)
+        .where(
+            models.Subscription.id == subscription_deltas.c.id,
+            models.Subscription.id.in_(locked_in_order(
+                select(models.Subscription.id).where(models.Subscription.id.in_(list(deltas)))
+            )),
+        )
+        .values(total_amount=models.Subscription.total_amount + subscription_deltas.c.delta)
+        .execution_options(synchronize_session=False)
+    )
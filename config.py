@@ -11,10 +11,46 @@ class Config:
 
     parsed = urlparse(DATABASE_URL)
     SQLALCHEMY_DATABASE_URI = urlunparse(parsed)
+    SQLALCHEMY_ASYNC_DATABASE_URI = urlunparse(parsed._replace(scheme='postgresql+asyncpg'))
+
+    ROUTING_CACHE_SIZE = int(os.getenv('ROUTING_CACHE_SIZE', 1024))
+    ROUTING_CACHE_TTL = float(os.getenv('ROUTING_CACHE_TTL', 30))
+
+    # Rows per metric and hour / day the rollups are spread over, 1 keeps a single row
+    ROLLUP_STRIPES = int(os.getenv('ROLLUP_STRIPES', 8))
+
+    DATALAKE_PATH = os.getenv('DATALAKE_PATH', 'datalake')
+    # What the lake's `date` partitions are truncated to, 'day' writes one small file per metric and day
+    DATALAKE_GRANULARITY = os.getenv('DATALAKE_GRANULARITY', 'month')
+    BENCHMARK_PATH = os.getenv('BENCHMARK_PATH', 'benchmarks')
+
+    # Monthly metricvalue / transaction partitions (partitions.py), retention 0 keeps every month
+    PARTITION_MONTHS_AHEAD = int(os.getenv('PARTITION_MONTHS_AHEAD', 3))
+    PARTITION_RETENTION_MONTHS = int(os.getenv('PARTITION_RETENTION_MONTHS', 0))
+    PARTITION_DROP_EXPIRED = os.getenv('PARTITION_DROP_EXPIRED', 'false').lower() == 'true'
+
+    # Billing path metrics (instrumentation.py), served on INSTRUMENTATION_PORT and / or printed every interval
+    INSTRUMENTATION = os.getenv('INSTRUMENTATION', 'false').lower() == 'true'
+    INSTRUMENTATION_PORT = int(os.getenv('INSTRUMENTATION_PORT', 0))
+    INSTRUMENTATION_LOG_INTERVAL = float(os.getenv('INSTRUMENTATION_LOG_INTERVAL', 0))
 
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': int(os.getenv('SQLALCHEMY_POOL_SIZE', 5)),
+        'max_overflow': int(os.getenv('SQLALCHEMY_MAX_OVERFLOW', 10)),
+        'pool_pre_ping': os.getenv('SQLALCHEMY_POOL_PRE_PING', 'false').lower() == 'true',
+        'pool_recycle': int(os.getenv('SQLALCHEMY_POOL_RECYCLE', -1)),
+        'connect_args': {
+            # Aware datetimes are stored in `timestamp` columns as UTC
+            'options': f'-csearch_path={DB_SCHEMA} -ctimezone=UTC'
+        }
+    }
+    SQLALCHEMY_ASYNC_ENGINE_OPTIONS = {
+        'pool_size': SQLALCHEMY_ENGINE_OPTIONS['pool_size'],
+        'max_overflow': SQLALCHEMY_ENGINE_OPTIONS['max_overflow'],
+        'pool_pre_ping': SQLALCHEMY_ENGINE_OPTIONS['pool_pre_ping'],
+        'pool_recycle': SQLALCHEMY_ENGINE_OPTIONS['pool_recycle'],
         'connect_args': {
-            'options': f'-csearch_path={DB_SCHEMA}'
+            'server_settings': {'search_path': DB_SCHEMA, 'timezone': 'UTC'}
         }
     }
@@ -0,0 +1,168 @@
+import datetime
+import random
+import time
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+
+from bson import ObjectId
+from pymongo import ASCENDING
+
+import models
+from nonrelational import bulk_insert_contents
+
+SEED = 42
+PAGE_SIZE = 100
+
+# Everything but the content body
+SUMMARY_FIELDS = ('created_at', 'updated_at', 'title', 'url', 'source_id')
+
+Key = Tuple[datetime.datetime, ObjectId]
+
+
+class Page(NamedTuple):
+    documents: List[dict]
+    # Pass as `after` to get the next page, None on the last page
+    next_key: Optional[Key]
+
+
+def find_contents(
+    source_id: int = None,
+    start: datetime.datetime = None,
+    end: datetime.datetime = None,
+    after: Key = None,
+    limit: int = PAGE_SIZE,
+    fields=SUMMARY_FIELDS,
+) -> Page:
+    """
+    One page of raw Content documents, optionally of one source and created in [start, end), ordered by
+    (created_at, _id). Pages are sought with `after`, the key of the last document of the previous page, so
+    every page costs the same whatever its depth. `fields=None` returns whole documents.
+    """
+    query = {}
+    if source_id is not None:
+        query['source_id'] = source_id
+
+    created_at = {}
+    if start is not None:
+        created_at['$gte'] = start
+    if end is not None:
+        created_at['$lt'] = end
+    if created_at:
+        query['created_at'] = created_at
+
+    if after is not None:
+        after_created_at, after_id = after
+        query['$or'] = [
+            {'created_at': {'$gt': after_created_at}},
+            {'created_at': after_created_at, '_id': {'$gt': after_id}},
+        ]
+
+    # The page key is read from the last document whatever `fields` asks for
+    projection = {field: 1 for field in ('created_at', '_id', *fields)} if fields is not None else None
+    documents = list(
+        models.Content._get_collection()
+        .find(query, projection)
+        .sort([('created_at', ASCENDING), ('_id', ASCENDING)])
+        .limit(limit)
+    )
+
+    next_key = None
+    if len(documents) == limit:
+        next_key = (documents[-1]['created_at'], documents[-1]['_id'])
+    return Page(documents, next_key)
+
+
+def iter_contents(
+    source_id: int = None,
+    start: datetime.datetime = None,
+    end: datetime.datetime = None,
+    page_size: int = PAGE_SIZE,
+    fields=SUMMARY_FIELDS,
+) -> Iterator[dict]:
+    after = None
+    while True:
+        page = find_contents(source_id, start, end, after, page_size, fields)
+        yield from page.documents
+        if page.next_key is None:
+            return
+        after = page.next_key
+
+
+def ensure_indexes():
+    models.Content.ensure_indexes()
+
+
+def test_query_latency(sizes=(10_000, 100_000, 1_000_000), source_count: int = 10, pages: int = 20):
+    rng = random.Random(SEED)
+    now = models.now()
+    body = 'x' * 2000
+
+    ensure_indexes()
+    collection = models.Content._get_collection()
+
+    print("Starting query latency test for MONGO content pages...")
+
+    for size in sizes:
+        # Grow the collection to `size` documents
+        missing = size - collection.estimated_document_count()
+        bulk_insert_contents(
+            {
+                'created_at': now - datetime.timedelta(seconds=rng.uniform(0, 365 * 24 * 3600)),
+                'updated_at': now,
+                'title': f'Title {i}',
+                'url': f'https://example.com/{i}',
+                'content': body,
+                'source_id': rng.randint(1, source_count),
+            }
+            for i in range(max(missing, 0))
+        )
+
+        # Walk `pages` pages of the last 30 days of one source, first page latency and deep page latency
+        source_id = rng.randint(1, source_count)
+        start = now - datetime.timedelta(days=30)
+
+        latencies = []
+        after = None
+        for _ in range(pages):
+            start_time = time.perf_counter()
+            page = find_contents(source_id, start, now, after)
+            latencies.append(time.perf_counter() - start_time)
+            if page.next_key is None:
+                break
+            after = page.next_key
+
+        print(f"find_contents(size={size}, pages={len(latencies)}) first page in {latencies[0] * 1000:.2f} ms, "
+              f"last page in {latencies[-1] * 1000:.2f} ms, average {sum(latencies) / len(latencies) * 1000:.2f} ms")
+
+
+def test_narrow_fields(count: int = 250, page_size: int = 40):
+    rng = random.Random(SEED)
+    now = models.now()
+    # A source no other test writes to
+    source_id = -rng.randint(1, 1_000_000)
+
+    collection = models.Content._get_collection()
+    bulk_insert_contents(
+        {
+            # Whole seconds, so pages have to break created_at ties on _id
+            'created_at': now - datetime.timedelta(seconds=rng.randint(0, count // 4)),
+            'updated_at': now,
+            'title': f'Title {i}',
+            'url': f'https://example.com/{i}',
+            'content': 'x',
+            'source_id': source_id,
+        }
+        for i in range(count)
+    )
+
+    try:
+        titles = [document['title'] for document in iter_contents(source_id, page_size=page_size, fields=('title',))]
+        assert len(titles) == count, f'{len(titles)} documents paged, expected {count}'
+        assert len(set(titles)) == count, 'Documents repeated across pages'
+    finally:
+        collection.delete_many({'source_id': source_id})
+    print(f"iter_contents(count={count}, page_size={page_size}, fields=('title',)) paged every document once")
+
+
+if __name__ == '__main__':
+    test_narrow_fields()
+    test_query_latency()
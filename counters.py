@@ -0,0 +1,103 @@
+import os
+import threading
+import zlib
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import Integer, delete, func, literal, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+import models
+from routing import Route, billed_subscriptions
+
+
+def stripe_slot(stripes: int) -> int:
+    # Same slot for the whole life of a worker thread, different workers spread over the stripes
+    return zlib.crc32(f'{os.getpid()}:{threading.get_ident()}'.encode()) % stripes
+
+
+def _add_on_conflict(statement):
+    return statement.on_conflict_do_update(
+        index_elements=[models.SubscriptionCounter.subscription_id, models.SubscriptionCounter.slot],
+        set_={'amount': models.SubscriptionCounter.amount + statement.excluded.amount},
+    )
+
+
+def stripes_upsert(topic_ids: List[int], slot: int):
+    billed = billed_subscriptions(topic_ids).subquery()
+    return _add_on_conflict(
+        insert(models.SubscriptionCounter).from_select(
+            ['subscription_id', 'slot', 'amount'],
+            select(
+                billed.c.id,
+                literal(slot, Integer),
+                billed.c.single_metric_pricing,
+            ).order_by(billed.c.id)
+        )
+    )
+
+
+def routes_stripes_upsert(routes: Iterable[Route], slot: int):
+    rows = [
+        {'subscription_id': subscription_id, 'slot': slot, 'amount': amount}
+        for subscription_id, amount in sorted(routes)
+    ]
+    return _add_on_conflict(insert(models.SubscriptionCounter).values(rows)) if rows else None
+
+
+def add_to_stripes(db: Session, topic_ids: List[int], slot: int) -> int:
+    return db.execute(stripes_upsert(topic_ids, slot)).rowcount
+
+
+def add_routes_to_stripes(db: Session, routes: Iterable[Route], slot: int) -> int:
+    statement = routes_stripes_upsert(routes, slot)
+    return db.execute(statement).rowcount if statement is not None else 0
+
+
+def striped_amounts():
+    return select(
+        models.SubscriptionCounter.subscription_id,
+        func.sum(models.SubscriptionCounter.amount).label('amount'),
+    ).group_by(models.SubscriptionCounter.subscription_id).subquery()
+
+
+def total_amounts(db: Session, subscription_ids: Optional[Iterable[int]] = None) -> Dict[int, Decimal]:
+    # Logical total_amount, the subscription row plus the sum of its stripes
+    striped = striped_amounts()
+    query = db.query(
+        models.Subscription.id,
+        models.Subscription.total_amount + func.coalesce(striped.c.amount, 0),
+    ).outerjoin(striped, striped.c.subscription_id == models.Subscription.id)
+
+    if subscription_ids is not None:
+        query = query.filter(models.Subscription.id.in_(list(subscription_ids)))
+    return dict(query.all())
+
+
+def get_total_amount(db: Session, subscription_id: int) -> Decimal:
+    amounts = total_amounts(db, [subscription_id])
+    if subscription_id not in amounts:
+        raise ValueError(f"Subscription with ID {subscription_id} not found")
+    return amounts[subscription_id]
+
+
+def compact_stripes(db: Session) -> int:
+    # Moves the stripes into subscription.total_amount in one statement, the logical total does not change
+    removed = delete(models.SubscriptionCounter).returning(
+        models.SubscriptionCounter.subscription_id,
+        models.SubscriptionCounter.amount,
+    ).cte('removed')
+
+    deltas = select(
+        removed.c.subscription_id,
+        func.sum(removed.c.amount).label('delta'),
+    ).group_by(removed.c.subscription_id).cte('deltas')
+
+    result = db.execute(
+        update(models.Subscription)
+        .where(models.Subscription.id == deltas.c.subscription_id)
+        .values(total_amount=models.Subscription.total_amount + deltas.c.delta)
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount
@@ -1,22 +1,139 @@
+import atexit
+import os
+import threading
 import mongoengine
 from mongoengine import ConnectionFailure
-from sqlalchemy import create_engine
+import datetime
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
-from contextlib import contextmanager
+from contextlib import asynccontextmanager, contextmanager
 from config import Config
 
 
-@contextmanager
-def with_database(**kwargs):
+# Engines (and their connection pools) are shared by the whole process, one per distinct set of options
+_engines = {}
+_async_engines = {}
+_engines_lock = threading.Lock()
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple, set)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def _engine_options(**kwargs) -> dict:
     config_kwargs = {
         **Config.SQLALCHEMY_ENGINE_OPTIONS
     }
     config_kwargs.update(kwargs)
+    return config_kwargs
+
+
+def _get_registered(**kwargs):
+    config_kwargs = _engine_options(**kwargs)
+    key = _freeze(config_kwargs)
+
+    registered = _engines.get(key)
+    if registered is None:
+        with _engines_lock:
+            registered = _engines.get(key)
+            if registered is None:
+                engine = create_engine(
+                    Config.SQLALCHEMY_DATABASE_URI,
+                    **config_kwargs,
+                )
+                SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+                registered = _engines[key] = (engine, SessionLocal)
+    return registered
+
+
+def get_engine(**kwargs) -> Engine:
+    engine, _ = _get_registered(**kwargs)
+    return engine
+
+
+def dispose_engines():
+    with _engines_lock:
+        registered = list(_engines.values())
+        _engines.clear()
+
+    for engine, _ in registered:
+        engine.dispose()
+
+
+def _get_async_registered(**kwargs):
+    config_kwargs = {
+        **Config.SQLALCHEMY_ASYNC_ENGINE_OPTIONS
+    }
+    config_kwargs.update(kwargs)
+    key = _freeze(config_kwargs)
+
+    registered = _async_engines.get(key)
+    if registered is None:
+        with _engines_lock:
+            registered = _async_engines.get(key)
+            if registered is None:
+                engine = create_async_engine(
+                    Config.SQLALCHEMY_ASYNC_DATABASE_URI,
+                    **config_kwargs,
+                )
+                event.listen(engine.sync_engine, 'before_cursor_execute', _drop_parameter_offsets, retval=True)
+                SessionLocal = async_sessionmaker(autocommit=False, autoflush=False, bind=engine)
+                registered = _async_engines[key] = (engine, SessionLocal)
+    return registered
+
+
+def _drop_offset(value):
+    if isinstance(value, datetime.datetime) and value.tzinfo is not None:
+        return value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value
+
 
-    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=create_engine(
-        Config.SQLALCHEMY_DATABASE_URI,
-        **config_kwargs,
-    ))
+def _drop_parameter_offsets(conn, cursor, statement, parameters, context, executemany):
+    # psycopg2 sends aware datetimes as timestamptz, postgres converts them to the session TimeZone (UTC, see
+    # Config) before storing them in `timestamp` columns. asyncpg refuses them, convert them to naive UTC too.
+    if executemany:
+        parameters = [tuple(_drop_offset(value) for value in row) for row in parameters]
+    else:
+        parameters = tuple(_drop_offset(value) for value in parameters)
+    return statement, parameters
+
+
+def get_async_engine(**kwargs) -> AsyncEngine:
+    engine, _ = _get_async_registered(**kwargs)
+    return engine
+
+
+async def dispose_async_engines():
+    # Async pools are bound to the event loop that created them, dispose them before that loop closes
+    with _engines_lock:
+        registered = list(_async_engines.values())
+        _async_engines.clear()
+
+    for engine, _ in registered:
+        await engine.dispose()
+
+
+def _dispose_engines_after_fork():
+    # Pooled connections must not be shared with a forked child, drop them without closing the parent's sockets
+    for engine, _ in list(_engines.values()):
+        engine.dispose(close=False)
+    for engine, _ in list(_async_engines.values()):
+        engine.sync_engine.dispose(close=False)
+
+
+atexit.register(dispose_engines)
+os.register_at_fork(after_in_child=_dispose_engines_after_fork)
+
+
+@contextmanager
+def with_database(**kwargs):
+    _, SessionLocal = _get_registered(**kwargs)
 
     db = SessionLocal()
 
@@ -30,6 +147,22 @@ def with_database(**kwargs):
         db.close()
 
 
+@asynccontextmanager
+async def with_async_database(**kwargs):
+    _, SessionLocal = _get_async_registered(**kwargs)
+
+    db = SessionLocal()
+
+    try:
+        yield db
+        await db.commit()
+    except Exception:
+        await db.rollback()
+        raise
+    finally:
+        await db.close()
+
+
 mongoengine.connect(
     alias='default',
     host=Config.MONGO_URI,
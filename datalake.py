@@ -0,0 +1,377 @@
+import datetime
+import json
+import os
+import shutil
+import time
+import uuid
+from decimal import Decimal
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from sqlalchemy import delete, func, select
+
+from config import Config
+from database import get_engine, with_database
+from export import Sink, arrow_schema, export_table, get_table, sync_table
+import models
+
+CHUNK_SIZE = 1_000_000
+ROW_GROUP_SIZE = 1 << 20
+COMPRESSION = 'zstd'
+# A chunk easily spans more days x metrics than pyarrow's default limit of 1024 partitions
+MAX_PARTITIONS = 1 << 16
+# Left behind in a partition while its small files are replaced by one, see compact_lake()
+COMPACTION_JOURNAL = '_compaction.json'
+
+# Table -> column its `date` partition comes from, partitioned by metric_id too when the table has one.
+# None is a snapshot, replaced on every export: subscription rows change (total_amount), they can't be appended.
+LAKE_TABLES = {
+    'metricvalue': 'calculated_on',
+    'transaction': 'created_at',
+    'subscription': None,
+}
+
+
+def _partition_fields(table_name: str):
+    table = get_table(table_name)
+    fields = []
+    if LAKE_TABLES[table_name] is not None:
+        fields.append(pa.field('date', pa.date32()))
+    if 'metric_id' in table.c:
+        fields.append(pa.field('metric_id', pa.int32()))
+    return fields
+
+
+def _partitioning(table_name: str):
+    fields = _partition_fields(table_name)
+    return ds.partitioning(pa.schema(fields), flavor='hive') if fields else None
+
+
+def lake_schema(table_name: str) -> pa.Schema:
+    schema = arrow_schema(get_table(table_name).columns)
+    if LAKE_TABLES[table_name] is not None:
+        schema = schema.append(pa.field('date', pa.date32()))
+    return schema
+
+
+class ParquetLakeSink(Sink):
+    """
+    Hive partitioned Parquet dataset per table under `path` (`transaction/date=2025-01-31/metric_id=3/...`),
+    zstd compressed with large row groups for scans. Every load appends new files, watermarks for
+    export.sync_table() are kept in `_state.json`.
+
+    `granularity` ('day', 'month', ...) is what the `date` partition is truncated to (default:
+    DATALAKE_GRANULARITY), coarser partitions mean fewer, larger files for small tables. Every load adds
+    files to the partitions it touches, compact_lake() merges them.
+    """
+
+    def __init__(self, path: str = None, granularity: str = None):
+        self.path = path or Config.DATALAKE_PATH
+        self.granularity = granularity or Config.DATALAKE_GRANULARITY
+        os.makedirs(self.path, exist_ok=True)
+
+    @property
+    def _state_path(self):
+        return os.path.join(self.path, '_state.json')
+
+    def _state(self) -> dict:
+        if not os.path.exists(self._state_path):
+            return {}
+        with open(self._state_path) as f:
+            return json.load(f)
+
+    def table_path(self, table_name: str) -> str:
+        return os.path.join(self.path, table_name)
+
+    def truncate(self, table_name: str):
+        shutil.rmtree(self.table_path(table_name), ignore_errors=True)
+        state = self._state()
+        if state.pop(table_name, None) is not None:
+            self._write_state(state)
+
+    def load(self, table_name: str, path: str):
+        staged = pq.read_table(path)
+        date_column = LAKE_TABLES[table_name]
+        if date_column is not None:
+            staged = staged.append_column('date', pc.cast(
+                pc.floor_temporal(staged[date_column], unit=self.granularity), pa.date32()
+            ))
+
+        ds.write_dataset(
+            staged,
+            self.table_path(table_name),
+            format='parquet',
+            partitioning=_partitioning(table_name),
+            basename_template=f'part-{uuid.uuid4().hex}-{{i}}.parquet',
+            existing_data_behavior='overwrite_or_ignore',
+            file_options=ds.ParquetFileFormat().make_write_options(compression=COMPRESSION),
+            min_rows_per_group=ROW_GROUP_SIZE,
+            max_rows_per_group=ROW_GROUP_SIZE,
+            max_partitions=MAX_PARTITIONS,
+        )
+
+    def merge(self, table_name: str, path: str, key: str):
+        # Lake tables are append-only, sync_table() only hands over rows above the watermark
+        self.load(table_name, path)
+
+    def get_watermark(self, table_name: str):
+        return self._state().get(table_name)
+
+    def set_watermark(self, table_name: str, watermark: str):
+        state = self._state()
+        state[table_name] = watermark
+        self._write_state(state)
+
+    def _write_state(self, state: dict):
+        # Replaced atomically, a crash leaves either the old or the new watermarks
+        tmp_path = f'{self._state_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self._state_path)
+
+
+def _finish_compaction(directory: str):
+    # Redo a replacement the journal describes, whatever step it was interrupted at
+    journal_path = os.path.join(directory, COMPACTION_JOURNAL)
+    with open(journal_path) as f:
+        journal = json.load(f)
+    staged = os.path.join(directory, journal['staged'])
+    if os.path.exists(staged):
+        os.replace(staged, os.path.join(directory, journal['file']))
+    for name in journal['replaced']:
+        if os.path.exists(os.path.join(directory, name)):
+            os.remove(os.path.join(directory, name))
+    os.remove(journal_path)
+
+
+def _compact_partition(directory: str, names) -> int:
+    # Files smaller than a row group are rewritten as one, larger ones are already as big as they get
+    small = sorted(
+        name for name in names
+        if name.endswith('.parquet') and pq.ParquetFile(os.path.join(directory, name)).metadata.num_rows < ROW_GROUP_SIZE
+    )
+    if len(small) < 2:
+        return 0
+
+    # Partition values live in the directory names, not in the files
+    merged = pq.read_table([os.path.join(directory, name) for name in small], partitioning=None)
+    name = f'part-{uuid.uuid4().hex}-0.parquet'
+    # Hidden from readers (pyarrow skips '.' and '_' prefixes) until the journal is written
+    staged = f'.{name}'
+    pq.write_table(merged, os.path.join(directory, staged), compression=COMPRESSION, row_group_size=ROW_GROUP_SIZE)
+
+    journal_path = os.path.join(directory, COMPACTION_JOURNAL)
+    with open(f'{journal_path}.tmp', 'w') as f:
+        json.dump({'file': name, 'staged': staged, 'replaced': small}, f)
+    os.replace(f'{journal_path}.tmp', journal_path)
+    _finish_compaction(directory)
+    return len(small)
+
+
+def compact_lake(path: str = None, table_names=None) -> dict:
+    """
+    Merges the small files every load leaves in each partition of `table_names` (default: every
+    partitioned lake table) into one file per partition. Returns the number of files replaced per table.
+    Run it while no export writes to the lake, an interrupted run is completed by the next one.
+    """
+    path = path or Config.DATALAKE_PATH
+    table_names = table_names or [table_name for table_name, date_column in LAKE_TABLES.items() if date_column]
+
+    replaced = {}
+    for table_name in table_names:
+        replaced[table_name] = 0
+        for directory, _, names in os.walk(os.path.join(path, table_name)):
+            if COMPACTION_JOURNAL in names:
+                _finish_compaction(directory)
+                names = os.listdir(directory)
+            for name in names:
+                # Staged by a run interrupted before its journal was written
+                if name.startswith('.part-'):
+                    os.remove(os.path.join(directory, name))
+            replaced[table_name] += _compact_partition(directory, [name for name in names if not name.startswith('.')])
+    return replaced
+
+
+def export_lake(
+    source_engine=None,
+    path: str = None,
+    granularity: str = None,
+    incremental: bool = True,
+    compact: bool = True,
+) -> dict:
+    """
+    Appends new metricvalue and transaction rows to the lake (or reloads them with `incremental=False`),
+    compacts the partitions they were added to and replaces the subscription snapshot. Returns the
+    number of rows written per table.
+    """
+    source_engine = source_engine or get_engine()
+    sink = ParquetLakeSink(path, granularity)
+
+    counts = {}
+    for table_name, date_column in LAKE_TABLES.items():
+        if date_column is not None and incremental:
+            counts[table_name] = sync_table(source_engine, sink, table_name, chunk_size=CHUNK_SIZE)
+        else:
+            counts[table_name] = export_table(source_engine, sink, table_name, CHUNK_SIZE)['rows']
+
+    if compact:
+        compact_lake(sink.path, [
+            table_name for table_name, date_column in LAKE_TABLES.items() if date_column and counts[table_name]
+        ])
+    return counts
+
+
+def _naive_utc(value: datetime.datetime) -> datetime.datetime:
+    # The lake stores timestamps as naive UTC, like the database
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def read_table(
+    table_name: str,
+    columns=None,
+    start: datetime.datetime = None,
+    end: datetime.datetime = None,
+    metric_ids=None,
+    filter=None,
+    path: str = None,
+    granularity: str = None,
+) -> pa.Table:
+    """
+    Reads a lake table, optionally only rows in [start, end) of its date column and of `metric_ids`.
+    Those conditions prune whole `date` / `metric_id` partitions before any file is opened, and are
+    pushed down with `filter` (a pyarrow.dataset expression) to skip row groups by their statistics.
+    `granularity` must match the one the lake was written with (default: DATALAKE_GRANULARITY).
+    """
+    granularity = granularity or Config.DATALAKE_GRANULARITY
+    table_path = os.path.join(path or Config.DATALAKE_PATH, table_name)
+    schema = lake_schema(table_name)
+    if not os.path.exists(table_path):
+        # Nothing exported yet
+        empty = schema.empty_table()
+        return empty.select(columns) if columns is not None else empty
+
+    dataset = ds.dataset(table_path, schema=schema, format='parquet', partitioning=_partitioning(table_name))
+
+    expression = filter
+    date_column = LAKE_TABLES[table_name]
+
+    def add(condition):
+        nonlocal expression
+        expression = condition if expression is None else expression & condition
+
+    if start is not None:
+        start = _naive_utc(start)
+        first_partition = pc.floor_temporal(pa.scalar(start, pa.timestamp('us')), unit=granularity)
+        add(ds.field('date') >= pc.cast(first_partition, pa.date32()))
+        add(ds.field(date_column) >= pa.scalar(start, pa.timestamp('us')))
+    if end is not None:
+        end = _naive_utc(end)
+        add(ds.field('date') <= pa.scalar(end.date(), pa.date32()))
+        add(ds.field(date_column) < pa.scalar(end, pa.timestamp('us')))
+    if metric_ids is not None:
+        add(ds.field('metric_id').isin(pa.array(list(metric_ids), pa.int32())))
+
+    return dataset.to_table(columns=columns, filter=expression)
+
+
+def _partition_files(table_path: str) -> dict:
+    # Visible Parquet files of every partition directory, with their row count
+    return {
+        directory: [
+            pq.ParquetFile(os.path.join(directory, name)).metadata.num_rows
+            for name in names if name.endswith('.parquet') and not name.startswith('.')
+        ]
+        for directory, _, names in os.walk(table_path)
+        if any(name.endswith('.parquet') for name in names)
+    }
+
+
+def _check_files(path: str, table_name: str, label: str):
+    table_path = os.path.join(path, table_name)
+    partitions = _partition_files(table_path)
+    files = sum(len(rows) for rows in partitions.values())
+    size = sum(os.path.getsize(os.path.join(directory, name)) for directory, _, names in os.walk(table_path) for name in names)
+    print(f"{label}: {table_name} in {files} files over {len(partitions)} partitions, "
+          f"{size / files / 1024:.1f} KB and {sum(map(sum, partitions.values())) / files:.0f} rows per file")
+
+    crowded = {directory: rows for directory, rows in partitions.items() if sum(count < ROW_GROUP_SIZE for count in rows) > 1}
+    assert not crowded, f'Partitions with more than one file smaller than a row group: {crowded}'
+    return files
+
+
+def test_lake(path: str = None, days: int = 30):
+    path = path or os.path.join(Config.DATALAKE_PATH, 'test')
+    shutil.rmtree(path, ignore_errors=True)
+
+    print("Starting data lake export test...")
+
+    start_time = time.perf_counter()
+    counts = export_lake(path=path)
+    elapsed = time.perf_counter() - start_time
+    print(f"export_lake({counts}) completed in {elapsed:.4f} seconds")
+
+    daily_path = os.path.join(path, 'daily')
+    try:
+        export_lake(path=daily_path, granularity='day', compact=False)
+        daily_files = sum(len(rows) for rows in _partition_files(os.path.join(daily_path, 'metricvalue')).values())
+    finally:
+        shutil.rmtree(daily_path, ignore_errors=True)
+    files = _check_files(path, 'metricvalue', f'{Config.DATALAKE_GRANULARITY} partitions')
+    print(f"day partitions: metricvalue in {daily_files} files")
+    assert Config.DATALAKE_GRANULARITY == 'day' or files < daily_files
+
+    with with_database() as db:
+        for table_name in LAKE_TABLES:
+            expected = db.execute(select(func.count()).select_from(get_table(table_name))).scalar()
+            assert read_table(table_name, columns=['id'], path=path).num_rows == expected, f'{table_name} mismatch'
+
+        metric_id, end = db.query(
+            models.MetricValue.metric_id, func.max(models.MetricValue.calculated_on)
+        ).group_by(models.MetricValue.metric_id).order_by(func.count().desc()).first()
+        start = end - datetime.timedelta(days=days)
+        expected = db.query(func.count(models.MetricValue.id)).filter(
+            models.MetricValue.metric_id == metric_id,
+            models.MetricValue.calculated_on >= start,
+            models.MetricValue.calculated_on < end,
+        ).scalar()
+
+    start_time = time.perf_counter()
+    full = read_table('metricvalue', columns=['calculated_on', 'metric_id', 'value'], path=path)
+    full_elapsed = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    pruned = read_table('metricvalue', ['calculated_on', 'value'], start, end, [metric_id], path=path)
+    pruned_elapsed = time.perf_counter() - start_time
+
+    assert pruned.num_rows == expected, f'Expected {expected} rows, read {pruned.num_rows}'
+    print(f"read_table(metricvalue) full scan of {full.num_rows} rows in {full_elapsed:.4f} seconds, "
+          f"{days} days of one metric ({pruned.num_rows} rows) in {pruned_elapsed:.4f} seconds")
+
+    # Incremental append
+    with with_database() as db:
+        db.add_all([
+            models.MetricValue(metric_id=metric_id, value=Decimal(i) / 100, calculated_on=models.now())
+            for i in range(100)
+        ])
+        db.commit()
+        added = db.query(func.max(models.MetricValue.id)).scalar()
+
+    try:
+        counts = export_lake(path=path)
+        assert counts['metricvalue'] == 100, f"Expected 100 appended rows, got {counts['metricvalue']}"
+        assert read_table('metricvalue', columns=['id'], path=path).num_rows == full.num_rows + 100
+        print(f"export_lake({counts}) appended incrementally")
+        _check_files(path, 'metricvalue', 'after append')
+    finally:
+        with with_database() as db:
+            db.execute(delete(models.MetricValue).where(models.MetricValue.id > added - 100))
+            db.commit()
+        shutil.rmtree(path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    export_lake()
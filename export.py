@@ -0,0 +1,570 @@
+import abc
+import bisect
+import datetime
+import json
+import os
+import resource
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from typing import Iterator, List, Tuple
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import BigInteger, Boolean, Date, DateTime, Float, Integer, Numeric, SmallInteger, String, delete, func, select
+from sqlalchemy.dialects.postgresql import ARRAY
+
+from database import get_engine, with_database
+import models
+
+CHUNK_SIZE = 50_000
+COMPRESSION = 'zstd'
+PARTITION_ROWS = 500_000
+# Default sync_table() overlap below the high-water mark, for integer and for date / timestamp watermarks
+ID_OVERLAP = 1000
+TIME_OVERLAP = datetime.timedelta(minutes=10)
+
+
+def get_table(table_name: str):
+    schema = models.Model.metadata.schema
+    return models.Model.metadata.tables[f'{schema}.{table_name}' if schema else table_name]
+
+
+def arrow_type(column_type) -> pa.DataType:
+    """
+    Arrow type of a SQLAlchemy column type, the single source of the exported types: record batches are
+    built with it and the Snowflake DDL is derived from it.
+    """
+    if isinstance(column_type, ARRAY):
+        return pa.list_(arrow_type(column_type.item_type))
+    if isinstance(column_type, Boolean):
+        return pa.bool_()
+    if isinstance(column_type, BigInteger):
+        return pa.int64()
+    if isinstance(column_type, SmallInteger):
+        return pa.int16()
+    if isinstance(column_type, Integer):
+        return pa.int32()
+    if isinstance(column_type, Float):
+        return pa.float64()
+    if isinstance(column_type, Numeric):
+        return pa.decimal128(column_type.precision or 38, column_type.scale or 0)
+    if isinstance(column_type, DateTime):
+        return pa.timestamp('us', tz='UTC' if column_type.timezone else None)
+    if isinstance(column_type, Date):
+        return pa.date32()
+    if isinstance(column_type, String):
+        return pa.string()
+    raise TypeError(f'No Arrow type for {column_type!r}')
+
+
+def arrow_schema(columns) -> pa.Schema:
+    return pa.schema([pa.field(column.name, arrow_type(column.type)) for column in columns])
+
+
+def peak_rss_mb() -> float:
+    # High-water mark of the whole process so far, it never goes down (ru_maxrss is in kilobytes on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def rss_mb() -> float:
+    # Current resident set size, it goes down when memory is returned to the OS (Linux /proc)
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize() / 1024 / 1024
+
+
+class RssSampler:
+    """
+    Samples rss_mb() every `interval` seconds in a background thread while in use. peak_mb(start, end) is
+    the highest sample between two time.perf_counter() values, the peak RSS of whatever ran in that window
+    rather than the high-water mark of the whole process.
+    """
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self._samples = []
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        self._samples.append((time.perf_counter(), rss_mb()))
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self._sample()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='rss-sampler', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stopped.set()
+        self._thread.join()
+        self._sample()
+
+    def peak_mb(self, start: float = None, end: float = None) -> float:
+        # The samples right before and after the window count too, a window shorter than `interval` has none
+        times = [sampled for sampled, _ in self._samples]
+        low = max(bisect.bisect_left(times, start) - 1, 0) if start is not None else 0
+        high = bisect.bisect_right(times, end) + 1 if end is not None else len(times)
+        return max(rss for _, rss in self._samples[low:high])
+
+
+def record_batches(source_engine, query, chunk_size: int = CHUNK_SIZE) -> Iterator[pa.RecordBatch]:
+    """
+    Runs query on a server-side cursor and yields its rows as Arrow record batches of `chunk_size` rows,
+    at most one chunk is held in memory whatever the size of the result. Columns are converted straight
+    to the Arrow type of their SQLAlchemy type, without inference.
+    """
+    schema = arrow_schema(query.selected_columns)
+    with source_engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, max_row_buffer=chunk_size).execute(query)
+        for rows in result.partitions(chunk_size):
+            yield pa.RecordBatch.from_arrays(
+                [pa.array(values, type=field.type) for values, field in zip(zip(*rows), schema)],
+                schema=schema,
+            )
+
+
+def staging_files(
+    batches,
+    directory: str,
+    prefix: str,
+    compression: str = COMPRESSION,
+) -> Iterator[Tuple[str, pa.RecordBatch]]:
+    # One compressed Parquet file per batch, removed once the consumer moves on to the next one
+    for i, batch in enumerate(batches):
+        path = os.path.join(directory, f'{prefix}_{i:06d}.parquet')
+        pq.write_table(pa.Table.from_batches([batch]), path, compression=compression)
+        try:
+            yield path, batch
+        finally:
+            os.remove(path)
+
+
+class Sink(abc.ABC):
+    """
+    Target of export_table() and sync_table(), loads staging Parquet files. Keeps one high-water mark per
+    table (as text) for sync_table(), which upserts rows on their key so loading a row twice is harmless.
+    """
+
+    @abc.abstractmethod
+    def truncate(self, table_name: str):
+        pass
+
+    @abc.abstractmethod
+    def load(self, table_name: str, path: str):
+        pass
+
+    @abc.abstractmethod
+    def merge(self, table_name: str, path: str, key: str):
+        pass
+
+    @abc.abstractmethod
+    def get_watermark(self, table_name: str):
+        pass
+
+    @abc.abstractmethod
+    def set_watermark(self, table_name: str, watermark: str):
+        pass
+
+    def close(self):
+        pass
+
+
+def _sqlite_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, list):
+        return json.dumps(value)
+    return value
+
+
+def _quote(name: str) -> str:
+    return f'"{name}"'
+
+
+class SQLiteSink(Sink):
+    """
+    Local stand-in for snowflake.SnowflakeSink, to run the export logic without a Snowflake account. Tables
+    are created on first load, MERGE is an INSERT ... ON CONFLICT DO UPDATE.
+    """
+
+    STATE_TABLE = 'export_state'
+
+    def __init__(self, path: str = ':memory:'):
+        # Parallel exports open one sink per worker on the same file, writers wait for each other
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=300)
+        self.conn.execute(
+            f'CREATE TABLE IF NOT EXISTS {self.STATE_TABLE} (table_name TEXT PRIMARY KEY, watermark TEXT)'
+        )
+        self.conn.commit()
+
+    def _insert(self, table_name: str, path: str, key: str = None):
+        staged = pq.read_table(path)
+        columns = ', '.join(_quote(column) for column in staged.column_names)
+        self.conn.execute(
+            f'CREATE TABLE IF NOT EXISTS {_quote(table_name)} ({columns}, PRIMARY KEY ({_quote(key or "id")}))'
+        )
+
+        placeholders = ', '.join('?' for _ in staged.column_names)
+        statement = f'INSERT INTO {_quote(table_name)} ({columns}) VALUES ({placeholders})'
+        if key is not None:
+            updates = ', '.join(
+                f'{_quote(column)} = excluded.{_quote(column)}' for column in staged.column_names if column != key
+            )
+            statement += f' ON CONFLICT ({_quote(key)}) DO UPDATE SET {updates}'
+
+        self.conn.executemany(statement, (
+            [_sqlite_value(value) for value in row.values()] for row in staged.to_pylist()
+        ))
+        self.conn.commit()
+
+    def truncate(self, table_name: str):
+        self.conn.execute(f'DROP TABLE IF EXISTS {_quote(table_name)}')
+        self.conn.commit()
+
+    def load(self, table_name: str, path: str):
+        self._insert(table_name, path)
+
+    def merge(self, table_name: str, path: str, key: str):
+        self._insert(table_name, path, key)
+
+    def get_watermark(self, table_name: str):
+        row = self.conn.execute(
+            f'SELECT watermark FROM {self.STATE_TABLE} WHERE table_name = ?', (table_name,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def set_watermark(self, table_name: str, watermark: str):
+        self.conn.execute(
+            f'INSERT INTO {self.STATE_TABLE} (table_name, watermark) VALUES (?, ?) '
+            f'ON CONFLICT (table_name) DO UPDATE SET watermark = excluded.watermark',
+            (table_name, watermark),
+        )
+        self.conn.commit()
+
+    def count(self, table_name: str) -> int:
+        return self.conn.execute(f'SELECT count(*) FROM {_quote(table_name)}').fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+
+def _export_query(source_engine, sink: Sink, table_name: str, query, prefix: str, chunk_size: int, staging_dir: str):
+    stats = {'rows': 0, 'files': 0, 'bytes': 0}
+    with tempfile.TemporaryDirectory(dir=staging_dir) as directory:
+        batches = record_batches(source_engine, query, chunk_size)
+        for path, batch in staging_files(batches, directory, prefix):
+            stats['bytes'] += os.path.getsize(path)
+            sink.load(table_name, path)
+            stats['rows'] += batch.num_rows
+            stats['files'] += 1
+    return stats
+
+
+def export_table(
+    source_engine,
+    sink: Sink,
+    table_name: str,
+    chunk_size: int = CHUNK_SIZE,
+    staging_dir: str = None,
+) -> dict:
+    """
+    Replaces the sink's copy of `table_name`, streaming it through one staging file at a time. Returns
+    rows, files, bytes, seconds and the peak RSS sampled during the export.
+    """
+    started = time.perf_counter()
+    with RssSampler() as sampler:
+        sink.truncate(table_name)
+        stats = _export_query(
+            source_engine, sink, table_name, select(get_table(table_name)), table_name, chunk_size, staging_dir
+        )
+    stats['seconds'] = time.perf_counter() - started
+    stats['peak_rss_mb'] = sampler.peak_mb()
+    return stats
+
+
+def load_order(table_names) -> List[List[str]]:
+    # Groups the tables in levels, each table only references tables of earlier levels
+    remaining = list(table_names)
+    levels = []
+    while remaining:
+        level = [
+            table_name for table_name in remaining
+            if not any(
+                foreign_key.column.table.name in remaining and foreign_key.column.table.name != table_name
+                for foreign_key in get_table(table_name).foreign_keys
+            )
+        ]
+        if not level:
+            raise ValueError(f'Foreign key cycle between {remaining}')
+        levels.append(level)
+        remaining = [table_name for table_name in remaining if table_name not in level]
+    return levels
+
+
+def pk_ranges(source_engine, table_name: str, partition_rows: int = PARTITION_ROWS):
+    """
+    Splits the table in [low, high) ranges of the leading integer column of its primary key (the id, also
+    for the (id, partition key) keys of partitioned tables) holding about `partition_rows` rows each,
+    assuming ids are dense. Tables without an integer key are one (None, None) range.
+    """
+    table = get_table(table_name)
+    keys = list(table.primary_key)
+    if not isinstance(keys[0].type, Integer):
+        return [(None, None)]
+
+    with source_engine.connect() as conn:
+        low, high = conn.execute(select(func.min(keys[0]), func.max(keys[0]))).one()
+    if low is None:
+        return [(None, None)]
+
+    bounds = list(range(low, high + 1, partition_rows)) + [high + 1]
+    return list(zip(bounds, bounds[1:]))
+
+
+def _export_range(source_engine, sink_factory, table_name: str, low, high, chunk_size: int, staging_dir: str):
+    table = get_table(table_name)
+    query = select(table)
+    if low is not None:
+        key = list(table.primary_key)[0]
+        query = query.where(key >= low, key < high)
+
+    started = time.perf_counter()
+    sink = sink_factory()
+    try:
+        stats = _export_query(
+            source_engine, sink, table_name, query, f'{table_name}_{low or 0}', chunk_size, staging_dir
+        )
+    finally:
+        sink.close()
+    return stats, started, time.perf_counter()
+
+
+def export_tables(
+    source_engine,
+    sink_factory,
+    table_names,
+    workers: int = 4,
+    partition_rows: int = PARTITION_ROWS,
+    respect_foreign_keys: bool = True,
+    chunk_size: int = CHUNK_SIZE,
+    staging_dir: str = None,
+) -> dict:
+    """
+    Replaces the sink's copy of every table with `workers` parallel exports. Large tables are split in
+    primary key ranges of `partition_rows`, every range is read on its own source connection and loaded
+    through its own sink from sink_factory(). With `respect_foreign_keys` a table starts loading only once
+    the tables it references are loaded. Returns export_table() stats per table, seconds and peak RSS from
+    the start of its first range to the end of its last one (tables loaded alongside share that memory).
+    """
+    stats = {
+        table_name: {'rows': 0, 'files': 0, 'bytes': 0, 'partitions': 0}
+        for table_name in table_names
+    }
+    levels = load_order(table_names) if respect_foreign_keys else [list(table_names)]
+    started = time.perf_counter()
+
+    sink = sink_factory()
+    try:
+        for table_name in table_names:
+            sink.truncate(table_name)
+    finally:
+        sink.close()
+
+    windows = {}
+    with RssSampler() as sampler, ThreadPoolExecutor(max_workers=workers) as pool:
+        for level in levels:
+            futures = [
+                (table_name, pool.submit(
+                    _export_range, source_engine, sink_factory, table_name, low, high, chunk_size, staging_dir
+                ))
+                for table_name in level
+                for low, high in pk_ranges(source_engine, table_name, partition_rows)
+            ]
+            for table_name, future in futures:
+                range_stats, range_started, range_finished = future.result()
+                for name, value in range_stats.items():
+                    stats[table_name][name] += value
+                stats[table_name]['partitions'] += 1
+                first, last = windows.get(table_name, (range_started, range_finished))
+                windows[table_name] = (min(first, range_started), max(last, range_finished))
+
+    for table_name, table_stats in stats.items():
+        first, last = windows.get(table_name, (started, started))
+        table_stats['seconds'] = last - first
+        table_stats['peak_rss_mb'] = sampler.peak_mb(first, last) if table_name in windows else sampler.peak_mb()
+    return stats
+
+
+def _format_watermark(watermark) -> str:
+    return watermark.isoformat() if isinstance(watermark, datetime.datetime) else str(watermark)
+
+
+def _default_overlap(column):
+    if isinstance(column.type, Integer):
+        return ID_OVERLAP
+    if isinstance(column.type, (DateTime, Date)):
+        return TIME_OVERLAP
+    return None
+
+
+def _parse_watermark(column, watermark: str):
+    if column.type.python_type is datetime.datetime:
+        return datetime.datetime.fromisoformat(watermark)
+    return column.type.python_type(watermark)
+
+
+def sync_table(
+    source_engine,
+    sink: Sink,
+    table_name: str,
+    watermark_column: str = 'id',
+    key: str = 'id',
+    overlap=None,
+    chunk_size: int = CHUNK_SIZE,
+    staging_dir: str = None,
+) -> int:
+    """
+    Upserts the rows of `table_name` newer than the sink's high-water mark on `watermark_column` and moves
+    the mark forward after every chunk, an interrupted run resumes where it stopped.
+
+    Ids and timestamps are assigned before commit, so a row can show up behind the mark. `overlap` (an int
+    for ids, a timedelta for timestamps) re-reads that much below the mark, MERGE makes the re-read rows
+    no-ops. It defaults to ID_OVERLAP / TIME_OVERLAP, 0 reads strictly past the mark. Returns the rows
+    merged, re-read ones included.
+    """
+    table = get_table(table_name)
+    column = table.c[watermark_column]
+    if overlap is None:
+        overlap = _default_overlap(column)
+
+    query = select(table).order_by(column)
+    watermark = sink.get_watermark(table_name)
+    if watermark is not None:
+        watermark = _parse_watermark(column, watermark)
+        query = query.where(column > (watermark - overlap if overlap else watermark))
+
+    count = 0
+    with tempfile.TemporaryDirectory(dir=staging_dir) as directory:
+        batches = record_batches(source_engine, query, chunk_size)
+        for path, batch in staging_files(batches, directory, table_name):
+            sink.merge(table_name, path, key)
+            count += batch.num_rows
+
+            last = batch.column(watermark_column)[-1].as_py()
+            if watermark is None or last > watermark:
+                watermark = last
+                sink.set_watermark(table_name, _format_watermark(watermark))
+    return count
+
+
+def test_incremental_sync(table_names=('topic', 'metric', 'metricvalue'), new_rows: int = 1000):
+    sink = SQLiteSink()
+    engine = get_engine()
+
+    print(f"Starting incremental sync test for tables: {table_names}...")
+
+    for table_name in table_names:
+        start_time = time.perf_counter()
+        count = sync_table(engine, sink, table_name)
+        elapsed = time.perf_counter() - start_time
+        print(f"sync_table({table_name}, initial) synced {count} rows in {elapsed:.4f} seconds")
+
+    with with_database() as db:
+        metric_id = db.query(func.min(models.Metric.id)).scalar()
+        db.add_all([
+            models.MetricValue(metric_id=metric_id, value=Decimal(i) / 100, calculated_on=models.now())
+            for i in range(new_rows)
+        ])
+        db.commit()
+        added = db.query(func.max(models.MetricValue.id)).scalar()
+
+    try:
+        start_time = time.perf_counter()
+        count = sync_table(engine, sink, 'metricvalue', overlap=0)
+        elapsed = time.perf_counter() - start_time
+        print(f"sync_table(metricvalue, incremental) synced {count} rows in {elapsed:.4f} seconds")
+        assert count == new_rows, f'Expected {new_rows} new rows, synced {count}'
+
+        with with_database() as db:
+            expected = db.query(models.MetricValue).count()
+            overlapping = db.query(models.MetricValue).filter(models.MetricValue.id > added - ID_OVERLAP).count()
+        assert sink.count('metricvalue') == expected
+
+        assert sync_table(engine, sink, 'metricvalue', overlap=0) == 0, 'Rows synced twice'
+        # The default overlap re-reads the last ID_OVERLAP ids, merged in place
+        assert sync_table(engine, sink, 'metricvalue') == overlapping
+        assert sink.count('metricvalue') == expected, 'Overlapping rows duplicated'
+    finally:
+        with with_database() as db:
+            db.execute(delete(models.MetricValue).where(models.MetricValue.id > added - new_rows))
+            db.commit()
+        sink.close()
+
+
+def test_streaming_export(table_names=('metricvalue', 'transaction'), chunk_size: int = CHUNK_SIZE):
+    engine = get_engine()
+
+    print(f"Starting streaming export test for tables: {table_names}, peak RSS {peak_rss_mb():.1f} MB...")
+
+    with tempfile.TemporaryDirectory() as directory:
+        sink = SQLiteSink(os.path.join(directory, 'export.sqlite'))
+        try:
+            for table_name in table_names:
+                stats = export_table(engine, sink, table_name, chunk_size)
+                assert sink.count(table_name) == stats['rows']
+                print(f"export_table({table_name}) exported {stats['rows']} rows in {stats['files']} files "
+                      f"({stats['bytes'] / 1024 / 1024:.1f} MB) in {stats['seconds']:.4f} seconds")
+                print(f"with ({(stats['rows'] / stats['seconds']):.4f}) per seconds, peak RSS {stats['peak_rss_mb']:.1f} MB")
+        finally:
+            sink.close()
+
+
+def test_parallel_export(
+    table_names=('topic', 'metric', 'metricvalue', 'client', 'subscription', 'transaction'),
+    worker_counts=(1, 2, 4, 8),
+    partition_rows: int = 200_000,
+):
+    print(f"Starting parallel export test for tables: {table_names}...")
+
+    with with_database() as db:
+        expected = {
+            table_name: db.execute(select(func.count()).select_from(get_table(table_name))).scalar()
+            for table_name in table_names
+        }
+
+    for workers in worker_counts:
+        engine = get_engine(pool_size=workers, max_overflow=0)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'export.sqlite')
+            start_time = time.perf_counter()
+            stats = export_tables(engine, lambda: SQLiteSink(path), table_names, workers, partition_rows)
+            elapsed = time.perf_counter() - start_time
+
+            sink = SQLiteSink(path)
+            try:
+                for table_name in table_names:
+                    assert sink.count(table_name) == expected[table_name], f'{table_name} row count mismatch'
+            finally:
+                sink.close()
+
+        rows = sum(table_stats['rows'] for table_stats in stats.values())
+        partitions = sum(table_stats['partitions'] for table_stats in stats.values())
+        print(f"export_tables(rows={rows}, partitions={partitions}, workers={workers}) completed in {elapsed:.4f} seconds")
+        print(f'with ({(rows / elapsed):.4f}) per seconds')
+
+
+if __name__ == '__main__':
+    test_incremental_sync()
+    test_streaming_export()
+    test_parallel_export()
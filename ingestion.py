@@ -0,0 +1,115 @@
+import asyncio
+import datetime
+import random
+import time
+from decimal import Decimal
+
+from business import process_metric_value_async
+from database import dispose_async_engines, with_async_database, with_database
+import models
+
+SEED = 42
+
+
+class AsyncIngestionEngine:
+    """
+    Processes metric values with `concurrency` workers, each holding its own pooled connection.
+
+    `submit()` waits while the queue holds `queue_size` pending events, producers are slowed down to the
+    rate the database can absorb instead of buffering without bound.
+    """
+
+    def __init__(self, concurrency: int = 8, queue_size: int = 1000, **process_kwargs):
+        self.concurrency = concurrency
+        self.process_kwargs = process_kwargs
+        self.engine_options = {'pool_size': concurrency, 'max_overflow': 0}
+
+        self.processed = 0
+        self.failed = 0
+        self.errors = []
+
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._workers = []
+
+    async def start(self):
+        self._workers = [
+            asyncio.create_task(self._worker(), name=f'ingestion-worker-{i}')
+            for i in range(self.concurrency)
+        ]
+
+    async def submit(self, metric_id: int, value: Decimal, calculated_on: datetime.datetime = None):
+        await self._queue.put((metric_id, value, calculated_on))
+
+    async def stop(self):
+        # Drain what is already queued, then shut the workers down
+        await self._queue.join()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
+
+    async def _worker(self):
+        while True:
+            metric_id, value, calculated_on = await self._queue.get()
+            try:
+                async with with_async_database(**self.engine_options) as db:
+                    await process_metric_value_async(
+                        db,
+                        metric_id,
+                        value,
+                        calculated_on,
+                        **self.process_kwargs,
+                    )
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                self.errors.append(e)
+            finally:
+                self._queue.task_done()
+
+
+async def ingest(events, concurrency: int = 8, queue_size: int = 1000, **process_kwargs) -> AsyncIngestionEngine:
+    async with AsyncIngestionEngine(concurrency, queue_size, **process_kwargs) as engine:
+        for event in events:
+            await engine.submit(*event)
+    return engine
+
+
+def test_async_performance(count: int, concurrencies=(1, 2, 4, 8, 16, 32, 64)):
+    random.seed(SEED)
+
+    with with_database() as db:
+        metric_ids = [
+            m.id for m in db.query(models.Metric).all()
+        ]
+
+    events = [
+        (random.choice(metric_ids), Decimal(random.randint(1, 10000) / 100))
+        for _ in range(count)
+    ]
+
+    print(f"Starting async performance test for metrics: {metric_ids}...")
+
+    async def run(concurrency):
+        try:
+            start_time = time.perf_counter()
+            engine = await ingest(events, concurrency=concurrency, queue_size=concurrency * 4)
+            return engine, time.perf_counter() - start_time
+        finally:
+            await dispose_async_engines()
+
+    for concurrency in concurrencies:
+        engine, elapsed = asyncio.run(run(concurrency))
+        print(f"ingest(count={count}, concurrency={concurrency}) completed in {elapsed:.4f} seconds, {engine.failed} failed")
+        print(f'with ({(count / elapsed):.4f}) per seconds')
+
+
+if __name__ == '__main__':
+    test_async_performance(2000)
@@ -0,0 +1,442 @@
+import bisect
+import contextvars
+import functools
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from config import Config
+
+PREFIX = 'eventhorizon'
+# Seconds, and statements / rows per call
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000, 10000)
+
+_enabled = False
+_NOOP = nullcontext()
+# Call being measured in this thread / task, None outside of one
+_current = contextvars.ContextVar('instrumented_call', default=None)
+_CHECKOUT_STARTED = 'instrumentation_checkout_started'
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        # One more for +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def copy(self) -> 'Histogram':
+        histogram = Histogram(self.buckets)
+        histogram.counts = list(self.counts)
+        histogram.count = self.count
+        histogram.sum = self.sum
+        return histogram
+
+    def since(self, previous: 'Histogram') -> 'Histogram':
+        histogram = self.copy()
+        if previous is not None:
+            histogram.counts = [count - before for count, before in zip(self.counts, previous.counts)]
+            histogram.count -= previous.count
+            histogram.sum -= previous.sum
+        return histogram
+
+    def quantile(self, q: float) -> float:
+        # Upper bound of the bucket holding the q-th observation
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return float('nan')
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else float('nan')
+
+
+def _labels(labels: tuple, **extra) -> str:
+    pairs = [*labels, *extra.items()]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}' if pairs else ''
+
+
+def _bound(value: float) -> str:
+    return '+Inf' if value == float('inf') else repr(float(value))
+
+
+class Metrics:
+    """
+    Histograms and counters by name and labels, rendered in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self._histograms: Dict[tuple, Histogram] = {}
+        self._counters: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, value: float, buckets: Tuple[float, ...] = LATENCY_BUCKETS, **labels):
+        key = (name, tuple(labels.items()))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def increment(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(labels.items()))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def snapshot(self) -> Tuple[dict, dict]:
+        with self._lock:
+            return (
+                {key: histogram.copy() for key, histogram in self._histograms.items()},
+                dict(self._counters),
+            )
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def render(self) -> str:
+        histograms, counters = self.snapshot()
+        lines = []
+        typed = set()
+
+        for (name, labels), histogram in sorted(histograms.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {PREFIX}_{name} histogram')
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                cumulative += count
+                lines.append(f'{PREFIX}_{name}_bucket{_labels(labels, le=_bound(bound))} {cumulative}')
+            lines.append(f'{PREFIX}_{name}_sum{_labels(labels)} {histogram.sum!r}')
+            lines.append(f'{PREFIX}_{name}_count{_labels(labels)} {histogram.count}')
+
+        for (name, labels), value in sorted(counters.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {PREFIX}_{name} counter')
+            lines.append(f'{PREFIX}_{name}{_labels(labels)} {value!r}')
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+class _Call:
+    __slots__ = ('name', 'stage', 'statements', 'rows')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.stage = None
+        self.statements = 0
+        self.rows = 0
+
+
+@contextmanager
+def _measure_call(name: str):
+    call = _Call(name)
+    token = _current.set(call)
+    started = time.perf_counter()
+    try:
+        yield call
+    except Exception:
+        metrics.increment('call_errors_total', call=name)
+        raise
+    finally:
+        metrics.observe('call_seconds', time.perf_counter() - started, call=name)
+        metrics.observe('call_statements', call.statements, COUNT_BUCKETS, call=name)
+        metrics.observe('call_rows', call.rows, COUNT_BUCKETS, call=name)
+        _current.reset(token)
+
+
+@contextmanager
+def _measure_stage(call: _Call, name: str):
+    outer, call.stage = call.stage, name
+    statements, rows = call.statements, call.rows
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe('stage_seconds', time.perf_counter() - started, call=call.name, stage=name)
+        metrics.increment('stage_statements_total', call.statements - statements, call=call.name, stage=name)
+        metrics.increment('stage_rows_total', call.rows - rows, call=call.name, stage=name)
+        call.stage = outer
+
+
+def instrumented(name: str = None):
+    # Records latency, statements and rows of every call of the decorated function, when enabled
+    def decorator(fn):
+        call_name = name or fn.__qualname__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with _measure_call(call_name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def stage(name: str):
+    """
+    with stage('commit'): ... times a stage of the instrumented call running in this thread. Costs a global
+    lookup when instrumentation is disabled, nothing is recorded outside of an instrumented call.
+    """
+    if not _enabled:
+        return _NOOP
+    call = _current.get()
+    if call is None:
+        return _NOOP
+    return _measure_stage(call, name)
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    call = _current.get()
+    if call is not None:
+        call.statements += 1
+        # Affected rows of writes, fetched rows of selects, -1 when the driver can't tell
+        call.rows += max(cursor.rowcount, 0)
+
+
+def _after_transaction_create(session, transaction):
+    if transaction.parent is None:
+        session.info[_CHECKOUT_STARTED] = time.perf_counter()
+
+
+def _do_orm_execute(orm_execute_state):
+    # Autobegin can happen long before the first statement (session.add()), start from the statement
+    info = orm_execute_state.session.info
+    if _CHECKOUT_STARTED in info:
+        info[_CHECKOUT_STARTED] = time.perf_counter()
+
+
+def _after_begin(session, transaction, connection):
+    # The session's connection was just checked out of the pool (or opened)
+    started = session.info.pop(_CHECKOUT_STARTED, None)
+    if started is not None:
+        metrics.observe('pool_checkout_seconds', time.perf_counter() - started)
+
+
+_LISTENERS = (
+    (Engine, 'after_cursor_execute', _after_cursor_execute),
+    (Session, 'after_transaction_create', _after_transaction_create),
+    (Session, 'do_orm_execute', _do_orm_execute),
+    (Session, 'after_begin', _after_begin),
+)
+
+_server = None
+_reporter = None
+
+
+def enable(port: int = None, log_interval: float = None):
+    """
+    Starts recording, and serves the metrics on http://0.0.0.0:`port`/metrics and / or prints a summary every
+    `log_interval` seconds when they are set (default: INSTRUMENTATION_PORT, INSTRUMENTATION_LOG_INTERVAL).
+    """
+    global _enabled, _server, _reporter
+
+    port = Config.INSTRUMENTATION_PORT if port is None else port
+    log_interval = Config.INSTRUMENTATION_LOG_INTERVAL if log_interval is None else log_interval
+
+    if not _enabled:
+        for target, identifier, fn in _LISTENERS:
+            event.listen(target, identifier, fn)
+        _enabled = True
+
+    if port and _server is None:
+        _server = serve(port)
+    if log_interval and _reporter is None:
+        _reporter = Reporter(log_interval)
+        _reporter.start()
+
+
+def disable():
+    global _enabled, _server, _reporter
+
+    if _enabled:
+        for target, identifier, fn in _LISTENERS:
+            event.remove(target, identifier, fn)
+        _enabled = False
+
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
+    if _reporter is not None:
+        _reporter.stop()
+        _reporter = None
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port: int, host: str = '0.0.0.0') -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
+
+
+def _ms(seconds: float) -> str:
+    return f'{seconds * 1000:.2f} ms'
+
+
+def summary(histograms: dict) -> str:
+    # One line: calls, latency, statements and rows per call, stage latencies and the pool checkout wait
+    parts = []
+    for (name, labels), histogram in sorted(histograms.items()):
+        labels = dict(labels)
+        if not histogram.count:
+            continue
+        if name == 'call_seconds':
+            statements = histograms.get(('call_statements', tuple(labels.items())))
+            rows = histograms.get(('call_rows', tuple(labels.items())))
+            parts.append(
+                f"{labels['call']}: {histogram.count} calls, p50 {_ms(histogram.quantile(0.5))}, "
+                f"p99 {_ms(histogram.quantile(0.99))}, {statements.mean:.1f} statements and {rows.mean:.1f} rows per call"
+            )
+        elif name == 'stage_seconds':
+            parts.append(f"{labels['stage']} p50 {_ms(histogram.quantile(0.5))} p99 {_ms(histogram.quantile(0.99))}")
+        elif name == 'pool_checkout_seconds':
+            parts.append(f"checkout {histogram.count}, p99 {_ms(histogram.quantile(0.99))}")
+    return ' | '.join(parts)
+
+
+class Reporter:
+    """
+    Prints a summary of the calls made since the previous line every `interval` seconds, nothing when idle.
+    """
+
+    def __init__(self, interval: float = 60.0):
+        self.interval = interval
+        self._previous = {}
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def report(self):
+        histograms, _ = metrics.snapshot()
+        line = summary({key: histogram.since(self._previous.get(key)) for key, histogram in histograms.items()})
+        self._previous = histograms
+        if line:
+            print(f'Instrumentation: {line}')
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='instrumentation-reporter', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.report()
+
+
+def _rearm_after_fork():
+    # A forked child (loadgen, benchmark.run_isolated) inherits the state but none of the threads: record its own
+    # calls from scratch, leave the port to the parent and restart the reporter in the child
+    global _server, _reporter
+
+    metrics._lock = threading.Lock()
+    metrics.reset()
+    if _server is not None:
+        _server.server_close()
+        _server = None
+    if _reporter is not None:
+        _reporter = Reporter(_reporter.interval)
+        _reporter.start()
+
+
+os.register_at_fork(after_in_child=_rearm_after_fork)
+
+if Config.INSTRUMENTATION:
+    enable()
+
+
+def test_instrumentation(count: int = 500):
+    import random
+
+    from business import process_metric_value
+    from database import with_database
+    import models
+
+    random.seed(42)
+    with with_database() as db:
+        metric_ids = [metric_id for metric_id, in db.query(models.Metric.id).order_by(models.Metric.id)]
+    events = [(random.choice(metric_ids), Decimal(random.randint(1, 10000)) / 100) for _ in range(count)]
+
+    def run():
+        start_time = time.perf_counter()
+        for metric_id, value in events:
+            with with_database() as _db:
+                process_metric_value(_db, metric_id=metric_id, value=value)
+        return time.perf_counter() - start_time
+
+    was_enabled = _enabled
+    disable()
+    start_time = time.perf_counter()
+    for _ in range(100000):
+        with stage('commit'):
+            pass
+    print(f"Disabled stage(): {(time.perf_counter() - start_time) / 100000 * 1e9:.0f} ns")
+
+    print(f"Starting instrumentation test with {count} events...")
+    disabled = run()
+    metrics.reset()
+    enable(port=0, log_interval=0)
+    enabled = run()
+    print(f"process_metric_value x {count}: {disabled:.4f} seconds disabled, {enabled:.4f} seconds enabled "
+          f"({enabled / disabled - 1:+.1%})")
+
+    histograms, _ = metrics.snapshot()
+    print(summary(histograms))
+    print(metrics.render())
+
+    assert histograms[('call_seconds', (('call', 'process_metric_value'),))].count == count
+    if not was_enabled:
+        disable()
+
+
+if __name__ == '__main__':
+    test_instrumentation()
@@ -0,0 +1,248 @@
+import argparse
+import functools
+import itertools
+import multiprocessing
+import random
+import sys
+import threading
+import time
+from decimal import Decimal
+from queue import Empty
+from typing import List
+
+from benchmark import summarize
+from database import with_database
+from retry import DEADLOCK_DETECTED, SERIALIZATION_FAILURE, error_code, retry_stats, run_in_transaction
+from writebehind import ledger_offsets
+import models
+
+SEED = 42
+# How often run_load checks for dead workers while waiting for results
+POLL_INTERVAL = 1.0
+# How long a worker waits at the start barrier for the others
+BARRIER_TIMEOUT = 60.0
+SKEWS = ('uniform', 'zipf')
+ISOLATION_LEVELS = ('READ COMMITTED', 'REPEATABLE READ', 'SERIALIZABLE')
+
+
+def metric_weights(count: int, skew: str = 'uniform', exponent: float = 1.1) -> List[float]:
+    # Zipf: the metric of rank k gets 1 / k^exponent of the events, ranks follow metric ids
+    if skew == 'zipf':
+        return [1 / rank ** exponent for rank in range(1, count + 1)]
+    return [1.0] * count
+
+
+def _run_thread(metric_ids, cum_weights, events, seed, barrier, options, results):
+    try:
+        from business import process_metric_value
+
+        rng = random.Random(seed)
+        db_kwargs = {'isolation_level': options['isolation_level'], 'pool_size': options['threads'], 'max_overflow': 0}
+        billing_kwargs = {'set_based': options['set_based'], 'stripes': options['stripes']}
+
+        latencies = []
+        errors = {'serialization_failures': 0, 'deadlocks': 0, 'other_errors': 0}
+    except BaseException:
+        # Break the barrier so the other workers fail instead of waiting for this one forever
+        barrier.abort()
+        raise
+
+    barrier.wait(BARRIER_TIMEOUT)
+    started = time.time()
+    for _ in range(events):
+        metric_id, = rng.choices(metric_ids, cum_weights=cum_weights)
+        value = Decimal(rng.randint(1, 10000)) / 100
+
+        start_time = time.perf_counter()
+        try:
+            if options['retry']:
+                run_in_transaction(
+                    functools.partial(process_metric_value, metric_id=metric_id, value=value, **billing_kwargs),
+                    call_site='process_metric_value',
+                    **db_kwargs,
+                )
+            else:
+                with with_database(**db_kwargs) as db:
+                    process_metric_value(db, metric_id=metric_id, value=value, **billing_kwargs)
+        except Exception as e:
+            code = error_code(e)
+            if code == SERIALIZATION_FAILURE:
+                errors['serialization_failures'] += 1
+            elif code == DEADLOCK_DETECTED:
+                errors['deadlocks'] += 1
+            else:
+                errors['other_errors'] += 1
+            continue
+        latencies.append(time.perf_counter() - start_time)
+
+    results.append((latencies, errors, started, time.time()))
+
+
+def _run_process(index, metric_ids, cum_weights, barrier, queue, options):
+    retry_stats.reset()
+    results = []
+    threads = [
+        threading.Thread(
+            target=_run_thread,
+            args=(metric_ids, cum_weights, options['events'], options['seed'] + index * 1000 + i, barrier, options, results),
+            name=f'Worker-{index}-{i}',
+        )
+        for i in range(options['threads'])
+    ]
+
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if len(results) < len(threads):
+        # Exits non-zero, run_load stops every worker
+        raise RuntimeError(f'{len(threads) - len(results)} of {len(threads)} load threads failed')
+
+    latencies = [latency for thread_latencies, _, _, _ in results for latency in thread_latencies]
+    errors = {name: sum(thread_errors[name] for _, thread_errors, _, _ in results) for name in results[0][1]}
+    site = retry_stats.snapshot().get('process_metric_value', {})
+    errors['retried_serialization_failures'] = site.get('serialization_failures', 0)
+    errors['retried_deadlocks'] = site.get('deadlocks', 0)
+    queue.put((
+        latencies,
+        errors,
+        min(started for _, _, started, _ in results),
+        max(finished for _, _, _, finished in results),
+    ))
+
+
+def run_load(
+    processes: int,
+    threads: int,
+    events: int = 100,
+    skew: str = 'uniform',
+    exponent: float = 1.1,
+    isolation_level: str = 'READ COMMITTED',
+    retry: bool = False,
+    set_based: bool = True,
+    stripes: int = 0,
+    seed: int = SEED,
+) -> dict:
+    """
+    Runs `events` process_metric_value calls on each of `processes` x `threads` workers started together, the
+    metrics drawn with `skew`. Returns the latency summary, error counts and whether every subscription's
+    total_amount moved by exactly the amount of its new transactions.
+    """
+    with with_database() as db:
+        metric_ids = [metric_id for metric_id, in db.query(models.Metric.id).order_by(models.Metric.id)]
+        offsets_before = ledger_offsets(db)
+
+    cum_weights = list(itertools.accumulate(metric_weights(len(metric_ids), skew, exponent)))
+    options = {
+        'threads': threads,
+        'events': events,
+        'isolation_level': isolation_level,
+        'retry': retry,
+        'set_based': set_based,
+        'stripes': stripes,
+        'seed': seed,
+    }
+
+    # Forked so the workers need no pickling, database.py drops inherited pool connections in the child
+    context = multiprocessing.get_context('fork')
+    barrier = context.Barrier(processes * threads)
+    queue = context.Queue()
+    workers = [
+        context.Process(target=_run_process, args=(i, metric_ids, cum_weights, barrier, queue, options), name=f'loadgen-{i}')
+        for i in range(processes)
+    ]
+    for p in workers:
+        p.start()
+
+    results = []
+    while len(results) < len(workers):
+        try:
+            results.append(queue.get(timeout=POLL_INTERVAL))
+        except Empty:
+            # A worker that died never puts its result, and the others may wait for it at the barrier
+            failed = [p for p in workers if p.exitcode not in (None, 0)]
+            if failed:
+                for p in workers:
+                    p.terminate()
+                    p.join()
+                raise RuntimeError(f"Load worker {failed[0].name} exited with code {failed[0].exitcode}")
+    for p in workers:
+        p.join()
+
+    latencies = [latency for process_latencies, _, _, _ in results for latency in process_latencies]
+    errors = {name: sum(process_errors[name] for _, process_errors, _, _ in results) for name in results[0][1]}
+    elapsed = max(finished for _, _, _, finished in results) - min(started for _, _, started, _ in results)
+
+    with with_database() as db:
+        offsets_after = ledger_offsets(db)
+    drifted = {
+        subscription_id: offsets_after.get(subscription_id, Decimal(0)) - offset
+        for subscription_id, offset in offsets_before.items()
+        if offsets_after.get(subscription_id) != offset
+    }
+
+    return {
+        'processes': processes,
+        'threads': threads,
+        **summarize(latencies, len(latencies), elapsed),
+        **errors,
+        'consistent': not drifted,
+        'drifted_subscriptions': len(drifted),
+        'drift': sum(drifted.values(), Decimal(0)),
+    }
+
+
+def _report(result: dict) -> str:
+    line = f"processes={result['processes']}, threads={result['threads']}: {result['operations']} events"
+    if result['operations']:
+        line += (f" in {result['seconds']:.4f} seconds, {result['throughput']:.1f} per second, "
+                 f"p50 {result['p50_ms']:.3f} ms, p95 {result['p95_ms']:.3f} ms, p99 {result['p99_ms']:.3f} ms")
+    line += (f", {result['serialization_failures']} serialization failures and {result['deadlocks']} deadlocks failed, "
+             f"{result['retried_serialization_failures']} and {result['retried_deadlocks']} retried, "
+             f"{result['other_errors']} other errors")
+    if result['consistent']:
+        return line + ', total_amount matches the transactions'
+    return line + f", total_amount off by {result['drift']} in {result['drifted_subscriptions']} subscriptions"
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Runs process_metric_value concurrently against the configured database, one run per '
+                    'combination of --processes and --threads.'
+    )
+    parser.add_argument('--processes', type=int, nargs='+', default=[1])
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--events', type=int, default=100, help='events per worker thread')
+    parser.add_argument('--skew', choices=SKEWS, default='uniform', help='distribution of events over metrics')
+    parser.add_argument('--exponent', type=float, default=1.1, help='Zipf exponent')
+    parser.add_argument('--isolation-level', choices=ISOLATION_LEVELS, default='READ COMMITTED')
+    parser.add_argument('--retry', action='store_true', help='retry serialization failures and deadlocks')
+    parser.add_argument('--per-subscription', action='store_true', help='one statement per subscription')
+    parser.add_argument('--stripes', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=SEED)
+    args = parser.parse_args(argv)
+
+    print(f"Starting load test: {args.events} events per worker, {args.skew} metrics, {args.isolation_level}"
+          f"{', with retries' if args.retry else ''}...")
+
+    consistent = True
+    for processes, threads in itertools.product(args.processes, args.threads):
+        result = run_load(
+            processes,
+            threads,
+            events=args.events,
+            skew=args.skew,
+            exponent=args.exponent,
+            isolation_level=args.isolation_level,
+            retry=args.retry,
+            set_based=not args.per_subscription,
+            stripes=args.stripes,
+            seed=args.seed,
+        )
+        print(_report(result))
+        consistent = consistent and result['consistent']
+    return 0 if consistent else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
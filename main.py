@@ -169,7 +169,13 @@ def _populate(db):
     print(f"- {len(metric_values)} metric values")
 
 
-def populate():
+def populate(bulk: bool = False, **scale):
+    if bulk:
+        # COPY based loader, see seed.bulk_populate for the scale parameters
+        from seed import bulk_populate
+        bulk_populate(**scale)
+        return
+
     with with_database() as _db:
         _populate(_db)
 
@@ -210,6 +216,41 @@ def test_performance(count: int):
     print(f'with ({(count / elapsed):.4f}) per seconds')
 
 
+def test_batch_performance(count: int, batch_sizes=(1, 10, 100, 1000)):
+    random.seed(SEED)
+
+    from business import process_metric_value, process_metric_values
+
+    with with_database() as db:
+        metric_ids = [
+            m.id for m in db.query(models.Metric).all()
+        ]
+
+    events = [
+        (random.choice(metric_ids), Decimal(random.randint(1, 10000) / 100))
+        for _ in range(count)
+    ]
+
+    print(f"Starting batch performance test for metrics: {metric_ids}...")
+
+    start_time = time.perf_counter()
+    with with_database() as db:
+        for metric_id, value in events:
+            process_metric_value(db, metric_id=metric_id, value=value)
+    elapsed = time.perf_counter() - start_time
+    print(f"process_metric_value(count={count}) completed in {elapsed:.4f} seconds")
+    print(f'with ({(count / elapsed):.4f}) per seconds')
+
+    for batch_size in batch_sizes:
+        start_time = time.perf_counter()
+        with with_database() as db:
+            for i in range(0, count, batch_size):
+                process_metric_values(db, events[i:i + batch_size])
+        elapsed = time.perf_counter() - start_time
+        print(f"process_metric_values(count={count}, batch_size={batch_size}) completed in {elapsed:.4f} seconds")
+        print(f'with ({(count / elapsed):.4f}) per seconds')
+
+
 def test_concurrent_subscription_updates(solved: bool = False):
     from business import process_metric_value
 
@@ -233,6 +274,10 @@ def test_concurrent_subscription_updates(solved: bool = False):
 
     with with_database() as db:
         # Setup test data - ensure clean state
+        db.query(models.SubscriptionCounter).delete()
+        db.query(models.MetricValueHourly).delete()
+        db.query(models.MetricValueDaily).delete()
+        db.query(models.TransactionDaily).delete()
         db.query(models.Transaction).delete()
         db.query(models.MetricValue).delete()
         db.query(models.Subscription).delete()
@@ -287,6 +332,130 @@ def test_concurrent_subscription_updates(solved: bool = False):
         )
 
 
+def _setup_contended_subscription(metric_name: str):
+    with with_database() as db:
+        # Setup test data - ensure clean state
+        db.query(models.SubscriptionCounter).delete()
+        db.query(models.MetricValueHourly).delete()
+        db.query(models.MetricValueDaily).delete()
+        db.query(models.TransactionDaily).delete()
+        db.query(models.Transaction).delete()
+        db.query(models.MetricValue).delete()
+        db.query(models.Subscription).delete()
+        db.query(models.Metric).delete()
+        db.commit()
+
+        client = db.query(models.Client).first()
+        topic = db.query(models.Topic).first()
+
+        subscription = models.Subscription(
+            topic_id=topic.id,
+            client_id=client.id,
+            total_amount=Decimal("0.00"),
+            single_metric_pricing=Decimal("1.00"),
+        )
+
+        metric = models.Metric(
+            name=metric_name,
+            topic_ids=[topic.id],
+        )
+
+        db.add_all([subscription, metric])
+        db.commit()
+        return subscription.id, metric.id
+
+
+def test_striped_contention(thread_counts=(1, 2, 4, 8, 16), stripes: int = 8, events_per_thread: int = 50):
+    from business import process_metric_value
+    from counters import get_total_amount
+
+    subscription_id, metric_id = _setup_contended_subscription('Striped Counter Contention Test')
+
+    def process_metric_thread(_stripes):
+        for _ in range(events_per_thread):
+            with with_database() as _db:
+                process_metric_value(
+                    db=_db,
+                    metric_id=metric_id,
+                    value=Decimal("1.00"),
+                    stripes=_stripes,
+                )
+
+    expected = Decimal("0.00")
+    for thread_count in thread_counts:
+        for _stripes in (1, stripes):
+            threads = [
+                threading.Thread(target=process_metric_thread, args=(_stripes,), name=f'Worker-{i}')
+                for i in range(thread_count)
+            ]
+
+            start_time = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.perf_counter() - start_time
+
+            count = thread_count * events_per_thread
+            expected += count
+            print(f"stripes={_stripes}, threads={thread_count}: {count} events in {elapsed:.4f} seconds "
+                  f"with ({(count / elapsed):.4f}) per seconds")
+
+    with with_database() as db:
+        total_amount = get_total_amount(db, subscription_id)
+
+    assert total_amount == expected, f"total_amount is {total_amount} when it should be {expected}"
+
+
+def test_retry_throughput(thread_count: int = 8, events_per_thread: int = 25):
+    from counters import get_total_amount
+    from retry import process_metric_value_with_retries, retry_stats
+
+    random.seed(SEED)
+    subscription_id, metric_id = _setup_contended_subscription('Serialization Retry Test')
+
+    def process_metric_thread(_isolation_level):
+        for _ in range(events_per_thread):
+            try:
+                process_metric_value_with_retries(
+                    metric_id=metric_id,
+                    value=Decimal("1.00"),
+                    isolation_level=_isolation_level,
+                    calculated_on=datetime.datetime.now(),
+                    _artificial_delay=random.random() * 0.01,
+                )
+                processed.append(1)
+            except sqlalchemy.exc.OperationalError as e:
+                # Out of attempts or retry budget
+                errors.append(e)
+
+    expected = Decimal("0.00")
+    for isolation_level in ('AUTOCOMMIT', 'SERIALIZABLE'):
+        retry_stats.reset()
+        processed, errors = [], []
+        threads = [
+            threading.Thread(target=process_metric_thread, args=(isolation_level,), name=f'Worker-{i}')
+            for i in range(thread_count)
+        ]
+
+        start_time = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start_time
+
+        count = len(processed)
+        expected += count
+        print(f"isolation_level={isolation_level}, threads={thread_count}: {count} events in {elapsed:.4f} seconds "
+              f"with ({(count / elapsed):.4f}) per seconds, {len(errors)} gave up")
+        retry_stats.report()
+
+        with with_database() as db:
+            total_amount = get_total_amount(db, subscription_id)
+        assert total_amount == expected, f"total_amount is {total_amount} when it should be {expected}"
+
+
 if __name__ == '__main__':
     populate()
     # test_performance(100)
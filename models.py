@@ -1,6 +1,6 @@
 import datetime
 import mongoengine
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Numeric
+from sqlalchemy import Boolean, Column, Date, Index, Integer, String, DateTime, ForeignKey, Numeric, text, true
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
 from sqlalchemy.dialects.postgresql import ARRAY
@@ -42,6 +42,12 @@ class Subscription(ModelMixin, Model):
     single_metric_pricing = Column(Numeric(precision=10, scale=4), nullable=False, default=1.0)
     transactions = relationship("Transaction", back_populates="subscription")
 
+    __table_args__ = (
+        # Topic -> subscriptions join of every fan-out
+        Index('ix_subscription_topic_id', 'topic_id'),
+        Index('ix_subscription_client_id', 'client_id'),
+    )
+
 
 class Transaction(ModelMixin, Model):
     subscription_id = Column(Integer, ForeignKey('subscription.id'))
@@ -53,6 +59,71 @@ class Transaction(ModelMixin, Model):
     # Increase by single_metric_pricing of related subscription
     amount = Column(Numeric(precision=10, scale=4))
 
+    # False while the amount is not yet added to subscription.total_amount (write-behind mode)
+    settled = Column(Boolean, nullable=False, default=True, server_default=true())
+
+    # Partitioned by month of created_at (partitions.py), the partition key is part of the primary key
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    created_at = Column(DateTime, default=now, nullable=False, primary_key=True)
+
+    __table_args__ = (
+        Index('ix_transaction_unsettled', 'subscription_id', postgresql_where=text('NOT settled')),
+        Index('ix_transaction_subscription_id_created_at', 'subscription_id', 'created_at'),
+        Index('ix_transaction_metric_id_created_at', 'metric_id', 'created_at'),
+        {'postgresql_partition_by': 'RANGE (created_at)'},
+    )
+
+
+class SubscriptionCounter(Model):
+    __tablename__ = 'subscriptioncounter'
+
+    # Part of the subscription's total_amount spread over a few slots so concurrent writers don't queue on one row
+    subscription_id = Column(Integer, ForeignKey('subscription.id'), primary_key=True)
+    slot = Column(Integer, primary_key=True)
+    amount = Column(Numeric(precision=10, scale=4), nullable=False, default=0.0)
+
+
+class TransactionDaily(Model):
+    __tablename__ = 'transactiondaily'
+
+    # Settled transactions of a subscription for one metric on one day, the ledger behind statements.py.
+    # Striped writers use their own slot, like SubscriptionCounter
+    subscription_id = Column(Integer, ForeignKey('subscription.id'), primary_key=True)
+    day = Column(Date, primary_key=True)
+    metric_id = Column(Integer, ForeignKey('metric.id'), primary_key=True)
+    slot = Column(Integer, primary_key=True, default=0, server_default='0')
+
+    count = Column(Integer, nullable=False)
+    amount = Column(Numeric(precision=20, scale=4), nullable=False)
+
+    __table_args__ = (
+        Index('ix_transactiondaily_day', 'day'),
+    )
+
+
+class MetricValueRollupMixin:
+    # count / sum / min / max of the non-null values of a metric calculated in [bucket, bucket + resolution),
+    # spread over a few slots so concurrent writers of the same metric don't queue on one row
+    @declared_attr
+    def metric_id(self):
+        return Column(Integer, ForeignKey('metric.id'), primary_key=True)
+
+    bucket = Column(DateTime, primary_key=True)
+    slot = Column(Integer, primary_key=True, default=0, server_default='0')
+
+    count = Column(Integer, nullable=False)
+    sum = Column(Numeric(precision=20, scale=4), nullable=False)
+    min = Column(Numeric(precision=10, scale=4), nullable=False)
+    max = Column(Numeric(precision=10, scale=4), nullable=False)
+
+
+class MetricValueHourly(MetricValueRollupMixin, Model):
+    __tablename__ = 'metricvaluehourly'
+
+
+class MetricValueDaily(MetricValueRollupMixin, Model):
+    __tablename__ = 'metricvaluedaily'
+
 
 class ScheduleFrequency(Enum):
     HOURLY = 'hourly'
@@ -82,6 +153,13 @@ class Content(mongoengine.Document):
     meta = {
         'db_alias': 'default',
         'collection': 'content',
+        # [source_id,] created_at, _id is the keyset pagination order of contents.find_contents(),
+        # the compound indexes also serve plain source_id / created_at lookups
+        'indexes': [
+            ('source_id', 'created_at', 'id'),
+            ('created_at', 'id'),
+            'updated_at',
+        ],
     }
 
 
@@ -97,10 +175,23 @@ class Metric(ModelMixin, Model):
     metric_values = relationship("MetricValue", back_populates="metric")
     transactions = relationship("Transaction", back_populates="metric")
 
+    __table_args__ = (
+        # Containment lookups, metrics routed to a topic (topic_ids @> ARRAY[...])
+        Index('ix_metric_topic_ids', 'topic_ids', postgresql_using='gin'),
+    )
+
 
 class MetricValue(ModelMixin, Model):
     value = Column(Numeric(precision=10, scale=4))
-    calculated_on = Column(DateTime)
+
+    # Partitioned by month of calculated_on (partitions.py), the partition key is part of the primary key
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    calculated_on = Column(DateTime, primary_key=True)
 
     metric_id = Column(Integer, ForeignKey('metric.id'))
     metric = relationship('Metric', back_populates='metric_values')
+
+    __table_args__ = (
+        Index('ix_metricvalue_metric_id_calculated_on', 'metric_id', 'calculated_on'),
+        {'postgresql_partition_by': 'RANGE (calculated_on)'},
+    )
@@ -1,13 +1,140 @@
 import datetime
 import random
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from faker import Faker
+from pymongo import ASCENDING, UpdateOne, WriteConcern
 from database import with_database
 import models
 
 
 SEED = 42
 PROGRESS_STEP = 4
+BATCH_SIZE = 1000
+
+
+class ContentBulkWriter:
+    """
+    Buffers raw Content documents and writes every `batch_size` of them with one insert_many, instead of a
+    round trip and a mongoengine object per document. Unordered batches carry on past a failed document.
+
+    Writes are acknowledged (w=1) by default, batching is what makes that affordable.
+    """
+
+    def __init__(self, batch_size: int = BATCH_SIZE, ordered: bool = False, w=1):
+        self.batch_size = batch_size
+        self.ordered = ordered
+        self.collection = models.Content._get_collection().with_options(write_concern=WriteConcern(w=w))
+
+        self.inserted = 0
+        self.batches = 0
+        self._buffer = []
+
+    def add(self, document):
+        if isinstance(document, models.Content):
+            document = document.to_mongo().to_dict()
+        self._buffer.append(document)
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+
+    def extend(self, documents):
+        for document in documents:
+            self.add(document)
+
+    def flush(self) -> int:
+        if not self._buffer:
+            return 0
+
+        batch, self._buffer = self._buffer, []
+        self.collection.insert_many(batch, ordered=self.ordered)
+        self.batches += 1
+        self.inserted += len(batch)
+        return len(batch)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+
+
+def bulk_insert_contents(documents, batch_size: int = BATCH_SIZE, ordered: bool = False, w=1) -> int:
+    with ContentBulkWriter(batch_size, ordered, w) as writer:
+        writer.extend(documents)
+    return writer.inserted
+
+
+def _id_ranges(collection, query: dict, workers: int):
+    # Splits the matching _id space in `workers` contiguous ranges of about the same size
+    count = collection.count_documents(query)
+    boundaries = [None]
+    for i in range(1, workers):
+        skip = count * i // workers
+        boundary = next(collection.find(query, {'_id': 1}).sort('_id', ASCENDING).skip(skip).limit(1), None)
+        if boundary is not None and boundary['_id'] != boundaries[-1]:
+            boundaries.append(boundary['_id'])
+    boundaries.append(None)
+
+    for low, high in zip(boundaries, boundaries[1:]):
+        id_range = {}
+        if low is not None:
+            id_range['$gte'] = low
+        if high is not None:
+            id_range['$lt'] = high
+        yield {**query, '_id': id_range} if id_range else query
+
+
+def _bulk_write(collection, operations, ordered: bool) -> int:
+    result = collection.bulk_write(operations, ordered=ordered)
+    # Unacknowledged writes (w=0) report no counts, only what was sent
+    return result.matched_count if result.acknowledged else len(operations)
+
+
+def _bulk_update_range(collection, query: dict, update_fn, projection: dict, batch_size: int, ordered: bool) -> int:
+    updated = 0
+    operations = []
+    for document in collection.find(query, projection, batch_size=batch_size):
+        changes = update_fn(document)
+        if changes:
+            operations.append(UpdateOne({'_id': document['_id']}, {'$set': changes}))
+        if len(operations) >= batch_size:
+            updated += _bulk_write(collection, operations, ordered)
+            operations = []
+    if operations:
+        updated += _bulk_write(collection, operations, ordered)
+    return updated
+
+
+def bulk_update_contents(
+    update_fn,
+    fields=(),
+    query: dict = None,
+    batch_size: int = BATCH_SIZE,
+    ordered: bool = False,
+    w=1,
+    workers: int = 1,
+) -> int:
+    """
+    Calls update_fn(document) for every Content matching `query` and $sets the fields it returns, `batch_size`
+    updates per bulk_write. Only `_id` and `fields` are read, the content body is never loaded unless asked for.
+    With `workers` > 1 the _id space is split in ranges updated by parallel threads. Returns the matched
+    documents, or with w=0 the updates sent.
+    """
+    query = query or {}
+    projection = {field: 1 for field in ('_id', *fields)}
+    collection = models.Content._get_collection().with_options(write_concern=WriteConcern(w=w))
+
+    ranges = list(_id_ranges(collection, query, workers)) if workers > 1 else [query]
+    if len(ranges) == 1:
+        return _bulk_update_range(collection, query, update_fn, projection, batch_size, ordered)
+
+    with ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+        return sum(pool.map(
+            lambda id_range: _bulk_update_range(collection, id_range, update_fn, projection, batch_size, ordered),
+            ranges,
+        ))
 
 
 def test_create_performance(count: int):
@@ -76,6 +203,61 @@ def test_update_performance():
     print(f'with ({(count / elapsed):.4f}) per seconds')
 
 
+def test_bulk_create_performance(count: int, batch_sizes=(1, 10, 100, 1000, 10000), ordered: bool = False, w=1):
+    from seed import generate_contents
+
+    with with_database() as db:
+        source_ids = [
+            m.id for m in db.query(models.Source).all()
+        ]
+
+    # Generated up front so only the writes are timed
+    documents = [document for batch in generate_contents(count, source_ids) for document in batch]
+    collection = models.Content._get_collection()
+
+    print(f"Starting performance test for MONGO BULK INSERT (ordered={ordered}, w={w})")
+
+    for batch_size in batch_sizes:
+        batch = [dict(document) for document in documents]
+
+        start_time = time.perf_counter()
+        inserted = bulk_insert_contents(batch, batch_size=batch_size, ordered=ordered, w=w)
+        elapsed = time.perf_counter() - start_time
+
+        assert inserted == count
+        print(f"bulk_insert_contents(count={count}, batch_size={batch_size}) completed in {elapsed:.4f} seconds")
+        print(f'with ({(count / elapsed):.4f}) per seconds')
+
+        collection.delete_many({'_id': {'$in': [document['_id'] for document in batch]}})
+
+
+def test_bulk_update_performance(batch_size: int = BATCH_SIZE, workers=(1, 2, 4)):
+    Faker.seed(SEED)
+    local = threading.local()
+
+    def update(document):
+        # Faker instances are not shared between threads
+        if not hasattr(local, 'fake'):
+            local.fake = Faker()
+        return {
+            'title': 'UPDATED ' + local.fake.sentence(),
+            'content': local.fake.text(max_nb_chars=2000),
+            'updated_at': models.now(),
+        }
+
+    print("Starting performance test for MONGO BULK UPDATE...")
+
+    for worker_count in workers:
+        start_time = time.perf_counter()
+        count = bulk_update_contents(update, batch_size=batch_size, workers=worker_count)
+        elapsed = time.perf_counter() - start_time
+
+        print(f"bulk_update_contents(count={count}, batch_size={batch_size}, workers={worker_count}) completed in {elapsed:.4f} seconds")
+        print(f'with ({(count / elapsed):.4f}) per seconds')
+
+
 if __name__ == '__main__':
     test_create_performance(10000)
+    test_bulk_create_performance(10000)
     test_update_performance()
+    test_bulk_update_performance()
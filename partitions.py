@@ -0,0 +1,238 @@
+import datetime
+import re
+import time
+from decimal import Decimal
+from typing import List, NamedTuple
+
+from sqlalchemy import delete, func, text
+from sqlalchemy.orm import Session
+
+from config import Config
+from database import with_database
+from writebehind import settle_transactions
+import models
+
+# Table -> partition key, one range partition per month plus a default partition for rows outside all of them
+PARTITIONED_TABLES = {
+    'metricvalue': models.MetricValue.__table__.c.calculated_on,
+    'transaction': models.Transaction.__table__.c.created_at,
+}
+
+_BOUNDS = re.compile(r"FROM \('([^']+)'\) TO \('([^']+)'\)")
+
+
+class Partition(NamedTuple):
+    name: str
+    start: datetime.datetime
+    end: datetime.datetime
+
+
+def _qualified(table_name: str) -> str:
+    return f'{Config.DB_SCHEMA}."{table_name}"'
+
+
+def month_start(value: datetime.datetime) -> datetime.datetime:
+    # Partition bounds are naive UTC, like the keys
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(month: datetime.datetime, months: int) -> datetime.datetime:
+    years, month_index = divmod(month.month - 1 + months, 12)
+    return month.replace(year=month.year + years, month=month_index + 1)
+
+
+def partition_name(table_name: str, month: datetime.datetime) -> str:
+    return f'{table_name}_p{month:%Y_%m}'
+
+
+def list_partitions(db: Session, table_name: str) -> List[Partition]:
+    """
+    Monthly partitions attached to the table, oldest first.
+    """
+    rows = db.execute(text(
+        'SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i '
+        'JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = CAST(:table AS regclass)'
+    ), {'table': _qualified(table_name)}).all()
+
+    partitions = []
+    for name, bound in rows:
+        match = _BOUNDS.search(bound)
+        # The default partition has no bounds
+        if match:
+            start, end = (datetime.datetime.fromisoformat(value) for value in match.groups())
+            partitions.append(Partition(name, start, end))
+    return sorted(partitions, key=lambda partition: partition.start)
+
+
+def create_partition(db: Session, table_name: str, month: datetime.datetime) -> int:
+    """
+    Creates the table's partition for `month`, moving the rows of that month out of the default partition.
+    Returns the number of rows moved.
+    """
+    key = PARTITIONED_TABLES[table_name]
+    name = _qualified(partition_name(table_name, month))
+    parent = _qualified(table_name)
+    default = _qualified(f'{table_name}_default')
+    bounds = f"FOR VALUES FROM ('{month.isoformat(' ')}') TO ('{add_months(month, 1).isoformat(' ')}')"
+    in_month = f'{key.name} >= :start AND {key.name} < :end'
+    params = {'start': month, 'end': add_months(month, 1)}
+
+    if not db.execute(text(f'SELECT EXISTS (SELECT 1 FROM {default} WHERE {in_month})'), params).scalar():
+        db.execute(text(f'CREATE TABLE {name} PARTITION OF {parent} {bounds}'))
+        return 0
+
+    # A partition can't be created over rows of the default partition, fill it as a plain table and attach it
+    columns = ', '.join(column.name for column in key.table.columns)
+    db.execute(text(f'CREATE TABLE {name} (LIKE {parent} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'))
+    moved = db.execute(text(
+        f'WITH moved AS (DELETE FROM {default} WHERE {in_month} RETURNING {columns}) '
+        f'INSERT INTO {name} ({columns}) SELECT {columns} FROM moved'
+    ), params).rowcount
+    db.execute(text(f'ALTER TABLE {parent} ATTACH PARTITION {name} {bounds}'))
+    return moved
+
+
+def ensure_partitions(db: Session, months_ahead: int = None, now: datetime.datetime = None) -> List[str]:
+    """
+    Creates the partitions of the current month and the next `months_ahead` ones, and of every month still
+    in the default partition (rows inserted before their partition existed, e.g. seeded history).
+    Commits after each partition, returns the names of the created ones.
+    """
+    months_ahead = Config.PARTITION_MONTHS_AHEAD if months_ahead is None else months_ahead
+    current = month_start(now or models.now())
+
+    created = []
+    for table_name, key in PARTITIONED_TABLES.items():
+        existing = {partition.start for partition in list_partitions(db, table_name)}
+        months = {
+            month for month, in db.execute(text(
+                f"SELECT DISTINCT date_trunc('month', {key.name}) FROM {_qualified(f'{table_name}_default')}"
+            ))
+        }
+        months.update(add_months(current, i) for i in range(months_ahead + 1))
+
+        for month in sorted(months - existing):
+            create_partition(db, table_name, month)
+            db.commit()
+            created.append(partition_name(table_name, month))
+    return created
+
+
+def _unsettled_subscription_ids(db: Session, name: str) -> List[int]:
+    return [
+        subscription_id for subscription_id, in db.execute(text(
+            f'SELECT DISTINCT subscription_id FROM {_qualified(name)} WHERE NOT settled'
+        ))
+    ]
+
+
+def expire_partitions(
+    db: Session,
+    retention_months: int = None,
+    drop: bool = None,
+    now: datetime.datetime = None,
+) -> List[str]:
+    """
+    Detaches the partitions that ended more than `retention_months` months before the current one (0 keeps
+    everything), and drops them with `drop`. Detached partitions stay as plain tables to archive or drop
+    later. Rollups are kept, rollups.metric_stats() still answers aligned ranges over expired months.
+
+    Unsettled transactions of an expiring partition are settled first so total_amount and the ledger count
+    them. The ledger keeps the expired days, but statements.backfill_statements() rebuilds from the attached
+    transactions only and can't bring them back.
+    """
+    retention_months = Config.PARTITION_RETENTION_MONTHS if retention_months is None else retention_months
+    drop = Config.PARTITION_DROP_EXPIRED if drop is None else drop
+    if not retention_months:
+        return []
+    cutoff = add_months(month_start(now or models.now()), -retention_months)
+
+    expired = []
+    for table_name in PARTITIONED_TABLES:
+        for partition in list_partitions(db, table_name):
+            if partition.end > cutoff:
+                break
+            if table_name == 'transaction':
+                subscription_ids = _unsettled_subscription_ids(db, partition.name)
+                if subscription_ids:
+                    settle_transactions(db, subscription_ids)
+                    db.commit()
+
+            db.execute(text(f'ALTER TABLE {_qualified(table_name)} DETACH PARTITION {_qualified(partition.name)}'))
+            # Detached rows can't be settled anymore, keep the partition if unsettled rows arrived meanwhile
+            if table_name == 'transaction' and _unsettled_subscription_ids(db, partition.name):
+                db.rollback()
+                print(f'{partition.name} has unsettled transactions, not expired')
+                continue
+            if drop:
+                db.execute(text(f'DROP TABLE {_qualified(partition.name)}'))
+            db.commit()
+            expired.append(partition.name)
+    return expired
+
+
+def maintain_partitions(**kwargs) -> dict:
+    # Meant to run daily, creating partitions well before they are needed keeps inserts out of the default partition
+    with with_database(**kwargs) as db:
+        return {
+            'created': ensure_partitions(db),
+            'expired': expire_partitions(db),
+        }
+
+
+def test_partitions(repeat: int = 20):
+    print("Starting partition maintenance test...")
+
+    with with_database() as db:
+        metric_id, last = db.query(
+            models.MetricValue.metric_id, func.max(models.MetricValue.calculated_on)
+        ).group_by(models.MetricValue.metric_id).order_by(func.count().desc()).first()
+
+        start_time = time.perf_counter()
+        created = ensure_partitions(db)
+        print(f"ensure_partitions() created {len(created)} partitions in {time.perf_counter() - start_time:.4f} seconds")
+
+        # A value past the last partition lands in the default partition until its month is created
+        partitions = list_partitions(db, 'metricvalue')
+        future = partitions[-1].end + datetime.timedelta(days=1)
+        db.add(models.MetricValue(metric_id=metric_id, value=Decimal(1), calculated_on=future))
+        db.commit()
+
+        try:
+            created = ensure_partitions(db)
+            assert created == [partition_name('metricvalue', month_start(future))], created
+            count = db.execute(text(
+                f"SELECT count(*) FROM {_qualified(partition_name('metricvalue', month_start(future)))}"
+            )).scalar()
+            assert count == 1, f'Expected the value in its new partition, found {count}'
+        finally:
+            db.execute(delete(models.MetricValue).where(models.MetricValue.calculated_on == future))
+            db.execute(text(f"DROP TABLE {_qualified(partition_name('metricvalue', month_start(future)))}"))
+            db.commit()
+
+        # Only the partition of the month is scanned
+        start = month_start(last)
+        query = db.query(func.count(models.MetricValue.id), func.avg(models.MetricValue.value)).filter(
+            models.MetricValue.metric_id == metric_id,
+            models.MetricValue.calculated_on >= start,
+            models.MetricValue.calculated_on < add_months(start, 1),
+        )
+        plan = '\n'.join(row for row, in db.execute(text(
+            'EXPLAIN ' + str(query.statement.compile(db.bind, compile_kwargs={'literal_binds': True}))
+        )))
+        tables = {partition.name for partition in list_partitions(db, 'metricvalue')} | {'metricvalue_default'}
+        scanned = set(re.findall(r' on (metricvalue_\w+)', plan)) & tables
+        assert scanned == {partition_name('metricvalue', start)}, f'Scanned {scanned}'
+
+        start_time = time.perf_counter()
+        for _ in range(repeat):
+            count, _ = query.one()
+        elapsed = (time.perf_counter() - start_time) / repeat
+        print(f"One month of metric {metric_id} ({count} values) from {len(scanned)} of "
+              f"{len(list_partitions(db, 'metricvalue'))} partitions in {elapsed * 1000:.3f} ms")
+
+
+if __name__ == '__main__':
+    print(maintain_partitions())
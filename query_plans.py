@@ -0,0 +1,102 @@
+import datetime
+from typing import Dict, List
+
+from sqlalchemy import func, select, text
+from sqlalchemy.orm import Session, with_parent
+
+from database import with_database
+from rollups import metric_stats_query
+from routing import billed_subscriptions
+from statements import statement_query, top_spenders_query
+import models
+
+
+def explain(db: Session, statement) -> dict:
+    # Plan of the statement as the application sends it, parameters bound by the driver
+    compiled = statement.compile(dialect=db.bind.dialect, compile_kwargs={'render_postcompile': True})
+    plan, = db.connection().exec_driver_sql(f'EXPLAIN (FORMAT JSON) {compiled}', compiled.params).one()
+    return plan[0]['Plan']
+
+
+def seq_scans(plan: dict) -> List[str]:
+    scans = [plan['Relation Name']] if plan['Node Type'] == 'Seq Scan' else []
+    for child in plan.get('Plans', ()):
+        scans += seq_scans(child)
+    return scans
+
+
+def core_queries(db: Session, days: int = 30) -> dict:
+    """
+    The lookups of the billing path, reports and rollups, bound to sample rows. Whole-table aggregates
+    (ledger_offsets, compact_stripes, recovery) read every row by design and are left out.
+    """
+    metric = db.query(models.Metric).filter(func.cardinality(models.Metric.topic_ids) > 0).order_by(models.Metric.id).first()
+    subscription = db.query(models.Subscription).order_by(models.Subscription.id).first()
+    client = db.get(models.Client, subscription.client_id)
+    end = models.now().replace(tzinfo=None)
+    start = end - datetime.timedelta(days=days)
+
+    return {
+        'metric routes': select(models.Metric.topic_ids).where(models.Metric.id == metric.id),
+        'billed subscriptions': billed_subscriptions(metric.topic_ids),
+        'metrics of a topic': select(models.Metric.id).where(models.Metric.topic_ids.contains(metric.topic_ids[:1])),
+        'client subscriptions': select(models.Subscription).where(with_parent(client, models.Client.subscriptions)),
+        'subscription transactions': select(models.Transaction).where(
+            with_parent(subscription, models.Subscription.transactions),
+            models.Transaction.created_at >= start,
+            models.Transaction.created_at < end,
+        ),
+        'metric transactions': select(models.Transaction).where(
+            with_parent(metric, models.Metric.transactions),
+            models.Transaction.created_at >= start,
+            models.Transaction.created_at < end,
+        ),
+        'unsettled transactions': select(models.Transaction.subscription_id, models.Transaction.amount).where(
+            ~models.Transaction.settled,
+            models.Transaction.subscription_id.in_([subscription.id]),
+        ),
+        'subscription counters': select(models.SubscriptionCounter).where(
+            models.SubscriptionCounter.subscription_id == subscription.id
+        ),
+        'metric values': select(models.MetricValue).where(
+            with_parent(metric, models.Metric.metric_values),
+            models.MetricValue.calculated_on >= start,
+            models.MetricValue.calculated_on < end,
+        ),
+        'metric stats': metric_stats_query(metric.id, start + datetime.timedelta(minutes=1), end, use_rollups=False),
+        'metric stats rollup': metric_stats_query(
+            metric.id, start.replace(hour=0, minute=0, second=0, microsecond=0), end.replace(minute=0, second=0, microsecond=0)
+        ),
+        'client statement': statement_query(start.date(), end.date(), client_id=client.id),
+        'subscription statement': statement_query(start.date(), end.date(), subscription_id=subscription.id),
+        'top spenders': top_spenders_query(start.date(), end.date()),
+    }
+
+
+def check_query_plans(db: Session) -> Dict[str, List[str]]:
+    """
+    Plans every core query with sequential scans disabled and returns the tables each one still scans
+    sequentially, which only happens when no index can serve it.
+    """
+    db.execute(text('SET LOCAL enable_seqscan = off'))
+    try:
+        return {name: seq_scans(explain(db, statement)) for name, statement in core_queries(db).items()}
+    finally:
+        db.rollback()
+
+
+def test_query_plans():
+    print("Starting query plan test...")
+
+    with with_database() as db:
+        results = check_query_plans(db)
+
+    for name, scans in results.items():
+        print(f"{name}: {'Seq Scan on ' + ', '.join(sorted(set(scans))) if scans else 'no sequential scan'}")
+
+    failures = {name: scans for name, scans in results.items() if scans}
+    assert not failures, f'Sequential scans in {failures}'
+
+
+if __name__ == '__main__':
+    test_query_plans()
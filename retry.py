@@ -0,0 +1,179 @@
+import functools
+import random
+import threading
+import time
+from collections import defaultdict
+from decimal import Decimal
+
+from sqlalchemy.exc import DBAPIError
+
+from database import with_database
+
+SERIALIZATION_FAILURE = '40001'
+DEADLOCK_DETECTED = '40P01'
+RETRYABLE_CODES = {SERIALIZATION_FAILURE, DEADLOCK_DETECTED}
+
+
+def error_code(error: Exception):
+    # psycopg2 exposes the SQLSTATE as pgcode, asyncpg as sqlstate
+    orig = getattr(error, 'orig', error)
+    return getattr(orig, 'pgcode', None) or getattr(orig, 'sqlstate', None)
+
+
+def is_retryable(error: Exception) -> bool:
+    return isinstance(error, DBAPIError) and error_code(error) in RETRYABLE_CODES
+
+
+class RetryPolicy:
+    """
+    Jittered exponential backoff ("full jitter") with a retry budget.
+
+    Every call adds `budget_ratio` tokens to the budget (up to `budget_max`), every retry takes one. When the
+    database is overloaded and most calls conflict the budget runs dry and errors are raised instead of
+    multiplying the load with retries.
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = 10,
+        base_delay: float = 0.005,
+        max_delay: float = 0.5,
+        budget_ratio: float = 1.0,
+        budget_max: float = 100.0,
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget_ratio = budget_ratio
+        self.budget_max = budget_max
+
+        self._tokens = budget_max
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self.budget_max, self._tokens + self.budget_ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    def delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class RetryStats:
+    def __init__(self):
+        self._sites = defaultdict(lambda: {
+            'calls': 0,
+            'retries': 0,
+            'serialization_failures': 0,
+            'deadlocks': 0,
+            'failures': 0,
+            'wasted_seconds': 0.0,
+        })
+        self._lock = threading.Lock()
+
+    def record(self, call_site: str, **counts):
+        with self._lock:
+            site = self._sites[call_site]
+            for name, value in counts.items():
+                site[name] += value
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {call_site: dict(site) for call_site, site in self._sites.items()}
+
+    def reset(self):
+        with self._lock:
+            self._sites.clear()
+
+    def report(self):
+        for call_site, site in sorted(self.snapshot().items()):
+            print(
+                f"{call_site}: {site['calls']} calls, {site['retries']} retries "
+                f"({site['serialization_failures']} serialization failures, {site['deadlocks']} deadlocks), "
+                f"{site['failures']} failed, {site['wasted_seconds']:.4f} seconds wasted"
+            )
+
+
+default_policy = RetryPolicy()
+retry_stats = RetryStats()
+
+
+def run_in_transaction(fn, *args, call_site: str = None, policy: RetryPolicy = None, **kwargs):
+    """
+    Runs fn(db, *args) in its own with_database() session and runs it again from scratch on serialization
+    failures and deadlocks. Keyword arguments go to with_database(), e.g. isolation_level='SERIALIZABLE'.
+    """
+    policy = policy or default_policy
+    call_site = call_site or getattr(fn, '__qualname__', repr(fn))
+
+    policy.deposit()
+    retry_stats.record(call_site, calls=1)
+
+    attempt = 0
+    while True:
+        started = time.perf_counter()
+        try:
+            with with_database(**kwargs) as db:
+                return fn(db, *args)
+        except DBAPIError as e:
+            if not is_retryable(e):
+                retry_stats.record(call_site, failures=1)
+                raise
+
+            wasted = time.perf_counter() - started
+            attempt += 1
+            if attempt >= policy.max_attempts or not policy.withdraw():
+                retry_stats.record(call_site, failures=1, wasted_seconds=wasted)
+                raise
+
+            delay = policy.delay(attempt)
+            retry_stats.record(
+                call_site,
+                retries=1,
+                serialization_failures=int(error_code(e) == SERIALIZATION_FAILURE),
+                deadlocks=int(error_code(e) == DEADLOCK_DETECTED),
+                wasted_seconds=wasted + delay,
+            )
+            time.sleep(delay)
+        except Exception:
+            retry_stats.record(call_site, failures=1)
+            raise
+
+
+def retrying(call_site: str = None, policy: RetryPolicy = None, **db_kwargs):
+    # @retrying(isolation_level='SERIALIZABLE') def fn(db, ...), callers drop the db argument
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            return run_in_transaction(
+                functools.partial(fn, **kwargs) if kwargs else fn,
+                *args,
+                call_site=call_site or fn.__qualname__,
+                policy=policy,
+                **db_kwargs,
+            )
+        return wrapper
+    return decorator
+
+
+def process_metric_value_with_retries(
+    metric_id: int,
+    value: Decimal,
+    isolation_level: str = 'SERIALIZABLE',
+    policy: RetryPolicy = None,
+    **kwargs,
+):
+    from business import process_metric_value
+
+    return run_in_transaction(
+        functools.partial(process_metric_value, metric_id=metric_id, value=value, **kwargs),
+        call_site='process_metric_value',
+        policy=policy,
+        isolation_level=isolation_level,
+    )
@@ -0,0 +1,244 @@
+import datetime
+import time
+from decimal import Decimal
+from typing import Iterable, List
+
+from sqlalchemy import DateTime, Integer, cast, column, delete, func, insert, literal, null, select, text, values
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+
+from config import Config
+from counters import stripe_slot
+from database import with_database
+import models
+
+# Coarsest first
+ROLLUPS = {
+    'day': models.MetricValueDaily,
+    'hour': models.MetricValueHourly,
+}
+
+# A rollup can answer an interval when its unit divides it
+INTERVALS = ['hour', 'day', 'week', 'month', 'quarter', 'year']
+
+
+def rollup_upserts(metric_values: Iterable[dict]) -> list:
+    rows = [
+        (metric_value['metric_id'], metric_value['value'], metric_value['calculated_on'])
+        for metric_value in metric_values
+        if metric_value['value'] is not None
+    ]
+    if not rows:
+        return []
+
+    new_values = values(
+        column('metric_id', Integer),
+        column('value', models.MetricValue.value.type),
+        column('calculated_on', DateTime),
+        name='new_values',
+    ).data(rows)
+    slot = literal(stripe_slot(Config.ROLLUP_STRIPES), Integer)
+
+    statements = []
+    for unit, rollup in ROLLUPS.items():
+        # Cast like the metricvalue insert does, so the value lands in the bucket of its stored calculated_on
+        bucket = func.date_trunc(unit, cast(new_values.c.calculated_on, DateTime))
+        statement = pg_insert(rollup).from_select(
+            ['metric_id', 'bucket', 'slot', 'count', 'sum', 'min', 'max'],
+            select(
+                new_values.c.metric_id,
+                bucket,
+                slot,
+                func.count(),
+                func.sum(new_values.c.value),
+                func.min(new_values.c.value),
+                func.max(new_values.c.value),
+            ).group_by(new_values.c.metric_id, bucket).order_by(new_values.c.metric_id, bucket)
+        )
+        statements.append(statement.on_conflict_do_update(
+            index_elements=[rollup.metric_id, rollup.bucket, rollup.slot],
+            set_={
+                'count': rollup.count + statement.excluded.count,
+                'sum': rollup.sum + statement.excluded.sum,
+                'min': func.least(rollup.min, statement.excluded.min),
+                'max': func.greatest(rollup.max, statement.excluded.max),
+            },
+        ))
+    return statements
+
+
+def add_to_rollups(db: Session, metric_values: Iterable[dict]) -> int:
+    """
+    Adds metric values ({'metric_id', 'value', 'calculated_on'} dicts) to every rollup, one upsert per
+    rollup into the worker's slot (see `ROLLUP_STRIPES`). Rows are locked in (metric_id, bucket) order,
+    after the subscriptions and right before the commit, so writers of the same metric only queue on
+    each other when they share a slot and then hold the row for as short as possible.
+    """
+    metric_values = list(metric_values)
+    for statement in rollup_upserts(metric_values):
+        db.execute(statement)
+    return sum(metric_value['value'] is not None for metric_value in metric_values)
+
+
+def backfill_rollups(metric_ids: List[int] = None, **kwargs) -> int:
+    """
+    Rebuilds the rollups of `metric_ids` (default: every metric) from metricvalue, one transaction per
+    metric. Each transaction holds a SHARE lock on metricvalue, new values wait until that metric is
+    rebuilt instead of being counted twice or lost.
+    """
+    with with_database(**kwargs) as db:
+        if metric_ids is None:
+            metric_ids = [metric_id for metric_id, in db.query(models.Metric.id).order_by(models.Metric.id)]
+
+    count = 0
+    for metric_id in metric_ids:
+        with with_database(**kwargs) as db:
+            db.execute(text(f'LOCK TABLE {models.MetricValue.__table__.fullname} IN SHARE MODE'))
+            for unit, rollup in ROLLUPS.items():
+                db.execute(delete(rollup).where(rollup.metric_id == metric_id))
+
+                bucket = func.date_trunc(unit, models.MetricValue.calculated_on)
+                result = db.execute(insert(rollup).from_select(
+                    ['metric_id', 'bucket', 'count', 'sum', 'min', 'max'],
+                    select(
+                        models.MetricValue.metric_id,
+                        bucket,
+                        func.count(),
+                        func.sum(models.MetricValue.value),
+                        func.min(models.MetricValue.value),
+                        func.max(models.MetricValue.value),
+                    ).where(
+                        models.MetricValue.metric_id == metric_id,
+                        models.MetricValue.value.isnot(None),
+                        models.MetricValue.calculated_on.isnot(None),
+                    ).group_by(models.MetricValue.metric_id, bucket)
+                ))
+                count += result.rowcount
+            db.commit()
+    return count
+
+
+def _naive_utc(value: datetime.datetime) -> datetime.datetime:
+    # calculated_on is stored as naive UTC
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _aligned(value: datetime.datetime, unit: str) -> bool:
+    if value.minute or value.second or value.microsecond:
+        return False
+    return unit == 'hour' or value.hour == 0
+
+
+def pick_rollup(start: datetime.datetime, end: datetime.datetime, interval: str = None):
+    """
+    Coarsest rollup that answers [start, end) exactly at `interval` (None: one row for the whole range),
+    None when only the raw values can.
+    """
+    for unit, rollup in ROLLUPS.items():
+        if interval is not None and (interval not in INTERVALS or INTERVALS.index(interval) < INTERVALS.index(unit)):
+            continue
+        if _aligned(start, unit) and _aligned(end, unit):
+            return rollup
+    return None
+
+
+def metric_stats_query(
+    metric_id: int,
+    start: datetime.datetime,
+    end: datetime.datetime,
+    interval: str = None,
+    use_rollups: bool = True,
+):
+    start, end = _naive_utc(start), _naive_utc(end)
+    rollup = pick_rollup(start, end, interval) if use_rollups else None
+
+    if rollup is not None:
+        timestamp = rollup.bucket
+        columns = [
+            func.coalesce(func.sum(rollup.count), 0),
+            func.min(rollup.min),
+            func.max(rollup.max),
+            func.sum(rollup.sum) / func.sum(rollup.count),
+        ]
+        source = select().select_from(rollup).where(rollup.metric_id == metric_id)
+    else:
+        timestamp = models.MetricValue.calculated_on
+        columns = [
+            func.count(models.MetricValue.value),
+            func.min(models.MetricValue.value),
+            func.max(models.MetricValue.value),
+            func.avg(models.MetricValue.value),
+        ]
+        source = select().select_from(models.MetricValue).where(
+            models.MetricValue.metric_id == metric_id,
+            models.MetricValue.value.isnot(None),
+        )
+
+    query = source.where(timestamp >= start, timestamp < end)
+    if interval is None:
+        return query.add_columns(null(), *columns)
+
+    bucket = func.date_trunc(interval, timestamp)
+    return query.add_columns(bucket, *columns).group_by(bucket).order_by(bucket)
+
+
+def metric_stats(
+    db: Session,
+    metric_id: int,
+    start: datetime.datetime,
+    end: datetime.datetime,
+    interval: str = None,
+    use_rollups: bool = True,
+) -> list:
+    """
+    (bucket, count, min, max, avg) of the metric's values calculated in [start, end), per `interval`
+    ('hour', 'day', 'week', 'month', ...) or a single row with bucket None. Read from the coarsest rollup
+    that answers the request exactly, the raw values otherwise.
+    """
+    return db.execute(metric_stats_query(metric_id, start, end, interval, use_rollups)).all()
+
+
+def test_rollup_performance(repeat: int = 20):
+    with with_database() as db:
+        metric_ids = [
+            m.id for m in db.query(models.Metric).all()
+        ]
+        end = db.query(func.max(models.MetricValue.calculated_on)).scalar()
+
+    end = (end + datetime.timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    start = end - datetime.timedelta(days=365)
+
+    start_time = time.perf_counter()
+    backfill_rollups()
+    print(f"backfill_rollups() completed in {time.perf_counter() - start_time:.4f} seconds")
+
+    print(f"Starting rollup performance test for metrics: {metric_ids}...")
+
+    for interval in (None, 'day', 'week', 'month'):
+        with with_database() as db:
+            timings = {}
+            for use_rollups in (False, True):
+                start_time = time.perf_counter()
+                for _ in range(repeat):
+                    for metric_id in metric_ids:
+                        rows = metric_stats(db, metric_id, start, end, interval, use_rollups)
+                timings[use_rollups] = time.perf_counter() - start_time
+
+            raw = [metric_stats(db, metric_id, start, end, interval, False) for metric_id in metric_ids]
+            rolled_up = [metric_stats(db, metric_id, start, end, interval) for metric_id in metric_ids]
+            for raw_rows, rollup_rows in zip(raw, rolled_up):
+                assert [row[:4] for row in raw_rows] == [row[:4] for row in rollup_rows], 'Rollups do not match raw values'
+                assert all(
+                    abs(raw_row[4] - rollup_row[4]) < Decimal('0.0001')
+                    for raw_row, rollup_row in zip(raw_rows, rollup_rows) if raw_row[1]
+                ), 'Rollup averages do not match raw values'
+
+        queries = repeat * len(metric_ids)
+        print(f"metric_stats(interval={interval}, {len(rows)} rows) raw in {timings[False] / queries * 1000:.3f} ms, "
+              f"rollup in {timings[True] / queries * 1000:.3f} ms ({timings[False] / timings[True]:.1f}x)")
+
+
+if __name__ == '__main__':
+    test_rollup_performance()
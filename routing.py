@@ -0,0 +1,174 @@
+import threading
+import time
+from collections import OrderedDict
+from decimal import Decimal
+from typing import List, Optional, Tuple
+
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session, object_session
+
+import models
+from config import Config
+
+Route = Tuple[int, Decimal]
+
+
+def billed_subscriptions(topic_ids: List[int]):
+    return select(
+        models.Subscription.id,
+        models.Subscription.single_metric_pricing,
+    ).join(models.Topic).where(
+        models.Topic.id.in_(topic_ids)
+    )
+
+
+def locked_in_order(subscription_ids):
+    # Lock rows in id order so concurrent writers over overlapping subscriptions queue instead of deadlocking.
+    # FOR NO KEY UPDATE does not conflict with the KEY SHARE locks taken by transaction inserts.
+    return subscription_ids.order_by(models.Subscription.id).with_for_update(key_share=True, of=models.Subscription)
+
+
+def load_routes(db: Session, metric_id: int) -> Tuple[Route, ...]:
+    topic_ids = db.execute(
+        select(models.Metric.topic_ids).where(models.Metric.id == metric_id)
+    ).one_or_none()
+
+    if topic_ids is None:
+        raise ValueError(f"Metric with ID {metric_id} not found")
+
+    return tuple(
+        (subscription.id, subscription.single_metric_pricing)
+        for subscription in db.execute(billed_subscriptions(topic_ids[0] or []))
+    )
+
+
+class RoutingCache:
+    """
+    LRU cache of metric_id -> ((subscription_id, single_metric_pricing), ...).
+
+    Entries expire after `ttl` seconds so changes made by other processes are picked up, changes made through
+    the ORM in this process invalidate the affected entries as soon as their session commits. Bulk
+    `query(...).update()` / `.delete()` on Metric or Subscription bypass ORM events, call `invalidate()` after
+    those (once committed).
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 30.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, db: Session, metric_id: int) -> Tuple[Route, ...]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(metric_id)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(metric_id)
+                self.hits += 1
+                return entry[1]
+
+            self.misses += 1
+            generation = self._generation
+
+        routes = load_routes(db, metric_id)
+
+        with self._lock:
+            # Skip storing if an invalidation happened while loading, the routes may already be stale
+            if generation == self._generation:
+                self._entries[metric_id] = (now + self.ttl, routes)
+                self._entries.move_to_end(metric_id)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return routes
+
+    def invalidate(self, metric_id: Optional[int] = None):
+        with self._lock:
+            self._generation += 1
+            self.invalidations += 1
+            if metric_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(metric_id, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
+
+
+routing_cache = RoutingCache(
+    max_size=Config.ROUTING_CACHE_SIZE,
+    ttl=Config.ROUTING_CACHE_TTL,
+)
+
+
+def _has_changes(target, *attributes) -> bool:
+    state = inspect(target)
+    return any(state.attrs[attribute].history.has_changes() for attribute in attributes)
+
+
+# Metric ids (None: every entry) to invalidate when the flushing session commits
+_PENDING_INVALIDATIONS = 'routing_cache_invalidations'
+
+
+def _invalidate_on_commit(target, metric_id: Optional[int] = None):
+    # Mapper events fire at flush, before the change is visible to other sessions. Invalidating now would let
+    # a miss in another thread load the old committed routes and keep them for the whole ttl.
+    session = object_session(target)
+    if session is None:
+        routing_cache.invalidate(metric_id)
+        return
+    session.info.setdefault(_PENDING_INVALIDATIONS, set()).add(metric_id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_invalidations(session):
+    pending = session.info.pop(_PENDING_INVALIDATIONS, None)
+    if not pending:
+        return
+    if None in pending:
+        routing_cache.invalidate()
+        return
+    for metric_id in sorted(pending):
+        routing_cache.invalidate(metric_id)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _drop_invalidations(session, previous_transaction):
+    # Changes flushed before a rolled back savepoint still commit, keep theirs
+    if previous_transaction.parent is None:
+        session.info.pop(_PENDING_INVALIDATIONS, None)
+
+
+@event.listens_for(models.Metric, 'after_update')
+def _invalidate_updated_metric(mapper, connection, target):
+    if _has_changes(target, 'topic_ids'):
+        _invalidate_on_commit(target, target.id)
+
+
+@event.listens_for(models.Metric, 'after_delete')
+def _invalidate_deleted_metric(mapper, connection, target):
+    _invalidate_on_commit(target, target.id)
+
+
+@event.listens_for(models.Subscription, 'after_insert')
+@event.listens_for(models.Subscription, 'after_delete')
+def _invalidate_subscriptions(mapper, connection, target):
+    _invalidate_on_commit(target)
+
+
+@event.listens_for(models.Subscription, 'after_update')
+def _invalidate_updated_subscription(mapper, connection, target):
+    if _has_changes(target, 'topic_id', 'single_metric_pricing'):
+        _invalidate_on_commit(target)
@@ -0,0 +1,404 @@
+import csv
+import datetime
+import hashlib
+import io
+import math
+import os
+import random
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+
+from faker import Faker
+
+from database import get_engine
+import models
+from main import SEED, metric_names, source_names, topic_names
+
+CHUNK_SIZE = 100_000
+
+# Shards are the unit of parallel work, their boundaries only depend on these sizes and never on the
+# number of workers, so the generated data is the same whatever `workers` is. A shard is held in memory
+# as one CSV text, at most CHUNK_SIZE rows each whatever the scale.
+TRANSACTION_SHARD_ROWS = CHUNK_SIZE
+METRIC_VALUE_SHARD_SLOTS = CHUNK_SIZE
+CONTENT_SHARD_SIZE = 1_000
+
+
+def _rng(table: str) -> random.Random:
+    # One independent, reproducible stream per table, adding rows to one table does not shift the others
+    return random.Random(f'{SEED}:{table}')
+
+
+def _faker(table: str) -> Faker:
+    fake = Faker()
+    fake.seed_instance(f'{SEED}:{table}')
+    return fake
+
+
+def _shard_seed(table: str, shard: int) -> str:
+    return f'{table}:{shard}'
+
+
+def _between(rng: random.Random, start: datetime.datetime, end: datetime.datetime) -> datetime.datetime:
+    return start + datetime.timedelta(seconds=rng.uniform(0, max((end - start).total_seconds(), 0)))
+
+
+def _array(values) -> str:
+    return '{' + ','.join(str(value) for value in values) + '}'
+
+
+def copy_rows(connection, table, columns, rows, chunk_size: int = CHUNK_SIZE) -> int:
+    """
+    Streams rows into table with COPY ... FROM STDIN, buffering at most `chunk_size` rows in memory.
+    `connection` is a raw DBAPI (psycopg2) connection.
+    """
+    preparer = get_engine().dialect.identifier_preparer
+    statement = 'COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+        preparer.format_table(table),
+        ', '.join(preparer.quote(column) for column in columns),
+    )
+
+    count = 0
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush():
+        buffer.seek(0)
+        with connection.cursor() as cursor:
+            cursor.copy_expert(statement, buffer)
+        buffer.seek(0)
+        buffer.truncate()
+
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+        if count % chunk_size == 0:
+            flush()
+
+    if buffer.tell():
+        flush()
+    return count
+
+
+def copy_csv(connection, table, columns, chunks) -> int:
+    # Like copy_rows for chunks that are already CSV text, one COPY per (text, row count) chunk
+    preparer = get_engine().dialect.identifier_preparer
+    statement = 'COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+        preparer.format_table(table),
+        ', '.join(preparer.quote(column) for column in columns),
+    )
+
+    count = 0
+    for chunk, rows in chunks:
+        if rows:
+            with connection.cursor() as cursor:
+                cursor.copy_expert(statement, io.StringIO(chunk))
+        count += rows
+    return count
+
+
+def generate(shard_fn, shards, workers: int = None):
+    """
+    Yields shard_fn(shard) for every shard, in order. With more than one worker the shards are generated by a
+    process pool, at most two per worker are in flight so memory stays bounded however many shards there are.
+    """
+    workers = workers or os.cpu_count()
+    if workers == 1:
+        yield from map(shard_fn, shards)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        in_flight = deque()
+        for shard in shards:
+            in_flight.append(pool.submit(shard_fn, shard))
+            if len(in_flight) >= workers * 2:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+
+def _csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+    return buffer.getvalue(), count
+
+
+def _transaction_shards(subscription_rows, transactions_per_subscription):
+    # Yields lists of (subscription row, transaction count) covering TRANSACTION_SHARD_ROWS transactions,
+    # the transactions of a subscription can be split across shards
+    spans, rows = [], 0
+    for subscription_row in subscription_rows:
+        if transactions_per_subscription is not None:
+            count = transactions_per_subscription
+        else:
+            total_amount, single_metric_pricing = subscription_row[4], subscription_row[5]
+            count = math.ceil(total_amount / single_metric_pricing)
+        while count:
+            taken = min(count, TRANSACTION_SHARD_ROWS - rows)
+            spans.append((subscription_row, taken))
+            rows += taken
+            count -= taken
+            if rows == TRANSACTION_SHARD_ROWS:
+                yield spans
+                spans, rows = [], 0
+    if spans:
+        yield spans
+
+
+def _transaction_shard(args):
+    shard, spans, metric_ids, now = args
+    rng = _rng(_shard_seed('transaction', shard))
+
+    def rows():
+        for (subscription_id, subscription_created_at, _, _, _, single_metric_pricing), count in spans:
+            for _ in range(count):
+                yield (
+                    subscription_id,
+                    rng.choice(metric_ids),
+                    single_metric_pricing,
+                    _between(rng, subscription_created_at, now),
+                )
+
+    return _csv(rows())
+
+
+def _metric_value_shard(args):
+    shard, metric_id, first_slot, last_slot, start_date, step, now = args
+    rng = _rng(_shard_seed('metricvalue', shard))
+
+    def rows():
+        for i in range(first_slot, last_slot):
+            # Skip some slots randomly to make it more realistic
+            if rng.random() > 0.2:
+                yield (
+                    metric_id,
+                    Decimal(rng.randint(1, 10000)) / 100,
+                    start_date + step * i,
+                    now,
+                )
+
+    return _csv(rows())
+
+
+def _content_shard(args):
+    shard, count, source_ids, now = args
+    seed = _shard_seed('content', shard)
+    rng, fake = _rng(seed), _faker(seed)
+
+    documents = []
+    for _ in range(count):
+        created_at = _between(rng, now - datetime.timedelta(days=365), now)
+        documents.append({
+            'created_at': created_at,
+            'updated_at': created_at,
+            'title': fake.sentence(),
+            'url': fake.url(),
+            'content': fake.text(max_nb_chars=2000),
+            'source_id': rng.choice(source_ids),
+        })
+    return documents
+
+
+def generate_contents(count: int, source_ids, workers: int = None, now: datetime.datetime = None):
+    # Yields lists of raw Content documents, at most CONTENT_SHARD_SIZE each
+    now = now or models.now()
+    shards = (
+        (shard, min(CONTENT_SHARD_SIZE, count - first), list(source_ids), now)
+        for shard, first in enumerate(range(0, count, CONTENT_SHARD_SIZE))
+    )
+    return generate(_content_shard, shards, workers)
+
+
+def _next_id(connection, model) -> int:
+    # Ids are assigned here so foreign keys can be written without reading anything back, after existing rows
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT coalesce(max(id), 0) + 1 FROM {}'.format(
+            get_engine().dialect.identifier_preparer.format_table(model.__table__)
+        ))
+        return cursor.fetchone()[0]
+
+
+def _reset_sequence(connection, model):
+    table = get_engine().dialect.identifier_preparer.format_table(model.__table__)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT setval(pg_get_serial_sequence(%s, 'id'), (SELECT coalesce(max(id), 0) + 1 FROM {table}), false)",
+            (table,),
+        )
+
+
+def bulk_populate(
+    clients: int = None,
+    subscriptions_per_client=(3, 5),
+    transactions_per_subscription: int = None,
+    metric_value_days: int = 365,
+    metric_values_per_day: int = 1,
+    contents: int = None,
+    chunk_size: int = CHUNK_SIZE,
+    now: datetime.datetime = None,
+    workers: int = None,
+):
+    """
+    Same distributions as main._populate, loaded with COPY. By default the sizes match main._populate,
+    scale with `clients`, `transactions_per_subscription` (default: enough to cover total_amount, as in
+    main._populate), `metric_value_days` and `metric_values_per_day`. Timestamps are relative to `now`, pass a
+    fixed value to get byte-identical data across runs. Transactions, metric values and content are generated
+    in shards by `workers` processes (default: one per core), the output does not depend on `workers`.
+    """
+    now = (now or models.now()).replace(tzinfo=None)
+    counts = {}
+    started = time.perf_counter()
+
+    connection = get_engine().raw_connection()
+    try:
+        # Sources
+        rng, fake = _rng('source'), _faker('source')
+        first_id = _next_id(connection, models.Source)
+        source_ids = list(range(first_id, first_id + len(source_names)))
+        counts['sources'] = copy_rows(connection, models.Source.__table__, ['id', 'created_at', 'name', 'url', 'schedules'], (
+            (
+                source_id,
+                now,
+                name,
+                fake.url(),
+                _array(rng.choice(list(models.ScheduleFrequency)).value for _ in range(2)),
+            )
+            for source_id, name in zip(source_ids, source_names)
+        ), chunk_size)
+
+        # Topics
+        first_id = _next_id(connection, models.Topic)
+        topic_ids = list(range(first_id, first_id + len(topic_names)))
+        counts['topics'] = copy_rows(connection, models.Topic.__table__, ['id', 'created_at', 'name'], (
+            (topic_id, now, name) for topic_id, name in zip(topic_ids, topic_names)
+        ), chunk_size)
+
+        # Metrics
+        rng = _rng('metric')
+        first_id = _next_id(connection, models.Metric)
+        metric_ids = list(range(first_id, first_id + len(metric_names)))
+        counts['metrics'] = copy_rows(connection, models.Metric.__table__, ['id', 'created_at', 'name', 'topic_ids'], (
+            (
+                metric_id,
+                now,
+                name,
+                _array(rng.choice(topic_ids) for _ in range(rng.randint(1, 3))),
+            )
+            for metric_id, name in zip(metric_ids, metric_names)
+        ), chunk_size)
+        connection.commit()
+
+        # Clients
+        rng, fake = _rng('client'), _faker('client')
+        client_count = clients if clients is not None else rng.randint(10, 20)
+        first_id = _next_id(connection, models.Client)
+        client_rows = [
+            (client_id, _between(rng, now - datetime.timedelta(days=730), now), fake.company())
+            for client_id in range(first_id, first_id + client_count)
+        ]
+        counts['clients'] = copy_rows(connection, models.Client.__table__, ['id', 'created_at', 'name'], client_rows, chunk_size)
+
+        # Subscriptions
+        rng = _rng('subscription')
+        subscription_rows = []
+        subscription_id = _next_id(connection, models.Subscription)
+        for client_id, client_created_at, _ in client_rows:
+            for _ in range(rng.randint(*subscriptions_per_client)):
+                total_amount = Decimal(rng.randint(100000, 10000000)) / 100
+                single_metric_pricing = (total_amount / rng.randint(5, 25)).quantize(Decimal('0.0001'))
+                subscription_rows.append((
+                    subscription_id,
+                    _between(rng, client_created_at, now),
+                    rng.choice(topic_ids),
+                    client_id,
+                    total_amount,
+                    single_metric_pricing,
+                ))
+                subscription_id += 1
+        counts['subscriptions'] = copy_rows(connection, models.Subscription.__table__, [
+            'id', 'created_at', 'topic_id', 'client_id', 'total_amount', 'single_metric_pricing'
+        ], subscription_rows, chunk_size)
+        connection.commit()
+
+        # Transactions
+        counts['transactions'] = copy_csv(connection, models.Transaction.__table__, [
+            'subscription_id', 'metric_id', 'amount', 'created_at'
+        ], generate(_transaction_shard, (
+            (shard, spans, metric_ids, now)
+            for shard, spans in enumerate(_transaction_shards(subscription_rows, transactions_per_subscription))
+        ), workers))
+        connection.commit()
+
+        # Metric values, `metric_values_per_day` slots a day for the last `metric_value_days` days
+        step = datetime.timedelta(days=1) / metric_values_per_day
+        start_date = now - datetime.timedelta(days=metric_value_days)
+        slots = metric_value_days * metric_values_per_day + 1
+        metric_value_shards = (
+            (metric_id, first, min(first + METRIC_VALUE_SHARD_SLOTS, slots))
+            for metric_id in metric_ids
+            for first in range(0, slots, METRIC_VALUE_SHARD_SLOTS)
+        )
+
+        counts['metric values'] = copy_csv(connection, models.MetricValue.__table__, [
+            'metric_id', 'value', 'calculated_on', 'created_at'
+        ], generate(_metric_value_shard, (
+            (shard, metric_id, first, last, start_date, step, now)
+            for shard, (metric_id, first, last) in enumerate(metric_value_shards)
+        ), workers))
+
+        for model in (models.Source, models.Topic, models.Metric, models.Client, models.Subscription,
+                      models.Transaction, models.MetricValue):
+            _reset_sequence(connection, model)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+    # Content lives in Mongo, there is no COPY so it goes in with unordered insert_many batches
+    content_count = contents if contents is not None else _rng('content').randint(200, 300)
+    collection = models.Content._get_collection()
+    counts['content items'] = 0
+    for documents in generate_contents(content_count, source_ids, workers, now):
+        counts['content items'] += len(collection.insert_many(documents, ordered=False).inserted_ids)
+
+    elapsed = time.perf_counter() - started
+    print(f"Database bulk populated in {elapsed:.4f} seconds with:")
+    for name, count in counts.items():
+        print(f"- {count} {name}")
+    return counts
+
+
+def test_generation_scaling(count: int = 20000, worker_counts=(1, 2, 4, 8)):
+    source_ids = list(range(1, len(source_names) + 1))
+    now = datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc)
+
+    print(f"Starting content generation scaling test for {count} documents on {os.cpu_count()} cores")
+
+    digests = set()
+    baseline = None
+    for workers in worker_counts:
+        digest = hashlib.sha256()
+        start_time = time.perf_counter()
+        for documents in generate_contents(count, source_ids, workers, now):
+            for document in documents:
+                digest.update(repr(sorted(document.items())).encode())
+        elapsed = time.perf_counter() - start_time
+        baseline = baseline or elapsed
+
+        digests.add(digest.hexdigest())
+        print(f"generate_contents(count={count}, workers={workers}) completed in {elapsed:.4f} seconds")
+        print(f'with ({(count / elapsed):.4f}) per seconds, {baseline / elapsed:.2f}x')
+
+    assert len(digests) == 1, 'Generated documents depend on the number of workers'
+
+
+if __name__ == '__main__':
+    bulk_populate()
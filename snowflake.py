@@ -1,13 +1,19 @@
 import os
-from snowflake.connector.pandas_tools import write_pandas
+import sys
 from sqlalchemy import create_engine
 import snowflake.connector
-import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from config import Config
+from export import Sink, arrow_type, export_table, export_tables, get_table, sync_table
 
 
 SNOWFLAKE_DATABASE = os.getenv('SNOWFLAKE_DATABASE')
 SNOWFLAKE_SCHEMA = os.getenv('SNOWFLAKE_SCHEMA')
+STATE_TABLE = 'EVENTHORIZON_EXPORT_STATE'
+
+# In foreign key order
+EXPORT_TABLES = ('topic', 'metric', 'metricvalue')
 
 
 def get_snowflake_connection():
@@ -21,73 +27,186 @@ def get_snowflake_connection():
     )
 
 
-def migrate_table_data(source_engine, sf_conn, table_name):
-    snowflake_table_name = f'EVENTHORIZON_{table_name.upper()}'
-    with source_engine.connect() as conn:
-        df = pd.read_sql_table(table_name, conn)
+def _qualified(table_name):
+    return f'{SNOWFLAKE_DATABASE}.{SNOWFLAKE_SCHEMA}.{table_name}'
+
+
+def _table_stage(table_name):
+    return f'@{SNOWFLAKE_DATABASE}.{SNOWFLAKE_SCHEMA}.%{table_name}'
+
+
+def _snowflake_table_name(table_name):
+    return f'EVENTHORIZON_{table_name.upper()}'
+
 
-    df.columns = map(lambda x: str(x).upper(), df.columns)
+class SnowflakeSink(Sink):
+    """
+    Staging files are PUT on the target's table stage and loaded with COPY INTO. Merges COPY into a
+    temporary staging table first and MERGE it into the target on its key. Watermarks live in
+    EVENTHORIZON_EXPORT_STATE.
+    """
 
-    for col in df.select_dtypes(include=['datetime', 'datetime64']).columns:
-        df[col] = df[col].apply(lambda x: x.isoformat() if pd.notnull(x) else None)
+    def __init__(self, conn):
+        self.conn = conn
+        with self.conn.cursor() as cur:
+            cur.execute(f"""
+                CREATE TABLE IF NOT EXISTS {_qualified(STATE_TABLE)} (
+                    table_name VARCHAR PRIMARY KEY,
+                    watermark VARCHAR
+                )
+            """)
+
+    def _copy(self, cur, target, stage_table, path):
+        # The vectorized scanner loads Parquet lists, decimals and timestamps as ARRAY, NUMBER and TIMESTAMP,
+        # PURGE removes the file from the stage once it is loaded
+        cur.execute(f"PUT 'file://{path}' {_table_stage(stage_table)} AUTO_COMPRESS=FALSE OVERWRITE=TRUE")
+        cur.execute(f"""
+            COPY INTO {_qualified(target)} FROM {_table_stage(stage_table)}
+            FILES = ('{os.path.basename(path)}')
+            FILE_FORMAT = (TYPE = PARQUET USE_VECTORIZED_SCANNER = TRUE)
+            MATCH_BY_COLUMN_NAME = CASE_INSENSITIVE
+            PURGE = TRUE
+        """)
+
+    def truncate(self, table_name):
+        with self.conn.cursor() as cur:
+            cur.execute(f"TRUNCATE TABLE {_qualified(_snowflake_table_name(table_name))}")
+
+    def load(self, table_name, path):
+        snowflake_table_name = _snowflake_table_name(table_name)
+        with self.conn.cursor() as cur:
+            self._copy(cur, snowflake_table_name, snowflake_table_name, path)
+
+    def merge(self, table_name, path, key):
+        snowflake_table_name = _snowflake_table_name(table_name)
+        staging_table_name = f'{snowflake_table_name}_STAGING'
+        columns = [column.upper() for column in pq.read_schema(path).names]
+        key = key.upper()
+
+        with self.conn.cursor() as cur:
+            cur.execute(
+                f"CREATE TEMPORARY TABLE IF NOT EXISTS {_qualified(staging_table_name)} "
+                f"LIKE {_qualified(snowflake_table_name)}"
+            )
+            cur.execute(f"TRUNCATE TABLE {_qualified(staging_table_name)}")
+            self._copy(cur, staging_table_name, snowflake_table_name, path)
+            cur.execute(f"""
+                MERGE INTO {_qualified(snowflake_table_name)} t
+                USING {_qualified(staging_table_name)} s ON t.{key} = s.{key}
+                WHEN MATCHED THEN UPDATE SET {', '.join(f't.{c} = s.{c}' for c in columns if c != key)}
+                WHEN NOT MATCHED THEN INSERT ({', '.join(columns)}) VALUES ({', '.join(f's.{c}' for c in columns)})
+            """)
+
+    def get_watermark(self, table_name):
+        with self.conn.cursor() as cur:
+            cur.execute(f"SELECT watermark FROM {_qualified(STATE_TABLE)} WHERE table_name = %s", (table_name,))
+            row = cur.fetchone()
+        return row[0] if row else None
+
+    def set_watermark(self, table_name, watermark):
+        with self.conn.cursor() as cur:
+            cur.execute(f"""
+                MERGE INTO {_qualified(STATE_TABLE)} t
+                USING (SELECT %s AS table_name, %s AS watermark) s ON t.table_name = s.table_name
+                WHEN MATCHED THEN UPDATE SET t.watermark = s.watermark
+                WHEN NOT MATCHED THEN INSERT (table_name, watermark) VALUES (s.table_name, s.watermark)
+            """, (table_name, watermark))
+
+    def close(self):
+        self.conn.close()
+
+
+def migrate_table_data(source_engine, sf_conn, table_name, incremental=False, watermark_column='id'):
+    snowflake_table_name = _snowflake_table_name(table_name)
+    sink = SnowflakeSink(sf_conn)
+
+    if incremental:
+        nrows = sync_table(source_engine, sink, table_name, watermark_column)
+        print(f"Merged {nrows} new rows into {snowflake_table_name}")
+        return
 
-    if df.empty:
+    stats = export_table(source_engine, sink, table_name)
+    if not stats['rows']:
         print(f"No data found in source for {snowflake_table_name}")
         return
 
-    with sf_conn.cursor() as cur:
-        cur.execute(f"TRUNCATE TABLE {SNOWFLAKE_DATABASE}.{SNOWFLAKE_SCHEMA}.{snowflake_table_name}")
-        pass
+    print(
+        f"Migrated {stats['rows']} rows to {snowflake_table_name} in {stats['seconds']:.4f} seconds "
+        f"({stats['rows'] / stats['seconds']:.4f} per seconds), peak RSS {stats['peak_rss_mb']:.1f} MB"
+    )
 
-    success, nchunks, nrows, _ = write_pandas(
-        conn=sf_conn,
-        df=df,
-        table_name=snowflake_table_name,
-        schema=SNOWFLAKE_SCHEMA,
-        database=SNOWFLAKE_DATABASE,
+
+def migrate_tables(source_engine, table_names=EXPORT_TABLES, workers=4):
+    # Full reload with export.export_tables, every worker uploads on its own Snowflake connection
+    stats = export_tables(
+        source_engine,
+        lambda: SnowflakeSink(get_snowflake_connection()),
+        table_names,
+        workers,
     )
+    for table_name, table_stats in stats.items():
+        print(
+            f"Migrated {table_stats['rows']} rows to {_snowflake_table_name(table_name)} "
+            f"in {table_stats['partitions']} partitions"
+        )
+
+
+def snowflake_type(arrow_type):
+    if pa.types.is_list(arrow_type):
+        return 'ARRAY'
+    if pa.types.is_boolean(arrow_type):
+        return 'BOOLEAN'
+    if pa.types.is_integer(arrow_type):
+        return 'INTEGER'
+    if pa.types.is_floating(arrow_type):
+        return 'FLOAT'
+    if pa.types.is_decimal(arrow_type):
+        return f'NUMBER({arrow_type.precision},{arrow_type.scale})'
+    if pa.types.is_timestamp(arrow_type):
+        return 'TIMESTAMP_TZ' if arrow_type.tz else 'TIMESTAMP_NTZ'
+    if pa.types.is_date(arrow_type):
+        return 'DATE'
+    if pa.types.is_string(arrow_type):
+        return 'VARCHAR'
+    raise TypeError(f'No Snowflake type for {arrow_type}')
+
+
+def create_table_ddl(table_name, table_names=EXPORT_TABLES):
+    # Derived from the model through export.arrow_type, the same types the staging files are written with
+    table = get_table(table_name)
+    lines = [
+        f'{column.name} {snowflake_type(arrow_type(column.type))}{"" if column.nullable else " NOT NULL"}'
+        for column in table.columns
+    ]
+    lines.append(f'PRIMARY KEY ({", ".join(column.name for column in table.primary_key)})')
+    for foreign_key in table.foreign_keys:
+        # Only between exported tables
+        if foreign_key.column.table.name in table_names:
+            lines.append(
+                f'FOREIGN KEY ({foreign_key.parent.name}) '
+                f'REFERENCES {_snowflake_table_name(foreign_key.column.table.name)}({foreign_key.column.name})'
+            )
 
-    if success:
-        print(f"Migrated {nrows} rows to {snowflake_table_name}")
-    else:
-        print(f"Failed to migrate {snowflake_table_name}")
+    columns = ',\n    '.join(lines)
+    return f'CREATE TABLE IF NOT EXISTS {_snowflake_table_name(table_name)} (\n    {columns}\n)'
 
 
-def create_snowflake_tables(conn):
+def create_snowflake_tables(conn, table_names=EXPORT_TABLES):
     with conn.cursor() as cur:
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS EVENTHORIZON_TOPIC (
-                id INTEGER PRIMARY KEY,
-                created_at TIMESTAMP_NTZ NOT NULL,
-                name VARCHAR
-            );
-        """)
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS EVENTHORIZON_METRIC (
-                id INTEGER PRIMARY KEY,
-                created_at TIMESTAMP_NTZ NOT NULL,
-                name VARCHAR,
-                topic_ids ARRAY
-            )
-        """)
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS EVENTHORIZON_METRICVALUE (
-                id INTEGER PRIMARY KEY,
-                created_at TIMESTAMP_NTZ NOT NULL,
-                value NUMERIC(10,4),
-                calculated_on TIMESTAMP_NTZ,
-                metric_id INTEGER,
-                FOREIGN KEY (metric_id) REFERENCES EVENTHORIZON_METRIC(id)
-            )
-        """)
+        for table_name in table_names:
+            cur.execute(create_table_ddl(table_name, table_names))
 
 
 if __name__ == "__main__":
+    incremental = '--incremental' in sys.argv
+    workers = int(sys.argv[sys.argv.index('--workers') + 1]) if '--workers' in sys.argv else 4
+
     source_engine = create_engine(
         Config.DATABASE_URL,
         connect_args={
             'options': '-csearch_path={}'.format(Config.DB_SCHEMA)
         },
+        pool_size=workers,
     )
 
     sf_conn = get_snowflake_connection()
@@ -95,9 +214,11 @@ if __name__ == "__main__":
     try:
         create_snowflake_tables(sf_conn)
 
-        migrate_table_data(source_engine, sf_conn, 'topic')
-        migrate_table_data(source_engine, sf_conn, 'metric')
-        migrate_table_data(source_engine, sf_conn, 'metricvalue')
+        if incremental:
+            for table_name in EXPORT_TABLES:
+                migrate_table_data(source_engine, sf_conn, table_name, incremental)
+        else:
+            migrate_tables(source_engine, EXPORT_TABLES, workers)
 
         print("Migration completed successfully!")
 
@@ -0,0 +1,233 @@
+import datetime
+import time
+from typing import Iterable, List, Sequence
+
+from sqlalchemy import Date, DateTime, Integer, cast, column, delete, func, literal, select, text, values
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+
+from database import with_database
+import models
+
+Ledger = models.TransactionDaily
+
+# Statement columns by name
+GROUPS = {
+    'day': Ledger.day,
+    'client': models.Subscription.client_id,
+    'subscription': Ledger.subscription_id,
+    'topic': models.Subscription.topic_id,
+    'metric': Ledger.metric_id,
+}
+
+
+def _day(timestamp):
+    # Cast like the transaction insert does, so the amount lands on the day of its stored created_at
+    return cast(cast(timestamp, DateTime), Date)
+
+
+def _upsert(rows):
+    statement = pg_insert(Ledger).from_select(['subscription_id', 'day', 'metric_id', 'slot', 'count', 'amount'], rows)
+    return statement.on_conflict_do_update(
+        index_elements=[Ledger.subscription_id, Ledger.day, Ledger.metric_id, Ledger.slot],
+        set_={
+            'count': Ledger.count + statement.excluded.count,
+            'amount': Ledger.amount + statement.excluded.amount,
+        },
+    )
+
+
+def _grouped_transactions(transactions, slot: int):
+    day = _day(transactions.c.created_at)
+    keys = [transactions.c.subscription_id, day, transactions.c.metric_id]
+    return select(
+        *keys, literal(slot, Integer), func.count(), func.sum(transactions.c.amount)
+    ).group_by(*keys).order_by(*keys)
+
+
+def transactions_upsert(transactions: Iterable[dict], slot: int = 0):
+    rows = [
+        (transaction['subscription_id'], transaction['metric_id'], transaction['amount'], transaction['created_at'])
+        for transaction in transactions
+    ]
+    if not rows:
+        return None
+
+    new_transactions = values(
+        column('subscription_id', Integer),
+        column('metric_id', Integer),
+        column('amount', models.Transaction.amount.type),
+        column('created_at', DateTime),
+        name='new_transactions',
+    ).data(rows)
+    return _upsert(_grouped_transactions(new_transactions, slot))
+
+
+def add_to_statements(db: Session, transactions: Iterable[dict], slot: int = 0) -> int:
+    """
+    Adds settled transactions ({'subscription_id', 'metric_id', 'amount', 'created_at'} dicts) to the daily
+    ledger in one upsert into `slot`. Rows are locked in key order, after the subscriptions and right before
+    the commit, so they are held no longer than the subscriptions they belong to.
+    """
+    transactions = list(transactions)
+    statement = transactions_upsert(transactions, slot)
+    if statement is not None:
+        db.execute(statement)
+    return len(transactions)
+
+
+def settled_statements(settled):
+    """
+    Ledger upsert of the transactions returned by `settled` (a data-modifying CTE returning subscription_id,
+    metric_id, amount and created_at), to run in the statement that settles them.
+    """
+    return _upsert(_grouped_transactions(settled, 0))
+
+
+def backfill_statements(metric_ids: List[int] = None, **kwargs) -> int:
+    """
+    Rebuilds the ledger of `metric_ids` (default: every metric) from the settled transactions, one database
+    transaction per metric. Each one holds a SHARE lock on transaction, new and settling transactions wait
+    until that metric is rebuilt instead of being counted twice or lost. Days of expired partitions (see
+    partitions.expire_partitions) have no transactions left to rebuild from, their ledger rows are lost.
+    """
+    with with_database(**kwargs) as db:
+        if metric_ids is None:
+            metric_ids = [metric_id for metric_id, in db.query(models.Metric.id).order_by(models.Metric.id)]
+
+    count = 0
+    for metric_id in metric_ids:
+        with with_database(**kwargs) as db:
+            db.execute(text(f'LOCK TABLE {models.Transaction.__table__.fullname} IN SHARE MODE'))
+            db.execute(delete(Ledger).where(Ledger.metric_id == metric_id))
+
+            day = _day(models.Transaction.created_at)
+            keys = [models.Transaction.subscription_id, day, models.Transaction.metric_id]
+            result = db.execute(pg_insert(Ledger).from_select(
+                ['subscription_id', 'day', 'metric_id', 'count', 'amount'],
+                select(*keys, func.count(), func.sum(models.Transaction.amount)).where(
+                    models.Transaction.metric_id == metric_id,
+                    models.Transaction.settled.is_(True),
+                    models.Transaction.subscription_id.isnot(None),
+                    models.Transaction.amount.isnot(None),
+                ).group_by(*keys)
+            ))
+            count += result.rowcount
+            db.commit()
+    return count
+
+
+def _grouped(group_by, columns, start: datetime.date, end: datetime.date, client_id: int = None, subscription_id: int = None):
+    keys = [GROUPS[name] for name in group_by]
+    query = select(*keys, *columns).select_from(Ledger).where(Ledger.day >= start, Ledger.day < end)
+    # The ledger only has subscription ids
+    if client_id is not None or {'client', 'topic'} & set(group_by):
+        query = query.join(models.Subscription, models.Subscription.id == Ledger.subscription_id)
+    if client_id is not None:
+        query = query.where(models.Subscription.client_id == client_id)
+    if subscription_id is not None:
+        query = query.where(Ledger.subscription_id == subscription_id)
+    return query
+
+
+def statement_query(
+    start: datetime.date,
+    end: datetime.date,
+    client_id: int = None,
+    subscription_id: int = None,
+    group_by: Sequence[str] = ('day', 'topic', 'metric'),
+):
+    keys = [GROUPS[name] for name in group_by]
+    query = _grouped(
+        group_by,
+        [func.sum(Ledger.count).label('transactions'), func.sum(Ledger.amount).label('amount')],
+        start, end, client_id, subscription_id,
+    )
+    return query.group_by(*keys).order_by(*keys)
+
+
+def statement(
+    db: Session,
+    start: datetime.date,
+    end: datetime.date,
+    client_id: int = None,
+    subscription_id: int = None,
+    group_by: Sequence[str] = ('day', 'topic', 'metric'),
+) -> list:
+    """
+    Spend of a client, a subscription (or everyone) over the days in [start, end), one (*group_by,
+    transactions, amount) row per combination of the `group_by` columns ('day', 'client', 'subscription',
+    'topic', 'metric'). Read from the daily ledger: the cost grows with the days and subscriptions
+    covered, not with the number of transactions.
+    """
+    return db.execute(statement_query(start, end, client_id, subscription_id, group_by)).all()
+
+
+def top_spenders_query(start: datetime.date, end: datetime.date, limit: int = 10, by: str = 'client'):
+    key = GROUPS[by]
+    amount = func.sum(Ledger.amount).label('amount')
+    return _grouped([by], [amount], start, end).group_by(key).order_by(amount.desc(), key).limit(limit)
+
+
+def top_spenders(db: Session, start: datetime.date, end: datetime.date, limit: int = 10, by: str = 'client') -> list:
+    """
+    The `limit` clients (or subscriptions, topics, metrics, see `by`) that spent the most over the days in
+    [start, end), as (key, amount) rows.
+    """
+    return db.execute(top_spenders_query(start, end, limit, by)).all()
+
+
+def test_statement_latency(repeat: int = 200):
+    with with_database() as db:
+        last = db.query(func.max(models.Transaction.created_at)).scalar()
+        client_id, = db.query(models.Subscription.client_id).join(models.Transaction).group_by(
+            models.Subscription.client_id
+        ).order_by(func.count().desc()).first()
+        transactions = db.query(func.count(models.Transaction.id)).scalar()
+
+    end = last.date() + datetime.timedelta(days=1)
+
+    start_time = time.perf_counter()
+    rows = backfill_statements()
+    print(f"backfill_statements() built {rows} ledger rows from {transactions} transactions "
+          f"in {time.perf_counter() - start_time:.4f} seconds")
+
+    def raw_statement(start):
+        keys = [_day(models.Transaction.created_at), models.Subscription.topic_id, models.Transaction.metric_id]
+        return select(*keys, func.count(), func.sum(models.Transaction.amount)).join(models.Subscription).where(
+            models.Subscription.client_id == client_id,
+            models.Transaction.created_at >= start,
+            models.Transaction.created_at < end,
+        ).group_by(*keys).order_by(*keys)
+
+    def raw_top_spenders(start):
+        amount = func.sum(models.Transaction.amount)
+        return select(models.Subscription.client_id, amount).join(models.Subscription).where(
+            models.Transaction.created_at >= start,
+            models.Transaction.created_at < end,
+        ).group_by(models.Subscription.client_id).order_by(amount.desc(), models.Subscription.client_id).limit(10)
+
+    print(f"Starting statement latency test for client {client_id}...")
+
+    with with_database() as db:
+        for days in (1, 30, 365):
+            start = end - datetime.timedelta(days=days)
+            for name, ledger_query, raw_query in (
+                ('statement', statement_query(start, end, client_id), raw_statement(start)),
+                ('top_spenders', top_spenders_query(start, end), raw_top_spenders(start)),
+            ):
+                timings = {}
+                for label, query in (('ledger', ledger_query), ('raw', raw_query)):
+                    start_time = time.perf_counter()
+                    for _ in range(repeat):
+                        result = db.execute(query).all()
+                    timings[label] = (time.perf_counter() - start_time) / repeat
+
+                assert [tuple(row) for row in db.execute(ledger_query)] == [tuple(row) for row in db.execute(raw_query)], \
+                    f'{name} over {days} days does not match the transactions'
+                print(f"{name}({days} days, {len(result)} rows) ledger in {timings['ledger'] * 1000:.3f} ms, "
+                      f"transactions in {timings['raw'] * 1000:.3f} ms")
+
+
+if __name__ == '__main__':
+    test_statement_latency()
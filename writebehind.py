@@ -0,0 +1,250 @@
+import random
+import threading
+import time
+from collections import defaultdict
+from decimal import Decimal
+from typing import Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import func, select, update
+from sqlalchemy.orm import Session
+
+from counters import striped_amounts
+from database import with_database
+from routing import locked_in_order
+from statements import settled_statements
+import models
+
+SEED = 42
+
+
+def settle_transactions(db: Session, subscription_ids: Optional[Iterable[int]] = None) -> int:
+    """
+    Adds every unsettled transaction to its subscription's total_amount and the statement ledger and marks it
+    settled, in one statement.
+
+    Marking and adding happen atomically so a row is counted exactly once, even with several processes flushing
+    the same subscriptions, and the subscriptions are locked in id order so those flushers queue instead of
+    deadlocking. Without `subscription_ids` every unsettled transaction is settled (crash recovery).
+    """
+    # NOT settled, the predicate of ix_transaction_unsettled (IS false doesn't match it)
+    settled = update(models.Transaction).where(
+        ~models.Transaction.settled
+    )
+    if subscription_ids is not None:
+        settled = settled.where(models.Transaction.subscription_id.in_(list(subscription_ids)))
+
+    settled = settled.values(settled=True).returning(
+        models.Transaction.subscription_id,
+        models.Transaction.metric_id,
+        models.Transaction.amount,
+        models.Transaction.created_at,
+    ).cte('settled')
+    ledger = settled_statements(settled).cte('ledger')
+
+    deltas = select(
+        settled.c.subscription_id,
+        func.sum(settled.c.amount).label('delta'),
+    ).group_by(settled.c.subscription_id).cte('deltas')
+
+    result = db.execute(
+        update(models.Subscription)
+        .where(
+            models.Subscription.id == deltas.c.subscription_id,
+            models.Subscription.id.in_(locked_in_order(
+                select(models.Subscription.id).where(models.Subscription.id.in_(select(deltas.c.subscription_id)))
+            )),
+        )
+        .values(total_amount=models.Subscription.total_amount + deltas.c.delta)
+        .add_cte(ledger)
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount
+
+
+def unsettled_amounts(db: Session) -> Dict[int, Decimal]:
+    return dict(
+        db.query(models.Transaction.subscription_id, func.sum(models.Transaction.amount))
+        .filter(~models.Transaction.settled)
+        .group_by(models.Transaction.subscription_id)
+        .all()
+    )
+
+
+def ledger_offsets(db: Session) -> Dict[int, Decimal]:
+    # Logical total_amount (including stripes) minus the settled transactions of each subscription,
+    # flushing, compaction and recovery must never change it
+    striped = striped_amounts()
+    settled_amounts = select(
+        models.Transaction.subscription_id,
+        func.sum(models.Transaction.amount).label('amount'),
+    ).where(models.Transaction.settled.is_(True)).group_by(models.Transaction.subscription_id).subquery()
+
+    return dict(
+        db.query(
+            models.Subscription.id,
+            models.Subscription.total_amount
+            + func.coalesce(striped.c.amount, 0)
+            - func.coalesce(settled_amounts.c.amount, 0),
+        ).outerjoin(
+            settled_amounts, settled_amounts.c.subscription_id == models.Subscription.id
+        ).outerjoin(
+            striped, striped.c.subscription_id == models.Subscription.id
+        ).all()
+    )
+
+
+def recover(**kwargs) -> int:
+    with with_database(**kwargs) as db:
+        return settle_transactions(db)
+
+
+class WriteBehindAggregator:
+    """
+    Collects per-subscription total_amount deltas of transactions inserted with settled=False and applies them
+    in one statement every `flush_interval` seconds or once `max_pending` transactions are waiting.
+
+    The transaction rows are the durable record, memory only decides when to flush. After a crash run
+    `recover()` to apply whatever was left unsettled. Failed background flushes are retried, the most recent
+    failure is kept in `last_error`.
+    """
+
+    def __init__(self, flush_interval: float = 1.0, max_pending: int = 1000, **db_kwargs):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.db_kwargs = db_kwargs
+
+        self.flushes = 0
+        self.flushed_transactions = 0
+        self.last_error = None
+
+        self._pending = defaultdict(Decimal)
+        self._pending_count = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def record(self, transactions: Iterable[Tuple[int, Decimal]]):
+        with self._lock:
+            for subscription_id, amount in transactions:
+                self._pending[subscription_id] += amount
+                self._pending_count += 1
+            full = self._pending_count >= self.max_pending
+
+        if full:
+            if self._thread is None:
+                self.flush()
+            else:
+                self._wakeup.set()
+
+    def pending_amount(self, subscription_id: int) -> Decimal:
+        with self._lock:
+            return self._pending.get(subscription_id, Decimal(0))
+
+    def flush(self) -> int:
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(Decimal)
+            pending_count, self._pending_count = self._pending_count, 0
+
+        if not pending:
+            return 0
+
+        try:
+            with with_database(**self.db_kwargs) as db:
+                settle_transactions(db, pending.keys())
+        except Exception:
+            # Nothing was applied, keep the deltas for the next attempt
+            with self._lock:
+                for subscription_id, amount in pending.items():
+                    self._pending[subscription_id] += amount
+                self._pending_count += pending_count
+            raise
+
+        self.flushes += 1
+        self.flushed_transactions += pending_count
+        return pending_count
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='write-behind-flusher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                # Retried on the next interval, the deltas are still pending
+                self.last_error = e
+
+
+def test_write_behind(count: int, threads: int = 4):
+    from business import process_metric_value
+
+    random.seed(SEED)
+
+    with with_database() as db:
+        metric_ids = [
+            m.id for m in db.query(models.Metric).all()
+        ]
+        offsets_before = ledger_offsets(db)
+
+    events = [
+        (random.choice(metric_ids), Decimal(random.randint(1, 10000) / 100))
+        for _ in range(count)
+    ]
+
+    def worker(_events, _aggregator):
+        for metric_id, value in _events:
+            with with_database() as _db:
+                process_metric_value(_db, metric_id=metric_id, value=value, aggregator=_aggregator)
+
+    # Not started, so flushes run inline whenever max_pending transactions are waiting
+    aggregator = WriteBehindAggregator(max_pending=500)
+
+    start_time = time.perf_counter()
+    workers = [
+        threading.Thread(target=worker, args=(events[i::threads], aggregator), name=f'Worker-{i}')
+        for i in range(threads)
+    ]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+
+    # Simulate a crash, whatever is still pending in memory is never flushed
+    elapsed = time.perf_counter() - start_time
+    print(f"process_metric_value(count={count}, threads={threads}, write-behind) completed in {elapsed:.4f} seconds")
+    print(f'with ({(count / elapsed):.4f}) per seconds, {aggregator.flushes} flushes')
+
+    with with_database() as db:
+        unsettled = unsettled_amounts(db)
+    print(f'{sum(unsettled.values(), Decimal(0))} left unsettled in {len(unsettled)} subscriptions after crash')
+
+    recover()
+
+    with with_database() as db:
+        assert not unsettled_amounts(db), 'Unsettled transactions left after recovery'
+        assert ledger_offsets(db) == offsets_before, 'total_amount does not match the transaction ledger'
+    print('total_amount matches the transaction ledger after recovery')
+
+
+if __name__ == '__main__':
+    test_write_behind(1000)